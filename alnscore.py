@@ -9,7 +9,7 @@ http://onlinelibrary.wiley.com/doi/10.1002/prot.10146/abstract;jsessionid=18D6E9
 
 Output is a table with one row per alignment column:
 1. pos
-2. identity
+2. identity (see --scores for other choices)
 3. entropy
 4. basecounts as base:count tuples
 """
@@ -19,15 +19,21 @@ Output is a table with one row per alignment column:
 #
 import os
 import sys
-from math import log
 import logging
+import tempfile
+import shutil
 # optparse deprecated from Python 2.7 on
 from optparse import OptionParser
-from collections import Counter
 
 #--- third-party imports
 #
-from Bio import AlignIO
+try:
+    from Bio.SubsMat.MatrixInfo import blosum62 as BLOSUM62
+except ImportError:
+    # Bio.SubsMat was removed in Biopython 1.80
+    from Bio.Align import substitution_matrices
+    BLOSUM62 = dict(substitution_matrices.load("BLOSUM62").items())
+import numpy
 
 #--- project specific imports
 #
@@ -53,18 +59,43 @@ LOG = logging.getLogger("")
 logging.basicConfig(level=logging.WARN,
                     format='%(levelname)s [%(asctime)s]: %(message)s')
 
-        
-                
-def shannon_entropy(l, b=2):
-    """Return the Shannon entropy of random variable with probability
-    vector l.
 
-    Adopted from
-    http://www.lysator.liu.se/~jc/mthesis/A_Source_code.html#functiondef:entropies.py:shannon_entropy
-    """
-    return sum([-p*log(p, b) for p in l if p > 0])
+# number of alignment columns processed at once
+PROFILE_COL_BLOCK = 1024
+# number of residues counted at once, i.e. bounds the size of
+# temporary arrays (in elements) independent of the number of
+# sequences
+PROFILE_COUNT_BLOCK = 4 * 1024 * 1024
+
+GAP_CODES = [ord(c) for c in bioutils.GAP_CHARS]
 
-    
+NUCLEIC_ACID_CHARS = "ACGTURYSWKMBDHVN"
+
+# characters considered for entropy etc. dna is what used to be
+# hardcoded
+ALPHABETS = dict([
+    ('dna', "ACGTN"),
+    ('rna', "ACGUN"),
+    ('iupac-dna', "ACGTRYSWKMBDHVN"),
+    ('protein', "ACDEFGHIKLMNPQRSTVWY"),
+    #x = any
+    #z = Gln or Glu
+    #b = Asp or Asn
+    ('iupac-protein', "ACDEFGHIKLMNPQRSTVWYBZX"),
+    ])
+
+# number of rows sampled for guessing the alphabet
+ALPHABET_SAMPLE_ROWS = 100
+
+# Background amino acid frequencies as used by Capra & Singh (2007)
+# for their Jensen-Shannon divergence score (BLOSUM62 background)
+BLOSUM62_BACKGROUND = dict(
+    A=0.078, R=0.051, N=0.041, D=0.052, C=0.024, Q=0.034, E=0.059,
+    G=0.083, H=0.025, I=0.062, L=0.092, K=0.056, M=0.024, F=0.044,
+    P=0.043, S=0.059, T=0.055, W=0.014, Y=0.034, V=0.072)
+
+        
+                
 def cmdline_parser():
     """
     creates an OptionParser instance
@@ -88,41 +119,261 @@ def cmdline_parser():
                       dest="map_to",
                       help="If given, using unaligned positions of this"
                       " seq instead of aligned pos (skipping pos with gaps in this seq)")
+    parser.add_option("", "--low-mem",
+                      action="store_true", dest="low_mem",
+                      help="Don't load alignment (fasta only) into memory,"
+                      " but spool it to a memory-mapped temporary file")
+    parser.add_option("", "--tmp-dir",
+                      dest="tmp_dir",
+                      help="Directory for temporary files (see --low-mem)")
+    parser.add_option("-s", "--scores",
+                      dest="scores",
+                      default=','.join(DEFAULT_SCORES),
+                      help="Comma separated list of scores to report (one"
+                      " output column each, in given order). Choices: %s"
+                      " (default: %s)" % (
+                          ', '.join(sorted(SCORERS.keys())),
+                          ','.join(DEFAULT_SCORES)))
+    parser.add_option("-w", "--seq-weights",
+                      action="store_true", dest="seq_weights",
+                      help="Compute scores from counts weighted with"
+                      " position-based (Henikoff) sequence weights"
+                      " (base counts are reported unweighted)")
+    choices = ['auto'] + sorted(ALPHABETS.keys())
+    parser.add_option("-a", "--alphabet",
+                      dest="alphabet",
+                      default="auto",
+                      choices=choices,
+                      help="Alphabet used for scores (%s; default: auto)" % (
+                          ', '.join(choices)))
     return parser
 
 
-def seqid(colctr):
-    """colctr has to be collections.Counter for residues in an
-    alignment column
+def guess_alphabet(aln_mx, thresh=0.90, sample_rows=ALPHABET_SAMPLE_ROWS):
+    """Guess alphabet (dna, rna or protein) of byte matrix aln_mx
+    (uppercased) from a sample of evenly spaced rows.
+
+    As in seqstat.guess_if_nucleic_acid(), it's considered nucleic
+    acid if at least thresh of all residues are ACGTUN, and rna if
+    there are more Us than Ts.
+    """
+    nseqs = aln_mx.shape[0]
+    rows = numpy.unique(numpy.linspace(
+        0, nseqs-1, min(nseqs, sample_rows)).astype(numpy.int64))
+    res_counts = numpy.bincount(aln_mx[rows].ravel(), minlength=256)
+    res_counts[GAP_CODES] = 0
+    nres = res_counts.sum()
+    if nres == 0:
+        return 'dna'
+    if res_counts[[ord(c) for c in "ACGTUN"]].sum() / float(nres) < thresh:
+        return 'protein'
+    if res_counts[ord('U')] > res_counts[ord('T')]:
+        return 'rna'
+    return 'dna'
+
+
+def column_profile(mx, seq_weights=None):
+    """Returns residue counts for all columns of byte matrix mx
+    (nseqs x ncols) as matrix of shape (256, ncols), i.e. indexed by
+    character code, computed with one bincount per block of rows (see
+    PROFILE_COUNT_BLOCK). If seq_weights (one per sequence) are
+    given, counts are weighted (float)
+    """
+    (nseqs, ncols) = mx.shape
+    row_block = max(1, PROFILE_COUNT_BLOCK // max(1, ncols))
+    offsets = numpy.arange(ncols)
+    if seq_weights is None:
+        counts = numpy.zeros(256*ncols, dtype=numpy.int64)
+    else:
+        counts = numpy.zeros(256*ncols)
+    for i in xrange(0, nseqs, row_block):
+        flat_idx = mx[i:i+row_block].astype(numpy.int64) * ncols + offsets
+        weights = None
+        if seq_weights is not None:
+            weights = numpy.repeat(seq_weights[i:i+row_block], ncols)
+        counts += numpy.bincount(flat_idx.ravel(), weights=weights,
+                                 minlength=256*ncols)
+    return counts.reshape(256, ncols)
+
+
+def henikoff_weights(aln_mx, col_block=PROFILE_COL_BLOCK):
+    """Returns position-based sequence weights (Henikoff & Henikoff,
+    1994) for byte matrix aln_mx, normalized to sum up to the number
+    of sequences.
+
+    In every column each residue contributes 1/(k*n), where k is the
+    number of different residues in that column and n the number of
+    times this residue occurs. Gaps contribute nothing. Computed in
+    one pass over blocks of columns, each processed in blocks of rows
+    (see PROFILE_COUNT_BLOCK).
+    """
+    (nseqs, aln_len) = aln_mx.shape
+    weights = numpy.zeros(nseqs)
+    for block_start in xrange(0, aln_len, col_block):
+        mx = aln_mx[:, block_start:block_start+col_block]
+        ncols = mx.shape[1]
+        res_counts = column_profile(mx)
+        res_counts[GAP_CODES] = 0
+        num_types = (res_counts > 0).sum(axis=0)
+        # contribution of each residue code per column. 0 for gaps and
+        # absent residues
+        with numpy.errstate(divide='ignore'):
+            code_contrib = numpy.where(
+                res_counts > 0, 1.0/(num_types * res_counts), 0.0)
+        row_block = max(1, PROFILE_COUNT_BLOCK // max(1, ncols))
+        offsets = numpy.arange(ncols)
+        for i in xrange(0, nseqs, row_block):
+            weights[i:i+row_block] += code_contrib[
+                mx[i:i+row_block], offsets].sum(axis=1)
+    if weights.sum() == 0:
+        return numpy.ones(nseqs)
+    return weights * nseqs / weights.sum()
+
+
+def seqid_per_col(counts):
+    """Fraction of the most frequent non-gap residue per column of
+    profile counts (see column_profile()). 0.0 for all-gap columns
+    """
+    res_counts = counts.copy()
+    res_counts[GAP_CODES] = 0
+    return res_counts.max(axis=0) / counts.sum(axis=0).astype(numpy.float64)
+
+
+def entropy_per_col(counts, char_set):
+    """Shannon entropy (bits) of the residue distribution per column
+    of profile counts (see column_profile()), considering only
+    characters in char_set. Also returns the denominator (number of
+    residues in char_set) per column, which is 0 if there were none
+    (entropy is then undefined).
     """
-    for (res, count) in colctr.most_common():
-        if res not in bioutils.GAP_CHARS:
-            return count/float(sum(colctr.values()))
-    # can only happen if only gaps
-    return 0.0    
+    cs_counts = counts[[ord(c) for c in char_set]].astype(numpy.float64)
+    return (_entropy(cs_counts), cs_counts.sum(axis=0))
 
 
-def get_aln_column(aln, col_no):
-    """Replacement for depreacted Alignment.get_column()
+def _entropy(sym_counts):
+    """Shannon entropy (bits) per column of symbol counts (symbols x
+    columns). NaN for columns without any symbol
+    """
+    denom = sym_counts.sum(axis=0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        probs = sym_counts / denom
+        terms = numpy.where(probs > 0, -probs*numpy.log(probs)/numpy.log(2), 0.0)
+    # add 0.0 to avoid negative zero
+    ent = terms.sum(axis=0) + 0.0
+    ent[denom == 0] = numpy.nan
+    return ent
+
+
+def is_nucleic_charset(char_set):
+    """Returns True if all characters in char_set are nucleic acid
+    (IUPAC) characters
     """
-    assert col_no < aln.get_alignment_length() 
-    # get_column() and get_all_seq() deprecated
-    return ''.join([s.seq[col_no] for s in aln])
+    return set(char_set) <= set(NUCLEIC_ACID_CHARS)
+
+
+def substitution_matrix(char_set):
+    """Returns substitution scores for char_set as matrix: BLOSUM62
+    for protein, otherwise identity (match 1, mismatch 0)
+    """
+    if is_nucleic_charset(char_set):
+        return numpy.identity(len(char_set))
+    subst_mx = numpy.zeros((len(char_set), len(char_set)))
+    for (i, a) in enumerate(char_set):
+        for (j, b) in enumerate(char_set):
+            subst_mx[i, j] = BLOSUM62.get((a, b), BLOSUM62.get((b, a), 0))
+    return subst_mx
+
+
+def background_freqs(char_set):
+    """Returns background residue frequencies for char_set: BLOSUM62
+    background for protein, otherwise uniform
+    """
+    if is_nucleic_charset(char_set):
+        bg = numpy.ones(len(char_set))
+    else:
+        bg = numpy.array([BLOSUM62_BACKGROUND.get(c, min(BLOSUM62_BACKGROUND.values()))
+                          for c in char_set])
+    return bg / bg.sum()
+
+
+def score_identity(counts, char_set):
+    """Scorer: fraction of most frequent non-gap residue
+    """
+    return seqid_per_col(counts)
+
+
+def score_entropy(counts, char_set):
+    """Scorer: Shannon entropy of residues in char_set
+    """
+    return entropy_per_col(counts, char_set)[0]
+
+
+def score_gap_entropy(counts, char_set):
+    """Scorer: Shannon entropy of residues in char_set with gaps
+    (any gap character) as additional symbol
+    """
+    sym_counts = numpy.vstack([
+        counts[[ord(c) for c in char_set]],
+        counts[GAP_CODES].sum(axis=0)]).astype(numpy.float64)
+    return _entropy(sym_counts)
+
+
+def score_sum_of_pairs(counts, char_set):
+    """Scorer: average substitution score (see substitution_matrix())
+    over all pairs of residues in char_set. NaN for columns with less
+    than two residues
+    """
+    cs_counts = counts[[ord(c) for c in char_set]].astype(numpy.float64)
+    subst_mx = substitution_matrix(char_set)
+    nres = cs_counts.sum(axis=0)
+    # all pairs minus self pairs
+    pair_sum = (cs_counts * numpy.dot(subst_mx, cs_counts)).sum(axis=0) \
+      - numpy.dot(numpy.diag(subst_mx), cs_counts)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        sop = pair_sum / (nres*(nres-1))
+    sop[nres < 2] = numpy.nan
+    return sop
+
+
+def score_jsd(counts, char_set):
+    """Scorer: Jensen-Shannon divergence (bits) between the residue
+    distribution of residues in char_set and the background (see
+    background_freqs()), multiplied by the fraction of non-gaps
+    (Capra & Singh, 2007)
+    """
+    cs_counts = counts[[ord(c) for c in char_set]].astype(numpy.float64)
+    bg = background_freqs(char_set)[:, numpy.newaxis]
+    nres = cs_counts.sum(axis=0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        probs = cs_counts / nres
+        mix = 0.5 * (probs + bg)
+        kl_probs = numpy.where(probs > 0, probs*numpy.log(probs/mix), 0.0)
+        kl_bg = bg * numpy.log(bg/mix)
+    jsd = 0.5 * (kl_probs.sum(axis=0) + kl_bg.sum(axis=0)) / numpy.log(2)
+    jsd *= 1.0 - counts[GAP_CODES].sum(axis=0) / counts.sum(axis=0).astype(numpy.float64)
+    jsd[nres == 0] = numpy.nan
+    return jsd
+
+
+# registry of column scores. each scorer is called with the profile
+# counts (see column_profile(); possibly weighted) of a block of
+# columns plus the char_set and returns one score per column
+SCORERS = dict([
+    ('identity', score_identity),
+    ('entropy', score_entropy),
+    ('gap-entropy', score_gap_entropy),
+    ('sum-of-pairs', score_sum_of_pairs),
+    ('jsd', score_jsd),
+    ])
+DEFAULT_SCORES = ['identity', 'entropy']
 
 
 def unaln_pos_map(seq):
     """Returns a list of length seq, where each value contains the
     unaligned position (or None if NA)
     """
-    map_to_seq_cols = []
-    gap_ctr = 0
-    for i in range(len(seq)):
-        if seq[i] in bioutils.GAP_CHARS:
-            gap_ctr += 1
-        map_to_seq_cols.append(i-gap_ctr)
-        if map_to_seq_cols[-1] < 0:
-            map_to_seq_cols[-1] = None
-    return map_to_seq_cols
+    unaln_pos = numpy.arange(len(seq)) - bioutils.gap_prefix_count(seq)
+    return [p if p >= 0 else None for p in unaln_pos.tolist()]
 
 
 def main():
@@ -142,90 +393,127 @@ def main():
         sys.exit(1)
     if len(args):
         parser.error("Unrecognized arguments found: %s" % args)
+    scores = opts.scores.split(',')
+    for score in scores:
+        if score not in SCORERS:
+            parser.error("Unknown score '%s'" % score)
         
-    char_set = "ACGTU"
-    char_set = "ACDEFGHIKLMNPQRSTVWY"
-    #x = any
-    #z = Gln or Glu
-    #b = Asp or Asn
-    char_set = "ACGTN"
-
-    LOG.warn("using hardcoded charset %s" % char_set)
-    # FIXME auto-detection of alphabet)
-    
     if opts.aln_in != "-" and not os.path.exists(opts.aln_in):
         LOG.fatal("Input alignment %s does not exist.\n" % opts.aln_in)
         sys.exit(1)
 
     if opts.aln_in == "-":
-        fh = sys.stdin
         fmt = 'fasta'
     else:
         fmt = bioutils.guess_seqformat(opts.aln_in)
-        fh = open(opts.aln_in, "rU")
+    # transparently decompresses
+    fh = bioutils.xopen(opts.aln_in)
                 
-    entropy_per_col = []    
-    seqid_per_col = []    
-    # note: had one case where this happily read an unaligned file!?
-    aln = AlignIO.read(fh, fmt)
+    tmp_dir = None
+    if opts.low_mem:
+        if fmt != 'fasta':
+            LOG.fatal("Only fasta input supported in low memory mode")
+            sys.exit(1)
+        tmp_dir = tempfile.mkdtemp(prefix="alnscore-", dir=opts.tmp_dir)
+        aln = bioutils.Alignment.read_fasta(
+            fh, os.path.join(tmp_dir, "aln.u8"), upper=True)
+        # mapping stays valid after removal
+        shutil.rmtree(tmp_dir)
+    else:
+        # note: had one case where this happily read an unaligned file!?
+        aln = bioutils.Alignment.read(fh, fmt).upper()
+    aln_mx = aln.mx
 
-    # if requested, get sequence record for the sequence we should
-    # positions to
+    # if requested, get sequence (uppercased) for the sequence we
+    # should map positions to
     map_to_seq = None
     if opts.map_to:
-        map_to_seq = [rec.seq for rec in aln if rec.id == opts.map_to]
-        if not len(map_to_seq):
+        map_to_idx = [i for (i, sid) in enumerate(aln.ids) if sid == opts.map_to]
+        if not len(map_to_idx):
             LOG.fatal("Couldn't find a sequence called %s in %s" % (
                 opts.map_to, fh.name))
             sys.exit(1)
-        elif len(map_to_seq)>1:
+        elif len(map_to_idx)>1:
             LOG.fatal("Find more than one sequence with name %s in %s" % (
                 opts.map_to, fh.name))
             sys.exit(1)
-        map_to_seq = map_to_seq[0]
+        map_to_seq = aln.seq(map_to_idx[0])
         map_to_seq_cols = unaln_pos_map(map_to_seq)
-        
-    for i in xrange(aln.get_alignment_length()):
-        #col = aln.get_column(i) # deprecated
-        col = get_aln_column(aln, i).upper()
-        not_in_char_set = [c for c in col if c not in char_set]
-        not_in_char_set = [c for c in not_in_char_set if c not in bioutils.GAP_CHARS]        
-        if len(not_in_char_set):
-            LOG.warn("Found characters not in char_set (%s) in col %d (%s)" % (
-                char_set, i+1, set(not_in_char_set)))
-        counter = Counter(col)
-
-        vec = []
-        # this will ignore invalid chars incl. ambiguities        
-        denom = sum([counter[r] for r in char_set])
-        if denom == 0:
-            LOG.fatal("denom = 0, means no valid chars in col %d?" % (i+1))
-            #import pdb; pdb.set_trace()
-            raise ValueError
-        for res in char_set:
-            vec.append(counter[res]/float(denom))
-        LOG.debug("vec=%s denom=%s counter=%s" % (vec, denom, counter))
-        entropy_per_col.append(shannon_entropy(vec))
-
-        seqid_per_col.append(seqid(counter))
-
-        # due to the fact that we keep all values (which is actually
-        # not necessary but would come in handy if values were
-        # precalculated) we cannot simply continue or there would be
-        # some missing. 'continue/next' here if needed.
-        if map_to_seq and map_to_seq[i] in bioutils.GAP_CHARS:
-            LOG.debug("Skipping col %d because map_to_seq has gap there." % (i+1))
-            continue
-
-        counts_str = ' '.join(
-            ["%s:%d" % (k,v) for (k,v) in sorted(counter.iteritems())])
-        if not map_to_seq:
-            rep_col = i
-        else: 
-            rep_col = map_to_seq_cols[i]
-        print "%d %.6f %.6f %s" % (
-            rep_col+1 if not map_to_seq else map_to_seq_cols[i]+1, 
-            seqid_per_col[i], entropy_per_col[i], counts_str)
+
+    # scores are computed per block of columns and rows are printed
+    # progressively
+    aln_len = aln_mx.shape[1]
+    if opts.alphabet == 'auto':
+        alphabet = guess_alphabet(aln_mx)
+        LOG.info("Guessed alphabet: %s" % alphabet)
+    else:
+        alphabet = opts.alphabet
+    char_set = ALPHABETS[alphabet]
+
+    valid_codes = set([ord(c) for c in char_set] + GAP_CODES)
+    # for aggregated reporting of characters not in char_set
+    invalid_totals = numpy.zeros(256, dtype=numpy.int64)
+    invalid_num_cols = 0
+    seq_weights = None
+    if opts.seq_weights:
+        seq_weights = henikoff_weights(aln_mx)
+        LOG.info("Sequence weights: min %f max %f" % (
+            seq_weights.min(), seq_weights.max()))
+    for block_start in xrange(0, aln_len, PROFILE_COL_BLOCK):
+        block_end = min(block_start+PROFILE_COL_BLOCK, aln_len)
+        counts = column_profile(aln_mx[:, block_start:block_end])
+        if seq_weights is not None:
+            score_counts = column_profile(aln_mx[:, block_start:block_end],
+                                          seq_weights)
+        else:
+            score_counts = counts
+        # all scores from the same counts
+        score_vals = [SCORERS[score](score_counts, char_set)
+                      for score in scores]
+        denoms = counts[[ord(c) for c in char_set]].sum(axis=0)
+        present_codes = numpy.flatnonzero(counts.any(axis=1))
+        invalid_codes = [c for c in present_codes if c not in valid_codes]
+        if invalid_codes:
+            invalid_totals[invalid_codes] += counts[invalid_codes].sum(axis=1)
+            invalid_num_cols += counts[invalid_codes].any(axis=0).sum()
+
+        for j in xrange(block_end-block_start):
+            i = block_start + j
+            col_codes = [c for c in present_codes if counts[c, j]]
+            if LOG.isEnabledFor(logging.DEBUG):
+                not_in_char_set = [chr(c) for c in invalid_codes if counts[c, j]]
+                if len(not_in_char_set):
+                    LOG.debug("Found characters not in char_set (%s) in col %d (%s)" % (
+                        char_set, i+1, set(not_in_char_set)))
+
+            # this will ignore invalid chars incl. ambiguities
+            if denoms[j] == 0 and 'entropy' in scores:
+                LOG.fatal("denom = 0, means no valid chars in col %d?" % (i+1))
+                raise ValueError
+            LOG.debug("denom=%s counts=%s" % (
+                denoms[j], dict((chr(c), counts[c, j]) for c in col_codes)))
+
+            # 'continue/next' here if needed.
+            if map_to_seq and bioutils.isgap(map_to_seq[i]):
+                LOG.debug("Skipping col %d because map_to_seq has gap there." % (i+1))
+                continue
+
+            counts_str = ' '.join(
+                ["%s:%d" % (chr(c), counts[c, j]) for c in col_codes])
+            if not map_to_seq:
+                rep_col = i
+            else: 
+                rep_col = map_to_seq_cols[i]
+            print "%d %s %s" % (
+                rep_col+1, ' '.join(["%.6f" % v[j] for v in score_vals]),
+                counts_str)
+
+    if invalid_num_cols:
+        LOG.warn("Found characters not in %s alphabet (%s) in %d columns"
+                 " (ignored for entropy): %s" % (
+                     alphabet, char_set, invalid_num_cols, ' '.join(
+                         ["%s:%d" % (chr(c), invalid_totals[c])
+                          for c in numpy.flatnonzero(invalid_totals)])))
 
     if fh != sys.stdout:
         fh.close()
@@ -6,10 +6,38 @@
 #--- standard library imports
 #
 import os
+import io
+import sys
+import zlib
+import bz2
+import errno
+import signal
+import threading
+import subprocess
+import struct
+import mmap
+import gzip
+import string
+import multiprocessing
+from cStringIO import StringIO
+from itertools import izip
+from distutils.spawn import find_executable
 
 #--- third-party imports
 #
-#/
+import numpy
+from Bio import AlignIO
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 #--- project specific imports
 #
@@ -24,12 +52,79 @@ __license__ = "The MIT License (MIT)"
 
 GAP_CHARS = ['-', '~', '.']
 
+# precomputed versions of GAP_CHARS for constant time lookups,
+# str.translate() (str and unicode) and numpy indexing by character
+# code
+GAP_SET = frozenset(GAP_CHARS)
+_GAP_DELETE_CHARS = ''.join(GAP_CHARS)
+_GAP_DELETE_TABLE = dict((ord(c), None) for c in GAP_CHARS)
+_GAP_LOOKUP = numpy.zeros(256, dtype=numpy.bool_)
+_GAP_LOOKUP[[ord(c) for c in GAP_CHARS]] = True
+# whitespace removed from (multi-line) fasta sequences
+_SEQ_WHITESPACE = '\r\n \t'
+
+# read size for read_fastx()
+FASTX_BLOCK_SIZE = 4 * 1024 * 1024
+
+# magic bytes of compressed files. bgzip is gzip with a 'BC' extra
+# subfield and checked separately in guess_compression()
+COMPRESSION_MAGIC = [
+    ('gzip', '\x1f\x8b'),
+    ('bz2', 'BZh'),
+    ('xz', '\xfd7zXZ\x00'),
+    ('zstd', '\x28\xb5\x2f\xfd')]
+COMPRESSION_EXTS = ['.gz', '.bgz', '.bz2', '.xz', '.zst']
+
+# external decompressors writing to stdout, tried in given order
+# (multi-threaded ones first). if none is found decompression
+# happens in a background thread
+DECOMPRESSORS = dict(
+    gzip = [['pigz', '-dc'], ['gzip', '-dc']],
+    bz2 = [['lbzip2', '-dc'], ['pbzip2', '-dc'], ['bzip2', '-dc']],
+    xz = [['xz', '-dc']],
+    zstd = [['zstd', '-dcq']])
+DECOMPRESSORS['bgzip'] = [['bgzip', '-dc']] + DECOMPRESSORS['gzip']
+
+# external compressors reading from stdin, tried in given order. if
+# none is found compression happens in-process
+COMPRESSORS = dict(
+    gzip = [['pigz', '-c'], ['gzip', '-c']],
+    bgzip = [['bgzip', '-c']])
+# buffer size of files opened by xopen_write()
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# (compressed) bytes per chunk in fastx_chunks()
+FASTX_CHUNK_SIZE = 4 * 1024 * 1024
+# read size for completing the last record of a chunk of an
+# uncompressed file
+PLAIN_READ_MORE_SIZE = 64 * 1024
+# compressed size of an empty BGZF block (as used for eof markers)
+BGZF_EMPTY_BLOCK_SIZE = 28
+# the empty BGZF block itself
+BGZF_EOF_BLOCK = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00' \
+  'BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+# uncompressed bytes per BGZF block written by _BgzfWriter (as in
+# htslib; leaves room for incompressible data)
+BGZF_BLOCK_DATA_SIZE = 0xff00
+
+# read size for background thread decompression
+DECOMPRESS_CHUNK_SIZE = 1024 * 1024
+
+# PHYLIP only knows '-' as gap
+_PHYLIP_GAP_TABLE = string.maketrans(_GAP_DELETE_CHARS, '-' * len(GAP_CHARS))
+
+# formats supported by Alignment.write()
+ALN_WRITE_FORMATS = ['fasta', 'phylip', 'stockholm', 'clustal']
+
+_UPPER_LOOKUP = numpy.frombuffer(
+    ''.join([chr(i) for i in range(256)]).upper(), dtype=numpy.uint8)
+
 
 
 def isgap(res):
     """Return true if given residue is a gap character
     """
-    return (res in GAP_CHARS)
+    return (res in GAP_SET)
 
 
 def ungap(seqstr):
@@ -40,9 +135,1431 @@ def ungap(seqstr):
     
     #assert isinstance(seqstr, type("")) or \
     #  isinstance(seqstr, type(u""))
-    for c in GAP_CHARS:
-        seqstr = seqstr.replace(c, '')
-    return seqstr
+    if isinstance(seqstr, unicode):
+        return seqstr.translate(_GAP_DELETE_TABLE)
+    return seqstr.translate(None, _GAP_DELETE_CHARS)
+
+
+def as_byte_array(seq_or_aln):
+    """Return sequence (string, Seq or SeqRecord) or alignment (list
+    or tuple of sequences of identical length, or Biopython
+    alignment) as uint8 numpy array (1-D or 2-D). uint8 arrays are
+    returned as they are.
+    """
+
+    if isinstance(seq_or_aln, numpy.ndarray):
+        assert seq_or_aln.dtype == numpy.uint8
+        return seq_or_aln
+    if isinstance(seq_or_aln, (list, tuple)) or \
+      hasattr(seq_or_aln, 'get_alignment_length'):
+        return numpy.vstack([as_byte_array(s) for s in seq_or_aln])
+    if hasattr(seq_or_aln, 'seq'):
+        seq_or_aln = seq_or_aln.seq
+    return numpy.frombuffer(str(seq_or_aln), dtype=numpy.uint8)
+
+
+def gap_mask(seq_or_aln):
+    """Return a boolean numpy array, which is True for every gap in
+    given sequence or alignment (see as_byte_array() for supported
+    types)
+    """
+    return _GAP_LOOKUP[as_byte_array(seq_or_aln)]
+
+
+def to_upper(seq_or_aln):
+    """Return uppercased copy of given sequence or alignment as uint8
+    numpy array (see as_byte_array() for supported types)
+    """
+    return _UPPER_LOOKUP[as_byte_array(seq_or_aln)]
+
+
+def gap_prefix_count(seq_or_aln):
+    """Return numpy array with the number of gaps up to and including
+    each position of given sequence or alignment (per row; see
+    as_byte_array() for supported types)
+    """
+    return numpy.cumsum(gap_mask(seq_or_aln), axis=-1)
+
+
+
+def guess_compression(magic):
+    """Guess compression type ('gzip', 'bgzip', 'bz2', 'xz', 'zstd')
+    from the first bytes of a file. Returns None if not compressed
+    (or unknown)
+    """
+    for (compression, prefix) in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            # bgzip: FEXTRA flag set and 'BC' subfield
+            if compression == 'gzip' and len(magic) >= 14 \
+              and ord(magic[3]) & 4 and magic[12:14] == 'BC':
+                return 'bgzip'
+            return compression
+    return None
+
+
+
+def _new_decompressor(compression):
+    """Returns a function creating a fresh streaming decompressor
+    object for the given compression type or None if not supported
+    by the available modules
+    """
+    if compression in ['gzip', 'bgzip']:
+        return lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        return bz2.BZ2Decompressor
+    elif compression == 'xz' and lzma is not None:
+        return lzma.LZMADecompressor
+    elif compression == 'zstd' and zstandard is not None:
+        return lambda: zstandard.ZstdDecompressor().decompressobj()
+    return None
+
+
+
+def _stream_ended(decomp):
+    """Returns True if the streaming decompressor decomp has seen the
+    end of its stream, i.e. its input wasn't truncated
+    """
+    if hasattr(decomp, 'eof'):
+        return decomp.eof
+    if not hasattr(decomp, 'unused_data'):
+        # can't tell
+        return True
+    # Python 2 zlib and bz2 objects don't know eof: fed after the end
+    # bz2 raises EOFError and zlib keeps the data as unused_data
+    try:
+        decomp.decompress('\0')
+    except EOFError:
+        return True
+    except (IOError, zlib.error):
+        return False
+    return decomp.unused_data == '\0'
+
+
+
+def _decompress_to_pipe(fh_in, new_decomp, fd_out, errors):
+    """Decompresses fh_in into file descriptor fd_out. Meant to be run
+    in a thread. Concatenated streams (multi-member gzip, bgzip etc.)
+    are supported. Truncated input is an error. Exceptions are
+    appended to errors
+    """
+
+    # errors have to be recorded before the pipe is closed, otherwise
+    # the reader might see a clean EOF first
+    with os.fdopen(fd_out, 'wb') as fh_out:
+        try:
+            decomp = new_decomp()
+            while True:
+                data = fh_in.read(DECOMPRESS_CHUNK_SIZE)
+                if not data:
+                    break
+                while data:
+                    try:
+                        fh_out.write(decomp.decompress(data))
+                    except EOFError:
+                        # previous stream ended exactly at chunk end
+                        decomp = new_decomp()
+                        continue
+                    # start of next stream, if any
+                    data = getattr(decomp, 'unused_data', '')
+                    if data:
+                        decomp = new_decomp()
+            if not _stream_ended(decomp):
+                raise EOFError("Compressed input ended before the"
+                               " end-of-stream marker was reached")
+        except Exception as err:
+            errors.append(err)
+        finally:
+            fh_in.close()
+
+
+
+def _restore_sigpipe():
+    """Python ignores SIGPIPE, which is inherited by subprocesses.
+    Restore the default so that decompressors exit quietly if we
+    stop reading early
+    """
+    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+
+
+
+class _DecompressedFile(object):
+    """Read-only file-like object for a decompression pipe. Checks
+    for decompression errors on close
+    """
+
+    def __init__(self, fh, name, proc=None, thread_errors=None):
+        self._fh = fh
+        self._proc = proc
+        self._thread_errors = thread_errors
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._fh, attr)
+
+    def __iter__(self):
+        return iter(self._fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Closes pipe and raises IOError if decompression failed
+        """
+        if self._fh.closed:
+            return
+        self._fh.close()
+        if self._proc is not None:
+            # killed by SIGPIPE if closed before reading everything
+            if self._proc.wait() not in [0, -signal.SIGPIPE]:
+                raise IOError(
+                    "Decompression of %s failed (exit status %d)" % (
+                        self.name, self._proc.returncode))
+        if self._thread_errors:
+            for err in self._thread_errors:
+                # reader closed the pipe early
+                if isinstance(err, (IOError, OSError)) \
+                  and err.errno == errno.EPIPE:
+                    continue
+                raise IOError("Decompression of %s failed: %s" % (
+                    self.name, err))
+
+
+
+def xopen(fname, use_external=True):
+    """Open a (possibly compressed) file for reading. Use '-' for
+    stdin.
+
+    Compression (gzip, bgzip, bz2, xz and zstd) is detected from
+    magic bytes, not the file extension. Compressed files are
+    decompressed in the background, so that parsing and decompression
+    overlap: by an external program (e.g. pigz, see DECOMPRESSORS) if
+    use_external is True and one is found, otherwise in a thread.
+    Returns a file-like object. Uncompressed files are opened as
+    before in universal newline mode.
+    """
+
+    if fname == '-':
+        # peek needs a buffered reader, which we return in any case
+        fh_raw = io.open(sys.stdin.fileno(), 'rb', closefd=False)
+        compression = guess_compression(fh_raw.peek(16)[:16])
+        if not compression:
+            return fh_raw
+    else:
+        with open(fname, 'rb') as fh:
+            compression = guess_compression(fh.read(16))
+        if not compression:
+            return open(fname, 'rU')
+        fh_raw = open(fname, 'rb')
+
+    # stdin was partially consumed by peek, so external programs
+    # can't read from its file descriptor directly
+    if use_external and fname != '-':
+        for cmd in DECOMPRESSORS[compression]:
+            if find_executable(cmd[0]):
+                proc = subprocess.Popen(cmd, stdin=fh_raw,
+                                        stdout=subprocess.PIPE,
+                                        bufsize=-1,
+                                        preexec_fn=_restore_sigpipe)
+                fh_raw.close()
+                return _DecompressedFile(proc.stdout, fname, proc=proc)
+
+    new_decomp = _new_decompressor(compression)
+    if new_decomp is None:
+        fh_raw.close()
+        raise IOError("Can't decompress %s: no %s decompressor found" % (
+            fname, compression))
+    (fd_in, fd_out) = os.pipe()
+    errors = []
+    thread = threading.Thread(target=_decompress_to_pipe,
+                              args=(fh_raw, new_decomp, fd_out, errors))
+    thread.daemon = True
+    thread.start()
+    return _DecompressedFile(os.fdopen(fd_in, 'rb'), fname,
+                             thread_errors=errors)
+
+
+
+class _CompressedFile(object):
+    """Write-only file-like object compressing to an underlying file,
+    either through an external program or in-process. Checks for
+    compression errors on close
+    """
+
+    def __init__(self, fh, name, proc=None, fh_raw=None):
+        self._fh = fh
+        self._proc = proc
+        self._fh_raw = fh_raw
+        self.name = name
+        # not all writers have a closed attribute
+        self.closed = False
+
+    def __getattr__(self, attr):
+        return getattr(self._fh, attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Flushes and closes the compressed stream. Raises IOError if
+        compression failed
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._fh.close()
+        if self._fh_raw is not None:
+            self._fh_raw.close()
+        if self._proc is not None and self._proc.wait() != 0:
+            raise IOError("Compression of %s failed (exit status %d)" % (
+                self.name, self._proc.returncode))
+
+
+
+class _BgzfWriter(object):
+    """Minimal BGZF writer, which (unlike Bio.bgzf.BgzfWriter)
+    never calls tell() or seek() on the underlying file, so that it
+    can write to pipes. Writes the eof marker and closes fh on close
+    """
+
+    def __init__(self, fh, level=6):
+        self._fh = fh
+        self._level = level
+        self._buf = []
+        self._buf_len = 0
+
+    def write(self, data):
+        """Buffers data and writes all complete blocks
+        """
+        self._buf.append(data)
+        self._buf_len += len(data)
+        if self._buf_len >= BGZF_BLOCK_DATA_SIZE:
+            data = ''.join(self._buf)
+            end = len(data) - len(data) % BGZF_BLOCK_DATA_SIZE
+            for start in xrange(0, end, BGZF_BLOCK_DATA_SIZE):
+                self._write_block(data[start:start+BGZF_BLOCK_DATA_SIZE])
+            self._buf = [data[end:]]
+            self._buf_len = len(data) - end
+
+    def _write_block(self, data):
+        """Writes data as one BGZF block (gzip member with the 'BC'
+        extra subfield holding the block size)
+        """
+        comp = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        cdata = comp.compress(data) + comp.flush()
+        # header (18 bytes) + cdata + crc32 and size (8 bytes)
+        bsize = len(cdata) + 26
+        self._fh.write('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff'
+                       '\x06\x00BC\x02\x00' + struct.pack('<H', bsize - 1))
+        self._fh.write(cdata)
+        self._fh.write(struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                                   len(data)))
+
+    def flush(self):
+        """Writes buffered data as (possibly short) block and flushes
+        the underlying file
+        """
+        if self._buf_len:
+            self._write_block(''.join(self._buf))
+            self._buf = []
+            self._buf_len = 0
+        self._fh.flush()
+
+    def close(self):
+        """Writes remaining data and eof marker and closes the
+        underlying file
+        """
+        self.flush()
+        self._fh.write(BGZF_EOF_BLOCK)
+        self._fh.close()
+
+
+
+def xopen_write(fname, compression=None, use_external=True):
+    """Open a file for writing through a large buffer
+    (WRITE_BUFFER_SIZE). Use '-' for stdout.
+
+    Output is compressed if compression is 'gzip' or 'bgzip' or, if
+    None, guessed from the file extension (.gz or .bgz). Compression
+    happens in an external program (see COMPRESSORS) if use_external
+    is True and one is found, otherwise in-process.
+    """
+
+    if compression is None and fname != '-':
+        ext = os.path.splitext(fname)[1]
+        compression = dict([('.gz', 'gzip'), ('.bgz', 'bgzip')]).get(ext)
+    if compression not in [None, 'gzip', 'bgzip']:
+        raise ValueError("Unsupported output compression %s" % compression)
+
+    if fname == '-':
+        # don't close the real stdout
+        sys.stdout.flush()
+        fh_raw = os.fdopen(os.dup(sys.stdout.fileno()), 'wb',
+                           WRITE_BUFFER_SIZE)
+    else:
+        fh_raw = open(fname, 'wb', WRITE_BUFFER_SIZE)
+    if not compression:
+        return fh_raw
+
+    if use_external:
+        for cmd in COMPRESSORS[compression]:
+            if find_executable(cmd[0]):
+                fh_raw.flush()
+                proc = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                        stdout=fh_raw,
+                                        bufsize=WRITE_BUFFER_SIZE)
+                fh_raw.close()
+                return _CompressedFile(proc.stdin, fname, proc=proc)
+
+    if compression == 'bgzip':
+        # writes eof marker and closes fh_raw
+        return _CompressedFile(_BgzfWriter(fh_raw), fname)
+    return _CompressedFile(gzip.GzipFile(fileobj=fh_raw, mode='wb'),
+                           fname, fh_raw=fh_raw)
+
+
+
+def _header_id(header):
+    """Return id of a header (everything up to the first whitespace,
+    as in SeqIO)
+    """
+    if not header:
+        return ''
+    return header.split(None, 1)[0]
+
+
+
+def _fasta_blocks(fh, block_size):
+    """Yields blocks of complete fasta records read from fh in chunks
+    of block_size bytes. Every block starts with '>' and ends before
+    the '>' of the next record. Anything before the first record is
+    skipped.
+    """
+
+    # parts of the current (incomplete) record(s), joined only once
+    # the start of a next record is seen, so that records longer than
+    # block_size don't lead to quadratic copying
+    parts = []
+    prev_char = ''
+    started = False
+    while True:
+        block = fh.read(block_size)
+        if not block:
+            if parts:
+                yield ''.join(parts)
+            return
+        # record starting right at the beginning of this block
+        boundary = block.startswith('>') and prev_char in ['', '\n']
+        prev_char = block[-1]
+        if not started:
+            if not boundary:
+                idx = block.find('\n>')
+                if idx < 0:
+                    continue
+                block = block[idx+1:]
+            started = True
+        elif boundary and parts:
+            yield ''.join(parts)
+            parts = []
+        last = block.rfind('\n>')
+        if last < 0:
+            parts.append(block)
+            continue
+        parts.append(block[:last+1])
+        yield ''.join(parts)
+        parts = [block[last+1:]]
+
+
+
+def _fastq_lines(fh, block_size):
+    """Yields lists of lines of complete (four-line) fastq records,
+    read from fh in chunks of block_size bytes
+    """
+
+    leftover = ''
+    while True:
+        block = fh.read(block_size)
+        buf = leftover + block
+        if '\r' in buf:
+            buf = buf.replace('\r', '')
+        if not block:
+            lines = buf.split('\n')
+            while lines and not lines[-1]:
+                lines.pop()
+            if len(lines) % 4:
+                raise ValueError("Truncated fastq record at end of file")
+            if lines:
+                yield lines
+            return
+        last_nl = buf.rfind('\n')
+        if last_nl < 0:
+            leftover = buf
+            continue
+        lines = buf[:last_nl].split('\n')
+        nlines = len(lines) - len(lines) % 4
+        leftover = '\n'.join(lines[nlines:] + [buf[last_nl+1:]])
+        if nlines:
+            yield lines[:nlines]
+
+
+
+def _fastx_records_mv(fh, fmt, block_size):
+    """Like read_fastx(), but sequences (and qualities) are
+    memoryviews into the block buffer. Sequences of multi-line fasta
+    records can't be referenced like that and are returned as strings
+    """
+
+    if fmt == 'fasta':
+        for buf in _fasta_blocks(fh, block_size):
+            mv = memoryview(buf)
+            pos = 0
+            buf_len = len(buf)
+            while pos < buf_len:
+                # buf[pos] is '>'
+                header_end = buf.find('\n', pos)
+                if header_end < 0:
+                    header_end = buf_len
+                next_rec = buf.find('\n>', header_end)
+                if next_rec < 0:
+                    next_rec = buf_len
+                header = buf[pos+1:header_end].rstrip()
+                seq_start = header_end+1
+                seq_end = next_rec
+                while seq_end > seq_start and buf[seq_end-1] in '\r\n':
+                    seq_end -= 1
+                if seq_end <= seq_start:
+                    seq = ''
+                elif buf.find('\n', seq_start, seq_end) >= 0 \
+                  or buf.find(' ', seq_start, seq_end) >= 0:
+                    seq = buf[seq_start:seq_end].translate(None, _SEQ_WHITESPACE)
+                else:
+                    seq = mv[seq_start:seq_end]
+                yield (_header_id(header), header, seq)
+                pos = next_rec+1
+
+    elif fmt == 'fastq':
+        for lines in _fastq_lines(fh, block_size):
+            # offsets of lines in the joined block
+            buf = '\n'.join(lines)
+            mv = memoryview(buf)
+            pos = 0
+            for i in xrange(0, len(lines), 4):
+                header = lines[i]
+                if header[:1] != '@':
+                    raise ValueError(
+                        "Fastq header line not starting with @: %s" % header)
+                seq_start = pos + len(header) + 1
+                seq_end = seq_start + len(lines[i+1])
+                qual_start = seq_end + 1 + len(lines[i+2]) + 1
+                qual_end = qual_start + len(lines[i+3])
+                header = header[1:].rstrip()
+                yield (_header_id(header), header,
+                       mv[seq_start:seq_end], mv[qual_start:qual_end])
+                pos = qual_end + 1
+    else:
+        raise ValueError("Unsupported format %s" % fmt)
+
+
+
+def _read_fastx_ids(fh, fmt, ids, exclude_ids, block_size):
+    """Like read_fastx(), but only yields records whose id is in ids
+    (or not, if exclude_ids). Only headers are parsed for all
+    records, sequences (and qualities) only for yielded ones
+    """
+
+    if fmt == 'fasta':
+        for buf in _fasta_blocks(fh, block_size):
+            buf_len = len(buf)
+            pos = 0
+            while pos < buf_len:
+                # buf[pos] is '>'
+                header_end = buf.find('\n', pos)
+                if header_end < 0:
+                    header_end = buf_len
+                next_rec = buf.find('\n>', header_end)
+                if next_rec < 0:
+                    next_rec = buf_len
+                header = buf[pos+1:header_end].rstrip()
+                seqid = _header_id(header)
+                if (seqid in ids) != exclude_ids:
+                    seq = buf[header_end+1:next_rec].translate(
+                        None, _SEQ_WHITESPACE)
+                    yield (seqid, header, seq)
+                pos = next_rec+1
+
+    elif fmt == 'fastq':
+        for lines in _fastq_lines(fh, block_size):
+            for i in xrange(0, len(lines), 4):
+                header = lines[i]
+                if header[:1] != '@':
+                    raise ValueError(
+                        "Fastq header line not starting with @: %s" % header)
+                header = header[1:].rstrip()
+                seqid = _header_id(header)
+                if (seqid in ids) != exclude_ids:
+                    yield (seqid, header, lines[i+1], lines[i+3])
+    else:
+        raise ValueError("Unsupported format %s" % fmt)
+
+
+
+def _fastx_records_raw(fh, fmt, block_size, ids=None, exclude_ids=False):
+    """Like read_fastx(), but records have the raw record text
+    (including newlines; a missing final newline is added) as
+    additional last element. Fastq records are joined from their
+    lines, i.e. without carriage returns
+    """
+
+    if fmt == 'fasta':
+        for buf in _fasta_blocks(fh, block_size):
+            buf_len = len(buf)
+            pos = 0
+            while pos < buf_len:
+                # buf[pos] is '>'
+                header_end = buf.find('\n', pos)
+                if header_end < 0:
+                    header_end = buf_len
+                next_rec = buf.find('\n>', header_end)
+                if next_rec < 0:
+                    next_rec = buf_len
+                else:
+                    next_rec += 1
+                header = buf[pos+1:header_end].rstrip()
+                seqid = _header_id(header)
+                if ids is None or (seqid in ids) != exclude_ids:
+                    seq = buf[header_end+1:next_rec].translate(
+                        None, _SEQ_WHITESPACE)
+                    text = buf[pos:next_rec]
+                    if not text.endswith('\n'):
+                        text += '\n'
+                    yield (seqid, header, seq, text)
+                pos = next_rec
+
+    elif fmt == 'fastq':
+        for lines in _fastq_lines(fh, block_size):
+            for i in xrange(0, len(lines), 4):
+                header = lines[i]
+                if header[:1] != '@':
+                    raise ValueError(
+                        "Fastq header line not starting with @: %s" % header)
+                header = header[1:].rstrip()
+                seqid = _header_id(header)
+                if ids is None or (seqid in ids) != exclude_ids:
+                    text = '\n'.join(lines[i:i+4]) + '\n'
+                    yield (seqid, header, lines[i+1], lines[i+3], text)
+    else:
+        raise ValueError("Unsupported format %s" % fmt)
+
+
+
+def read_fastx(fh, fmt='fasta', block_size=FASTX_BLOCK_SIZE,
+               as_memoryview=False, ids=None, exclude_ids=False, raw=False):
+    """Fast fasta or fastq parser (bypassing SeqIO), working on blocks
+    of block_size bytes read from fh.
+
+    Yields tuples of id, description (complete header without '>' or
+    '@', as in SeqIO) and sequence (string) for fasta, plus quality
+    string for fastq. Multi-line fasta is supported, fastq records
+    must have four lines.
+
+    If as_memoryview is True, sequences (and qualities) are returned
+    as memoryviews into the block buffer where possible, which
+    avoids copies, but are only valid until the next block is read.
+    Convert to string if you need to keep them.
+
+    If a set of ids is given, only records with these ids (or, if
+    exclude_ids is True, all others) are returned. Sequences of
+    other records are skipped without being constructed.
+
+    If raw is True, the original text of each record is added as last
+    tuple element (e.g. for writing it out unchanged).
+    """
+
+    if raw:
+        for rec in _fastx_records_raw(fh, fmt, block_size, ids, exclude_ids):
+            yield rec
+        return
+
+    if ids is not None:
+        for rec in _read_fastx_ids(fh, fmt, ids, exclude_ids, block_size):
+            yield rec
+        return
+
+    if as_memoryview:
+        for rec in _fastx_records_mv(fh, fmt, block_size):
+            yield rec
+        return
+
+    if fmt == 'fasta':
+        for buf in _fasta_blocks(fh, block_size):
+            # skip leading '>'
+            for rec in buf[1:].split('\n>'):
+                nl = rec.find('\n')
+                if nl < 0:
+                    header = rec.rstrip()
+                    seq = ''
+                else:
+                    header = rec[:nl].rstrip()
+                    seq = rec[nl+1:].translate(None, _SEQ_WHITESPACE)
+                yield (_header_id(header), header, seq)
+
+    elif fmt == 'fastq':
+        for lines in _fastq_lines(fh, block_size):
+            for (header, seq, qual) in izip(
+                    lines[0::4], lines[1::4], lines[3::4]):
+                if header[:1] != '@':
+                    raise ValueError(
+                        "Fastq header line not starting with @: %s" % header)
+                header = header[1:].rstrip()
+                yield (_header_id(header), header, seq, qual)
+    else:
+        raise ValueError("Unsupported format %s" % fmt)
+
+
+
+def _read_bgzf_header(fh):
+    """Reads header of the BGZF block at the current position of fh.
+    Returns the header (incl. extra field) and the total block size,
+    or an empty header at eof. Raises ValueError if this is not a
+    BGZF block
+    """
+
+    pos = fh.tell()
+    header = fh.read(12)
+    if not header:
+        return ('', 0)
+    if len(header) < 12 or header[:4] != '\x1f\x8b\x08\x04':
+        raise ValueError("Not a BGZF block at offset %d" % pos)
+    xlen = struct.unpack('<H', header[10:12])[0]
+    extra = fh.read(xlen)
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack('<H', extra[i+2:i+4])[0]
+        if extra[i:i+2] == 'BC' and slen == 2:
+            bsize = struct.unpack('<H', extra[i+4:i+6])[0]
+            return (header + extra, bsize + 1)
+        i += 4 + slen
+    raise ValueError("No BGZF block size at offset %d" % pos)
+
+
+
+def _read_bgzf_block(fh):
+    """Reads the (compressed) BGZF block at the current position of
+    fh. Returns an empty string at eof
+    """
+    (header, size) = _read_bgzf_header(fh)
+    if not header:
+        return ''
+    return header + fh.read(size - len(header))
+
+
+
+def bgzf_block_offsets(fh):
+    """Returns list of (compressed) start offsets of all blocks in a
+    BGZF (bgzip) file handle, by reading only the block headers.
+    Raises ValueError if this is not a BGZF file
+    """
+
+    offsets = []
+    pos = 0
+    while True:
+        fh.seek(pos)
+        (header, size) = _read_bgzf_header(fh)
+        if not header:
+            break
+        offsets.append(pos)
+        pos += size
+    return offsets
+
+
+
+def _decompress_members(data):
+    """Decompress concatenated gzip members (e.g. BGZF blocks)
+    """
+    out = []
+    while data:
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out.append(decomp.decompress(data))
+        data = decomp.unused_data
+    return ''.join(out)
+
+
+
+def _next_record_start(text, pos, fmt):
+    """Returns position of first fasta/fastq record starting at or
+    after pos (>0) in text or -1 if text doesn't tell (yet).
+
+    Fasta records start with '>' at the beginning of a line. A fastq
+    record starts with an '@' line followed by a line and a line
+    starting with '+'. Since sequence lines never start with '+', a
+    quality line starting with '@' can't be mistaken for a header.
+    """
+
+    if fmt == 'fasta':
+        idx = text.find('\n>', pos-1)
+        return idx+1 if idx >= 0 else -1
+
+    if text[pos-1] == '\n':
+        start = pos
+    else:
+        start = text.find('\n', pos) + 1
+        if start == 0:
+            return -1
+    while start < len(text):
+        nl1 = text.find('\n', start)
+        if nl1 < 0:
+            return -1
+        nl2 = text.find('\n', nl1+1)
+        if nl2 < 0 or nl2+1 >= len(text):
+            return -1
+        if text[start] == '@' and text[nl2+1] == '+':
+            return start
+        start = nl1 + 1
+    return -1
+
+
+
+def _owned_text(text, offset, fmt, read_more):
+    """Returns the records 'owned' by a chunk of a fasta/fastq file as
+    text. text[offset:] is the chunk's data, text[:offset] is the
+    character preceding it (empty for the first chunk). A chunk owns
+    all records starting in its data. The last of these is completed
+    with text returned by read_more() (empty at eof)
+    """
+
+    if offset == 0:
+        own_start = 0
+    else:
+        own_start = -1
+    data_end = len(text)
+    eof = False
+    while True:
+        if own_start < 0:
+            own_start = _next_record_start(text, offset, fmt)
+        if own_start >= data_end:
+            # no record starting here
+            return ''
+        if own_start >= 0:
+            own_end = _next_record_start(text, max(data_end, 1), fmt)
+            if own_end >= 0:
+                break
+        if eof:
+            own_end = len(text)
+            if own_start < 0:
+                return ''
+            break
+        more = read_more()
+        if not more:
+            eof = True
+        text += more
+    return text[own_start:own_end]
+
+
+
+def _chunk_text(fname, fmt, chunk):
+    """Returns the records owned by chunk (see fastx_chunks()) as text
+    """
+
+    (kind, prev_offset, start, end) = chunk
+    with open(fname, 'rb') as fh:
+        before = ''
+        if kind == 'bgzf':
+            # the previous block is only needed to know whether the
+            # chunk starts at the beginning of a line
+            if prev_offset is not None:
+                fh.seek(prev_offset)
+                before = _decompress_members(fh.read(start-prev_offset))[-1:]
+            fh.seek(start)
+            data = _decompress_members(fh.read(end-start))
+            read_more = lambda: _decompress_members(_read_bgzf_block(fh))
+        else:
+            if start > 0:
+                fh.seek(start-1)
+                before = fh.read(1)
+            data = fh.read(end-start)
+            read_more = lambda: fh.read(PLAIN_READ_MORE_SIZE)
+        return _owned_text(before + data, len(before), fmt, read_more)
+
+
+
+def read_fastx_chunk(fname, fmt, chunk, raw=False):
+    """Returns read_fastx() iterator over records owned by chunk (see
+    fastx_chunks())
+    """
+    return read_fastx(StringIO(_chunk_text(fname, fmt, chunk)), fmt,
+                      raw=raw)
+
+
+
+def _chunk_worker(args):
+    """Parses records of one chunk and applies func to them. Used by
+    fastx_parallel_map()
+    """
+    (fname, fmt, chunk, func, func_args) = args
+    return func(read_fastx_chunk(fname, fmt, chunk), *func_args)
+
+
+
+def is_chunkable(fname):
+    """Returns True if fname can be split with fastx_chunks(), i.e. is
+    a bgzip compressed or an uncompressed file
+    """
+    if fname == '-' or not os.path.isfile(fname):
+        return False
+    with open(fname, 'rb') as fh:
+        return guess_compression(fh.read(16)) in [None, 'bgzip']
+
+
+
+def fastx_chunks(fname, chunk_size=FASTX_CHUNK_SIZE):
+    """Splits a bgzip compressed or uncompressed fasta/fastq file into
+    chunks which can be parsed independently (read_fastx_chunk()).
+
+    bgzip files are split at BGZF block boundaries into chunks of
+    roughly chunk_size compressed bytes, uncompressed files into
+    chunks of chunk_size bytes. Chunks are tuples of kind ('bgzf' or
+    'plain'), offset of the last block of the previous chunk (bgzf
+    only; None for the first chunk), start and end offset
+    """
+
+    if not is_chunkable(fname):
+        raise ValueError("Can only split bgzip compressed or"
+                         " uncompressed files, not %s" % fname)
+    fsize = os.path.getsize(fname)
+    if not is_bgzf(fname):
+        return [('plain', None, start, min(start+chunk_size, fsize))
+                for start in xrange(0, fsize, chunk_size)]
+
+    with open(fname, 'rb') as fh:
+        offsets = bgzf_block_offsets(fh)
+    chunks = []
+    start = 0
+    prev_offset = None
+    for (i, offset) in enumerate(offsets):
+        block_end = offsets[i+1] if i+1 < len(offsets) else fsize
+        if block_end - start < chunk_size and block_end < fsize:
+            continue
+        # the chunk worker needs the last char of the previous
+        # block, so never start a chunk after an empty block
+        if block_end - offset <= BGZF_EMPTY_BLOCK_SIZE and block_end < fsize:
+            continue
+        chunks.append(('bgzf', prev_offset, start, block_end))
+        prev_offset = offset
+        start = block_end
+    return chunks
+
+
+
+def fastx_parallel_map(fname, fmt, func, func_args=(), num_workers=None,
+                       chunk_size=FASTX_CHUNK_SIZE, ordered=True):
+    """Parse a bgzip compressed or uncompressed fasta or fastq file in
+    parallel.
+
+    The file is split into chunks (see fastx_chunks()), which are
+    decompressed and parsed by num_workers processes (default: number
+    of cpus). Each worker resynchronizes to the first record starting
+    in its chunk and completes the last one from the following
+    data. func is called as func(records, *func_args), where records
+    is a read_fastx() iterator over the records of one chunk, and has
+    to be picklable, as do its arguments and return value.
+
+    Yields func's return values in input order, or in order of
+    completion if ordered is False
+    """
+
+    chunks = fastx_chunks(fname, chunk_size)
+    work = [(fname, fmt, chunk, func, func_args) for chunk in chunks]
+    pool = multiprocessing.Pool(num_workers)
+    try:
+        if ordered:
+            results = pool.imap(_chunk_worker, work)
+        else:
+            results = pool.imap_unordered(_chunk_worker, work)
+        for result in results:
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+
+def is_bgzf(fname):
+    """Returns True if fname is a BGZF (bgzip compressed) file
+    """
+    if fname == '-' or not os.path.isfile(fname):
+        return False
+    with open(fname, 'rb') as fh:
+        return guess_compression(fh.read(16)) == 'bgzip'
+
+
+
+class Alignment(object):
+    """Compact alignment representation: sequence ids are kept in a
+    list, residues in one contiguous uint8 matrix (mx) of shape
+    (nseqs, aln_len), i.e. one byte per residue. Rows and columns are
+    accessible as zero-copy numpy views.
+
+    mx can also be a numpy.memmap (see read_fasta()).
+    """
+
+    def __init__(self, ids, mx, descriptions=None):
+        """
+        """
+        assert len(ids) == mx.shape[0]
+        self.ids = ids
+        self.mx = mx
+        if descriptions is None:
+            descriptions = ids
+        self.descriptions = descriptions
+
+
+    def __len__(self):
+        """Number of sequences
+        """
+        return self.mx.shape[0]
+
+
+    def get_alignment_length(self):
+        """Same as Biopython's MultipleSeqAlignment method
+        """
+        return self.mx.shape[1]
+
+
+    def row(self, i):
+        """Zero-copy view of sequence i
+        """
+        return self.mx[i]
+
+
+    def col(self, j):
+        """Zero-copy (strided) view of column j
+        """
+        return self.mx[:, j]
+
+
+    def seq(self, i):
+        """Sequence i as string
+        """
+        return self.mx[i].tostring()
+
+
+    def gap_mask(self):
+        """Boolean matrix, True for gaps (see gap_mask())
+        """
+        return gap_mask(self.mx)
+
+
+    def upper(self, row_block=1024):
+        """Uppercase all residues in place (row_block rows at a time,
+        to keep memory bounded) and return self
+        """
+        for i in xrange(0, len(self), row_block):
+            self.mx[i:i+row_block] = to_upper(self.mx[i:i+row_block])
+        return self
+
+
+    @classmethod
+    def from_seqrecs(cls, seqrecs):
+        """Create from aligned SeqRecords, e.g. a Biopython alignment
+        """
+        seqrecs = list(seqrecs)
+        return cls([s.id for s in seqrecs], as_byte_array(seqrecs).copy(),
+                   [s.description for s in seqrecs])
+
+
+    @classmethod
+    def read_fasta(cls, fh, fname=None, upper=False):
+        """Read aligned fasta from file handle fh without creating
+        SeqRecords. Sequences are appended one by one (uppercased if
+        upper is True) to a byte buffer or, if fname is given, to a
+        file of that name, which is then memory-mapped (read-only), so
+        that memory usage is independent of the alignment size.
+        """
+
+        ids = []
+        descriptions = []
+        aln_len = None
+        if fname:
+            fh_out = open(fname, 'wb')
+            write = fh_out.write
+        else:
+            buf = bytearray()
+            write = buf.extend
+        for (seqid, desc, seqstr) in read_fastx(fh, 'fasta'):
+            if aln_len is None:
+                aln_len = len(seqstr)
+            elif len(seqstr) != aln_len:
+                raise ValueError(
+                    "Sequences must all be the same length (%s has %d, expected %d)" % (
+                        seqid, len(seqstr), aln_len))
+            if upper:
+                seqstr = seqstr.upper()
+            write(seqstr)
+            ids.append(seqid)
+            descriptions.append(desc)
+        if fname:
+            fh_out.close()
+        if not ids:
+            raise ValueError("No records found in handle")
+
+        if fname:
+            mx = numpy.memmap(fname, dtype=numpy.uint8, mode='r',
+                              shape=(len(ids), aln_len))
+        else:
+            mx = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(
+                len(ids), aln_len)
+        return cls(ids, mx, descriptions)
+
+
+    @classmethod
+    def read(cls, fh, fmt='fasta'):
+        """Read alignment in given format from fh. Fasta is read
+        directly (see read_fasta()), other formats via AlignIO
+        """
+        if fmt == 'fasta':
+            return cls.read_fasta(fh)
+        return cls.from_seqrecs(AlignIO.read(fh, fmt))
+
+
+    def row_blocks(self, rows=None, cols=None, row_block=1024):
+        """Yields tuples of row indices and byte matrix for blocks of
+        row_block of the given rows (all if None), reduced to cols
+        (index array or slice; all if None) by numpy indexing
+        """
+        nrows = len(self)
+        if rows is not None:
+            rows = numpy.arange(nrows)[rows]
+            nrows = len(rows)
+        for start in xrange(0, nrows, row_block):
+            if rows is None:
+                # a view, no copy
+                block_rows = xrange(start, min(start+row_block, nrows))
+                sub = self.mx[start:start+row_block]
+            else:
+                block_rows = rows[start:start+row_block]
+                sub = self.mx[block_rows]
+            if cols is not None:
+                sub = sub[:, cols]
+            yield (block_rows, sub)
+
+
+    def write(self, fh, fmt='fasta', rows=None, cols=None, with_descr=True):
+        """Write alignment to fh in one of ALN_WRITE_FORMATS (see the
+        write_<fmt>() methods), optionally only given rows and/or cols
+        (index arrays or slices). Descriptions are only written for
+        fasta if with_descr is True, all other formats use ids
+        """
+        if fmt == 'fasta':
+            self.write_fasta(fh, rows=rows, cols=cols, with_descr=with_descr)
+        elif fmt == 'phylip':
+            self.write_phylip(fh, rows=rows, cols=cols)
+        elif fmt == 'stockholm':
+            self.write_stockholm(fh, rows=rows, cols=cols)
+        elif fmt == 'clustal':
+            self.write_clustal(fh, rows=rows, cols=cols)
+        else:
+            raise ValueError("Unsupported alignment output format %s" % fmt)
+
+
+    def write_fasta(self, fh, line_width=None, rows=None, cols=None,
+                    with_descr=True, row_block=1024):
+        """Write alignment in fasta format to fh, optionally only
+        given rows and/or cols (index arrays or slices). If line_width
+        is None, each sequence is written on one line. Headers contain
+        the full description, unless with_descr is False (ids only).
+
+        Columns are selected for row_block rows at a time by numpy
+        indexing and each block is written at once.
+        """
+
+        if with_descr:
+            headers = self.descriptions
+        else:
+            headers = self.ids
+        for (block_rows, sub) in self.row_blocks(rows, cols, row_block):
+            out = []
+            for (i, row) in izip(block_rows, sub):
+                seqstr = row.tostring()
+                out.append(">%s\n" % headers[i])
+                if line_width:
+                    for pos in xrange(0, len(seqstr), line_width):
+                        out.append("%s\n" % seqstr[pos:pos+line_width])
+                else:
+                    out.append("%s\n" % seqstr)
+            fh.write(''.join(out))
+
+
+    def _out_shape(self, rows=None, cols=None):
+        """Number of rows and columns after selecting rows and cols
+        """
+        nrows = len(self)
+        if rows is not None:
+            nrows = len(numpy.arange(nrows)[rows])
+        ncols = self.get_alignment_length()
+        if cols is not None:
+            ncols = len(numpy.arange(ncols)[cols])
+        return (nrows, ncols)
+
+
+    def _write_rows(self, fh, rows, cols, row_block=1024, table=None):
+        """Writes one line of padded id and sequence per row.
+        Sequences are translated with table if given
+        """
+        if rows is None:
+            width = max([len(x) for x in self.ids])
+        else:
+            width = max([0] + [len(self.ids[i])
+                               for i in numpy.arange(len(self))[rows]])
+        for (block_rows, sub) in self.row_blocks(rows, cols, row_block):
+            fh.write(''.join(["%s %s\n" % (self.ids[i].ljust(width),
+                                            row.tostring().translate(table))
+                              for (i, row) in izip(block_rows, sub)]))
+
+
+    def write_phylip(self, fh, rows=None, cols=None):
+        """Write alignment in relaxed (sequential) PHYLIP format, i.e.
+        one line per sequence with full id. All gaps are written as '-'
+        """
+        fh.write("%d %d\n" % self._out_shape(rows, cols))
+        self._write_rows(fh, rows, cols, table=_PHYLIP_GAP_TABLE)
+
+
+    def write_stockholm(self, fh, rows=None, cols=None):
+        """Write alignment in Stockholm format (single block)
+        """
+        fh.write("# STOCKHOLM 1.0\n\n")
+        self._write_rows(fh, rows, cols)
+        fh.write("//\n")
+
+
+    def write_clustal(self, fh, rows=None, cols=None, line_width=60):
+        """Write alignment in Clustal format, i.e. interleaved in blocks
+        of line_width columns (without conservation line)
+        """
+        col_idx = numpy.arange(self.get_alignment_length())
+        if cols is not None:
+            col_idx = col_idx[cols]
+        fh.write("CLUSTAL W multiple sequence alignment\n\n")
+        for start in xrange(0, len(col_idx), line_width):
+            fh.write("\n")
+            self._write_rows(fh, rows, col_idx[start:start+line_width])
+
+
+
+class FastaIndex(object):
+    """Random access to sequences in a plain fasta file via a samtools
+    faidx compatible index (.fai), i.e. without scanning the file.
+
+    The index is read from fname.fai if it exists and is not older
+    than fname, otherwise built (and written if write_index is True
+    and possible). Sequences are fetched from a read-only memory map
+    of fname. Sequence names are header ids (up to first whitespace)
+    """
+
+    def __init__(self, fname, write_index=True):
+        """
+        """
+        with open(fname, 'rb') as fh:
+            if guess_compression(fh.read(16)):
+                raise ValueError(
+                    "Can't index compressed file %s" % fname)
+        self.fname = fname
+        fai = fname + ".fai"
+        if os.path.exists(fai) and \
+          os.path.getmtime(fai) >= os.path.getmtime(fname):
+            (self.names, self.entries) = self.read_fai(fai)
+        else:
+            (self.names, self.entries) = self.build(fname)
+            if write_index:
+                try:
+                    self.write_fai(fai)
+                except IOError:
+                    pass
+        self._fh = open(fname, 'rb')
+        if os.path.getsize(fname):
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = ''
+
+
+    def __len__(self):
+        """Number of sequences
+        """
+        return len(self.names)
+
+
+    def __contains__(self, name):
+        return name in self.entries
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def close(self):
+        """Release memory map and file
+        """
+        if hasattr(self._mm, 'close'):
+            self._mm.close()
+        self._fh.close()
+
+
+    def length(self, name):
+        """Length of sequence name
+        """
+        return self.entries[name][0]
+
+
+    def header(self, name):
+        """Returns complete header line (without '>') of sequence name
+        """
+        offset = self.entries[name][1]
+        # header line ends right before offset
+        start = self._mm.rfind('\n', 0, offset-1) + 1
+        return self._mm[start+1:offset].rstrip()
+
+
+    def fetch(self, name, start=None, end=None):
+        """Returns sequence name or its region start to end (zero-based,
+        end exclusive, as in pysam). Raises KeyError for unknown names
+        """
+
+        (seqlen, offset, line_bases, line_width) = self.entries[name]
+        if start is None or start < 0:
+            start = 0
+        if end is None or end > seqlen:
+            end = seqlen
+        if start >= end:
+            return ''
+        if line_bases == 0:
+            return ''
+        (start_line, start_col) = divmod(start, line_bases)
+        (end_line, end_col) = divmod(end, line_bases)
+        byte_start = offset + start_line*line_width + start_col
+        byte_end = offset + end_line*line_width + end_col
+        seq = self._mm[byte_start:byte_end]
+        if end_line > start_line:
+            seq = seq.translate(None, '\r\n')
+        return seq
+
+
+    def fetch_region(self, region):
+        """Like fetch(), but for a samtools style region string
+        (name, name:start or name:start-end; one-based, inclusive)
+        """
+
+        if region in self.entries:
+            return self.fetch(region)
+        (name, _, coords) = region.rpartition(':')
+        if name not in self.entries:
+            raise KeyError(region)
+        coords = coords.replace(',', '')
+        if '-' in coords:
+            (start, end) = coords.split('-', 1)
+            return self.fetch(name, int(start)-1, int(end))
+        return self.fetch(name, int(coords)-1)
+
+
+    @staticmethod
+    def build(fname):
+        """Scans fasta file and returns list of names and dict of index
+        entries (length, offset, line bases, line width) per name.
+        Raises ValueError if line lengths within a sequence differ
+        (apart from its last line) or for duplicate names
+        """
+
+        names = []
+        entries = dict()
+        name = None
+        pos = 0
+        with open(fname, 'rb') as fh:
+            for line in fh:
+                line_width = len(line)
+                if line.startswith('>'):
+                    if name is not None:
+                        entries[name] = (seqlen, offset, line_bases, first_width)
+                    header = line[1:].rstrip()
+                    name = header.split(None, 1)[0] if header else ''
+                    if name in entries:
+                        raise ValueError(
+                            "Duplicate sequence name %s in %s" % (name, fname))
+                    names.append(name)
+                    seqlen = 0
+                    offset = pos + line_width
+                    line_bases = first_width = 0
+                    nlines = 0
+                    # seen a line which can only be the last one
+                    last_seen = False
+                elif name is not None:
+                    bases = len(line.rstrip('\r\n'))
+                    if (last_seen and bases) or \
+                      (nlines and bases > line_bases):
+                        raise ValueError(
+                            "Different line length in sequence %s in %s" % (
+                                name, fname))
+                    if not nlines:
+                        line_bases = bases
+                        first_width = line_width
+                    if not bases or bases < line_bases \
+                      or line_width != first_width:
+                        last_seen = True
+                    nlines += 1
+                    seqlen += bases
+                pos += line_width
+        if name is not None:
+            entries[name] = (seqlen, offset, line_bases, first_width)
+        return (names, entries)
+
+
+    def read_fai(self, fai):
+        """Reads a .fai index. Returns list of names and dict of
+        entries as build()
+        """
+        names = []
+        entries = dict()
+        with open(fai) as fh:
+            for line in fh:
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) < 5:
+                    raise ValueError("Invalid line in %s: %s" % (fai, line))
+                names.append(fields[0])
+                entries[fields[0]] = tuple([int(f) for f in fields[1:5]])
+        return (names, entries)
+
+
+    def write_fai(self, fai):
+        """Writes index in samtools faidx format
+        """
+        with open(fai, 'w') as fh:
+            for name in self.names:
+                fh.write("%s\t%d\t%d\t%d\t%d\n" % (
+                    (name,) + self.entries[name]))
+
+
+
+def fasta_index_exists(fname):
+    """Returns True if fname is a plain file with an up to date
+    faidx index (see FastaIndex)
+    """
+    fai = fname + ".fai"
+    if fname == '-' or not os.path.exists(fai) \
+      or os.path.getmtime(fai) < os.path.getmtime(fname):
+        return False
+    with open(fname, 'rb') as fh:
+        return guess_compression(fh.read(16)) is None
+
 
 
 def guess_seqformat(fseq):
@@ -59,6 +1576,8 @@ def guess_seqformat(fseq):
         embl = 'embl',
         fasta = 'fasta',
         fa = 'fasta',
+        fastq = 'fastq',
+        fq = 'fastq',
         genbank = 'genbank',
         gb = 'genbank',
         phylip = 'phylip',
@@ -70,7 +1589,10 @@ def guess_seqformat(fseq):
         stk = 'stockholm')
 
     try:
-        fext = os.path.splitext(fseq)[1]
+        (fbase, fext) = os.path.splitext(fseq)
+        # format is given by inner extension of compressed files
+        if fext.lower() in COMPRESSION_EXTS:
+            fext = os.path.splitext(fbase)[1]
         fext = fext[1:].lower()
         fmt =  ext_to_fmt_table[fext]
     except KeyError:
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Benchmark bioutils.read_fastx() against Bio.SeqIO.parse() on the
+same fasta/fastq file(s)
+"""
+
+
+#--- standard library imports
+#
+import sys
+import logging
+import time
+# optparse deprecated from Python 2.7 on
+from optparse import OptionParser
+
+#--- third-party imports
+#
+from Bio import SeqIO
+
+#--- project specific imports
+#
+import bioutils
+
+
+__author__ = "Andreas Wilm"
+__version__ = "0.1"
+__email__ = "andreas.wilm@gmail.com"
+__license__ = "The MIT License (MIT)"
+
+
+#global logger
+# http://docs.python.org/library/logging.html
+LOG = logging.getLogger("")
+logging.basicConfig(level=logging.WARN,
+                    format='%(levelname)s [%(asctime)s]: %(message)s')
+
+
+
+def run_seqio(fname, fmt):
+    """Parse with SeqIO. Returns number of records and residues
+    """
+    nrecs = nres = 0
+    with open(fname) as fh:
+        for rec in SeqIO.parse(fh, fmt):
+            nrecs += 1
+            nres += len(rec.seq)
+    return (nrecs, nres)
+
+
+
+def run_fastx(fname, fmt, block_size, as_memoryview=False):
+    """Parse with bioutils.read_fastx. Returns number of records and
+    residues
+    """
+    nrecs = nres = 0
+    with open(fname) as fh:
+        for rec in bioutils.read_fastx(fh, fmt, block_size=block_size,
+                                       as_memoryview=as_memoryview):
+            nrecs += 1
+            nres += len(rec[2])
+    return (nrecs, nres)
+
+
+
+def cmdline_parser():
+    """
+    creates an OptionParser instance
+    """
+
+    # http://docs.python.org/library/optparse.html
+    usage = "%prog: " + __doc__ + "\n" \
+            "usage: %prog [options] file[s]"
+    parser = OptionParser(usage=usage)
+
+    parser.add_option("", "--verbose",
+                      action="store_true",
+                      dest="verbose",
+                      help="be verbose")
+    parser.add_option("", "--debug",
+                      action="store_true",
+                      dest="debug",
+                      help="debugging")
+    parser.add_option("-f", "--infmt",
+                      dest="informat",
+                      help="Input format: fasta or fastq"
+                      " (default: guess from extension)")
+    parser.add_option("-b", "--block-size",
+                      dest="block_size",
+                      type="int",
+                      default=bioutils.FASTX_BLOCK_SIZE,
+                      help="Block size for read_fastx"
+                      " (default: %d)" % bioutils.FASTX_BLOCK_SIZE)
+    parser.add_option("-r", "--repeats",
+                      dest="repeats",
+                      type="int",
+                      default=1,
+                      help="Number of repeats per method (best time"
+                      " is reported)")
+    parser.add_option("", "--no-seqio",
+                      action="store_true",
+                      dest="no_seqio",
+                      help="Skip (slow) SeqIO run")
+    return parser
+
+
+
+def main():
+    """
+    The main function
+    """
+
+    parser = cmdline_parser()
+    (opts, args) = parser.parse_args()
+
+    if opts.verbose:
+        LOG.setLevel(logging.INFO)
+    if opts.debug:
+        LOG.setLevel(logging.DEBUG)
+
+    if len(args) < 1:
+        parser.error("Need at least one sequence file as argument")
+        sys.exit(1)
+    if opts.repeats < 1:
+        parser.error("Number of repeats must be at least 1")
+        sys.exit(1)
+
+    methods = []
+    if not opts.no_seqio:
+        methods.append(
+            ('SeqIO.parse', lambda f, fmt: run_seqio(f, fmt)))
+    methods.append(
+        ('read_fastx', lambda f, fmt: run_fastx(
+            f, fmt, opts.block_size)))
+    methods.append(
+        ('read_fastx (memoryview)', lambda f, fmt: run_fastx(
+            f, fmt, opts.block_size, as_memoryview=True)))
+
+    print "#file\tmethod\trecords\tresidues\tseconds\tspeedup"
+    for fname in args:
+        fmt = opts.informat
+        if not fmt:
+            fmt = bioutils.guess_seqformat(fname)
+        if fmt not in ['fasta', 'fastq']:
+            LOG.fatal("Unsupported format %s for %s" % (fmt, fname))
+            sys.exit(1)
+        LOG.info("Benchmarking %s (format %s)" % (fname, fmt))
+
+        results = []
+        for (name, func) in methods:
+            best = None
+            for _ in xrange(opts.repeats):
+                start = time.time()
+                counts = func(fname, fmt)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            results.append((name, counts, best))
+
+        # all parsers have to agree
+        if len(set([r[1] for r in results])) != 1:
+            LOG.error("Parsers disagree on %s: %s" % (
+                fname, ', '.join(["%s=%s" % (r[0], r[1]) for r in results])))
+        ref_time = results[0][2]
+        for (name, (nrecs, nres), elapsed) in results:
+            print "%s\t%s\t%d\t%d\t%.3f\t%.1fx" % (
+                fname, name, nrecs, nres, elapsed,
+                ref_time/elapsed if elapsed > 0 else float('inf'))
+
+
+
+if __name__ == "__main__":
+    main()
@@ -21,6 +21,7 @@ import difflib
 #
 import Bio
 from Bio import SeqIO
+import numpy
 
 
 #--- project specific imports
@@ -48,25 +49,17 @@ class PosMap(object):
     NOTE: all unit-offset!
     """
     
-    def __init__(self, seqrecs=None):
+    def __init__(self, aln=None):
         """
         """
 
         self.seq_ids = []
         self.pos_map = dict()
 
-        if seqrecs:
-            self.generate(seqrecs)
+        if aln:
+            self.generate(aln)
         
-    @staticmethod
-    def isgap(res):
-        """Return true if given residue is a gap character
-        """
-        return (res in ['-', '~', '.'])
-    
-
-    
-    def generate(self, seqrecs):
+    def generate(self, aln):
         """Computes a position map, which is a dict with aligned
         positions as main key. Sequence ids are 2nd dim key and their
         corresponding unaligned position is the value
@@ -77,26 +70,28 @@ class PosMap(object):
         NOTE: the format is terribly inefficient. should be spit out
         as blocks/ranges asfor liftover chains (troublesome for >2
         though)")
+
+        aln can be a bioutils.Alignment or a list of aligned
+        SeqRecords
         """
        
+        if not isinstance(aln, bioutils.Alignment):
+            for s in aln:
+                assert len(s.seq) == len(aln[0].seq), (
+                    "Looks like your seqs are not aligned")
+            aln = bioutils.Alignment.from_seqrecs(aln)
+
         self.pos_map = dict()
-        self.seq_ids = [s.id for s in seqrecs]
-        
-        aln_len = len(seqrecs[0].seq)
-        for s in seqrecs:
-            assert len(s.seq) == aln_len, (
-                "Looks like your seqs are not aligned")
+        self.seq_ids = list(aln.ids)
+        aln_len = aln.get_alignment_length()
 
-        # all offset one
-        cur_unaligned_pos = len(seqrecs) * [0]
+        # all offset one: number of residues up to and including
+        # each aligned position (per seq)
+        unaligned_pos = numpy.arange(1, aln_len+1) \
+          - bioutils.gap_prefix_count(aln.mx)
         for aln_pos in xrange(aln_len):
-            for s in xrange(len(seqrecs)):
-                res = seqrecs[s][aln_pos]
-                if not self.isgap(res):
-                    cur_unaligned_pos[s] += 1
-            self.pos_map[aln_pos+1] = dict()
-            for (p, s) in zip(cur_unaligned_pos, [s.id for s in seqrecs]):
-                self.pos_map[aln_pos+1][s] = p
+            self.pos_map[aln_pos+1] = dict(
+                zip(self.seq_ids, unaligned_pos[:, aln_pos].tolist()))
 
                 
     
@@ -229,7 +224,8 @@ def main():
     refseq = refseq[0]
 
 
-    pw_aln = list(SeqIO.parse(opts.pw_aln, bioutils.guess_seqformat(opts.pw_aln)))
+    pw_aln = bioutils.Alignment.read(
+        open(opts.pw_aln), bioutils.guess_seqformat(opts.pw_aln))
     assert len(pw_aln)==2, (
         "Was expecting two sequences, but parsed %d from %s" % (
             len(pw_aln), opts.pw_aln))
@@ -238,7 +234,7 @@ def main():
     # determine ref id
     #
     # seqids in alignment should match genbank id but might not
-    matches = difflib.get_close_matches(refseq.id, [s.id for s in pw_aln])
+    matches = difflib.get_close_matches(refseq.id, pw_aln.ids)
     assert len(matches), (
         "Couldn't find a sensible match between sequence ids in alignment and genbank")
     aln_ref_id = matches[0]
@@ -249,7 +245,7 @@ def main():
 
     # determine query id
     assert len(pw_aln) == 2
-    for sid in [s.id for s in pw_aln]:
+    for sid in pw_aln.ids:
         if sid != aln_ref_id:
             query_id = sid
     LOG.info("%s is the query id" % (query_id))
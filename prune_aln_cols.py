@@ -6,16 +6,19 @@
 #--- standard library imports
 #
 import sys
+import os
 import logging
+import string
+import tempfile
+import shutil
 # optparse deprecated from Python 2.7 on
 from optparse import OptionParser, SUPPRESS_HELP
-from collections import Counter
 
 
 #--- third-party imports
 #
 import Bio
-from Bio import AlignIO
+import numpy
 
 #--- project specific imports
 #
@@ -34,6 +37,33 @@ LOG = logging.getLogger("")
 logging.basicConfig(level=logging.WARN,
                     format='%(levelname)s [%(asctime)s]: %(message)s')
 
+# residue classes for column statistics: one per (uppercased)
+# character. letters and gap characters have fixed classes, any other
+# character gets its own class once seen (see ColumnCounts.add())
+_CLASS_CHARS = string.ascii_uppercase + ''.join(bioutils.GAP_CHARS)
+# marks characters without class yet in class lookup tables
+_NO_CLASS = 255
+_CLASS_LOOKUP = numpy.empty(256, dtype=numpy.uint8)
+_CLASS_LOOKUP[:] = _NO_CLASS
+for (_i, _c) in enumerate(_CLASS_CHARS):
+    _CLASS_LOOKUP[ord(_c)] = _CLASS_LOOKUP[ord(_c.lower())] = _i
+GAP_CLASSES = [_CLASS_CHARS.index(c) for c in bioutils.GAP_CHARS]
+
+# max. number of residues counted at once in ColumnCounts.add()
+COUNT_BLOCK_SIZE = 4 * 1024 * 1024
+
+# column filters: option name and help
+FILTERS = [
+    ('any-gap', "Prune columns with at least one gap"),
+    ('all-gap', "Prune columns if all residues are gaps"),
+    ('identical', "Prune columns if all residues are identical"),
+    ('max-gap-frac', "Prune columns with a higher fraction of gaps"),
+    ('min-conservation', "Prune columns in which the most frequent"
+     " residue makes up a smaller fraction of all sequences"),
+    ('max-entropy', "Prune columns with higher Shannon entropy (bits,"
+     " residues only; 0 for all-gap columns)"),
+    ]
+
 
 
 def cmdline_parser():
@@ -54,61 +84,391 @@ def cmdline_parser():
                       dest="debug",
                       action="store_true", 
                       help=SUPPRESS_HELP) #"debugging")
-    parser.add_option("", "--all-gap",
-                      action="store_true", 
-                      dest="all_gap",
-                      help="Prune columns if all residues are gaps")
-    parser.add_option("", "--any-gap",
-                      action="store_true", 
-                      dest="any_gap",
-                      help="Prune columns with at least one gap")
-    parser.add_option("", "--identical",
-                      action="store_true", 
-                      dest="identical",
-                      help="Prune columns if all residues are identical")
+    for (name, helpstr) in FILTERS:
+        if name.startswith('max-') or name.startswith('min-'):
+            parser.add_option("", "--%s" % name,
+                              dest=name.replace('-', '_'),
+                              type="float",
+                              help=helpstr)
+        else:
+            parser.add_option("", "--%s" % name,
+                              action="store_true",
+                              dest=name.replace('-', '_'),
+                              help=helpstr)
+    parser.add_option("", "--ref-seq",
+                      dest="ref_seq",
+                      help="Prune columns with a gap in this sequence")
+    parser.add_option("", "--ref-positions",
+                      dest="ref_positions",
+                      help="Only keep columns of these (unaligned, one-based)"
+                      " positions of the reference sequence, e.g."
+                      " 1-100,150,200-250 (needs --ref-seq)")
+    choices = ['and', 'or']
+    parser.add_option("", "--combine",
+                      dest="combine",
+                      default="and",
+                      choices=choices,
+                      help="Keep columns passing all (and) or any (or) of"
+                      " the given filters (%s; default: and)" % (choices))
     parser.add_option("-i", "--in",
                       dest="aln_in",
                       help="Input alignment ('-' for stdin)")
     parser.add_option("-f", "--infmt",
                       dest="informat",
                       help="Input format (must be supported by Biopython)")
+    parser.add_option("", "--stream",
+                      action="store_true",
+                      dest="stream",
+                      help="Don't load alignment (fasta only) into memory:"
+                      " collect column statistics in a first pass and"
+                      " write pruned sequences in a second pass over the"
+                      " file (stdin is spooled to a memory-mapped"
+                      " temporary file)")
+    parser.add_option("", "--tmp-dir",
+                      dest="tmp_dir",
+                      help="Directory for temporary files (see --stream)")
+    choices = bioutils.ALN_WRITE_FORMATS
+    parser.add_option("-o", "--outfmt",
+                      dest="outformat",
+                      default="fasta",
+                      choices=choices,
+                      help="Output format (%s; default: fasta)" % (
+                          ', '.join(choices)))
+    parser.add_option("", "--colmap",
+                      dest="colmap",
+                      help="Write map of kept columns to this file (tab"
+                      " separated runs of kept columns: start and end in"
+                      " original and in pruned alignment, one-based)")
     return parser
 
 
-def prune_aln(aln, what, fh_out=sys.stdout):
-    """Prune what columns from alignment and print result
+class ColumnCounts(object):
+    """Residue class counts (see _CLASS_CHARS) per alignment column,
+    from which all column statistics used by the filters are derived
     """
 
-    assert what in ['any_gap', 'all_gap', 'identical']
-    
-    keep_cols = []
-    for i in xrange(aln.get_alignment_length()):
-        # deprecated: col = aln.get_column(i)
-        col_nucs = [sr.seq[i].upper() for sr in aln]
-        counter = Counter(col_nucs)
-
-        if what == 'any_gap':
-            if any([bioutils.isgap(c) for c in counter.keys()]):
-                continue
-        if what == 'all_gap':
-            if all([bioutils.isgap(c) for c in counter.keys()]):
-                continue
-        if what == 'identical':
-            if len(set(counter.keys())) == 1:
-                continue
-
-        keep_cols.append(i)
-
-    # FIXME add support for proper alignment output, not just
-    # concatenated fasta
-    LOG.info("Keeping the following columns: %s" % (
-        ', '.join([str(x+1) for x in keep_cols])))
-    for s in aln:
-        fh_out.write(">%s\n" % s.id)
-        fh_out.write('%s\n' % ''.join([s.seq[i] for i in keep_cols]))
+    def __init__(self, aln_len):
+        """
+        """
+        self.aln_len = aln_len
+        self.nseqs = 0
+        self.class_chars = list(_CLASS_CHARS)
+        self._class_lookup = _CLASS_LOOKUP.copy()
+        self.counts = numpy.zeros((len(self.class_chars), aln_len),
+                                  dtype=numpy.int64)
+
+
+    def _add_classes(self, codes):
+        """Add a class (and counts row) for every character code in
+        codes not having one yet
+        """
+        new_codes = [c for c in numpy.unique(codes)
+                     if self._class_lookup[c] == _NO_CLASS]
+        for c in new_codes:
+            self._class_lookup[c] = len(self.class_chars)
+            self.class_chars.append(chr(c))
+        self.counts = numpy.vstack([
+            self.counts,
+            numpy.zeros((len(new_codes), self.aln_len), dtype=numpy.int64)])
+
+
+    def add(self, mx):
+        """Add sequences of byte matrix mx (nseqs x aln_len). Counted
+        with one bincount per block of rows (see COUNT_BLOCK_SIZE)
+        """
+        assert mx.shape[1] == self.aln_len
+        row_block = max(1, COUNT_BLOCK_SIZE // max(1, self.aln_len))
+        offsets = numpy.arange(self.aln_len)
+        for i in xrange(0, mx.shape[0], row_block):
+            classes = self._class_lookup[mx[i:i+row_block]]
+            if classes.max() == _NO_CLASS:
+                self._add_classes(mx[i:i+row_block][classes == _NO_CLASS])
+                classes = self._class_lookup[mx[i:i+row_block]]
+            num_classes = len(self.class_chars)
+            flat_idx = classes.astype(numpy.int64) * self.aln_len + offsets
+            self.counts += numpy.bincount(
+                flat_idx.ravel(), minlength=num_classes*self.aln_len).reshape(
+                    num_classes, self.aln_len)
+        self.nseqs += mx.shape[0]
+
+
+    def res_counts(self):
+        """Counts of residue (i.e. non-gap) classes per column
+        """
+        return numpy.delete(self.counts, GAP_CLASSES, axis=0)
+
+
+    def gaps(self):
+        """Number of gaps per column
+        """
+        return self.counts[GAP_CLASSES].sum(axis=0)
+
+
+    def gap_frac(self):
+        """Fraction of gaps per column
+        """
+        return self.gaps() / float(max(1, self.nseqs))
+
+
+    def num_classes(self):
+        """Number of different residues (and gap characters) per
+        column
+        """
+        return (self.counts > 0).sum(axis=0)
+
+
+    def conservation(self):
+        """Fraction of the most frequent residue (gaps not counted as
+        residue) per column
+        """
+        return self.res_counts().max(axis=0) / float(max(1, self.nseqs))
+
+
+    def entropy(self):
+        """Shannon entropy (bits) of the residue distribution per
+        column (ignoring gaps). 0.0 for all-gap columns
+        """
+        res_counts = self.res_counts().astype(numpy.float64)
+        denom = res_counts.sum(axis=0)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            probs = res_counts / denom
+            terms = numpy.where(probs > 0, -probs*numpy.log2(probs), 0.0)
+        # add 0.0 to avoid negative zero
+        return terms.sum(axis=0) + 0.0
+
+
+
+def parse_positions(positions):
+    """Parses comma separated list of one-based positions or ranges
+    (e.g. 1-100,150) and returns list of (start, end) tuples
+    (inclusive)
+    """
+    ranges = []
+    for part in positions.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            (start, end) = [int(x) for x in part.split('-', 1)]
+        else:
+            start = end = int(part)
+        if start < 1 or end < start:
+            raise ValueError("Invalid position range %s" % part)
+        ranges.append((start, end))
+    return ranges
+
+
+
+def ref_keep_mask(ref_row, ranges=None):
+    """Returns mask of columns in which reference sequence ref_row
+    (byte array) has a residue, restricted to the unaligned
+    (one-based) positions in ranges (see parse_positions()) if given
+    """
+    is_res = ~bioutils.gap_mask(ref_row)
+    if not ranges:
+        return is_res
+    # one-based unaligned position of residue columns
+    unaln_pos = numpy.cumsum(is_res)
+    selected = numpy.zeros(unaln_pos[-1] + 1 if len(unaln_pos) else 1,
+                           dtype=numpy.bool_)
+    for (start, end) in ranges:
+        selected[start:end+1] = True
+    return is_res & selected[unaln_pos]
+
+
+
+def keep_mask(col_counts, filters, combine='and', ref_row=None):
+    """Evaluates all filters, given as list of (name, threshold) tuples
+    (see FILTERS; 'ref' for reference positions with list of ranges
+    or None as threshold), on the same column counts (ColumnCounts).
+    Returns mask of columns passing all (combine='and') or any
+    (combine='or') filters
+    """
+
+    masks = []
+    for (name, value) in filters:
+        if name == 'any-gap':
+            masks.append(col_counts.gaps() == 0)
+        elif name == 'all-gap':
+            masks.append(col_counts.gaps() < col_counts.nseqs)
+        elif name == 'identical':
+            masks.append(col_counts.num_classes() > 1)
+        elif name == 'max-gap-frac':
+            masks.append(col_counts.gap_frac() <= value)
+        elif name == 'min-conservation':
+            masks.append(col_counts.conservation() >= value)
+        elif name == 'max-entropy':
+            masks.append(col_counts.entropy() <= value)
+        elif name == 'ref':
+            masks.append(ref_keep_mask(ref_row, value))
+        else:
+            raise ValueError("Unknown filter %s" % name)
+        LOG.info("Filter %s keeps %d columns" % (name, masks[-1].sum()))
+
+    if combine == 'and':
+        return numpy.logical_and.reduce(masks)
+    elif combine == 'or':
+        return numpy.logical_or.reduce(masks)
+    raise ValueError("Unknown combination %s" % combine)
+
+
+
+def prune_aln(aln, filters, combine='and', ref_row=None, fh_out=sys.stdout,
+              fmt='fasta'):
+    """Prune columns not passing filters (see keep_mask()) from
+    alignment (bioutils.Alignment) and print result in format fmt
+    (see bioutils.ALN_WRITE_FORMATS). Returns kept columns
+    """
+
+    col_counts = ColumnCounts(aln.get_alignment_length())
+    col_counts.add(aln.mx)
+    keep_cols = numpy.flatnonzero(
+        keep_mask(col_counts, filters, combine, ref_row))
+
+    write_pruned(aln, keep_cols, fh_out, fmt)
+    return keep_cols
+
+
+
+def write_pruned(aln, keep_cols, fh_out=sys.stdout, fmt='fasta'):
+    """Print alignment reduced to keep_cols in format fmt
+    """
+
+    LOG.info("Keeping %d of %d columns" % (
+        len(keep_cols), aln.get_alignment_length()))
+    aln.write(fh_out, fmt, cols=keep_cols, with_descr=False)
+
+
+
+def col_ranges(keep_cols):
+    """Returns runs of consecutive columns in (sorted) keep_cols as
+    list of (start, end) tuples (zero-based, inclusive)
+    """
+    if not len(keep_cols):
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(keep_cols) != 1)
+    starts = numpy.concatenate([[0], breaks+1])
+    ends = numpy.concatenate([breaks, [len(keep_cols)-1]])
+    return zip(keep_cols[starts].tolist(), keep_cols[ends].tolist())
+
+
+
+def write_colmap(keep_cols, fh):
+    """Writes map of kept columns as run-length ranges: one tab
+    separated line per run of consecutive kept columns with start and
+    end in the original and in the pruned alignment (one-based,
+    inclusive)
+    """
+    fh.write("#orig_start\torig_end\tpruned_start\tpruned_end\n")
+    pruned_start = 1
+    for (start, end) in col_ranges(keep_cols):
+        pruned_end = pruned_start + end - start
+        fh.write("%d\t%d\t%d\t%d\n" % (
+            start+1, end+1, pruned_start, pruned_end))
+        pruned_start = pruned_end + 1
+
+
+
+def fasta_row_blocks(fh, block_size=COUNT_BLOCK_SIZE):
+    """Reads aligned fasta from fh and yields blocks of about
+    block_size residues as bioutils.Alignment (ids only)
+    """
+
+    aln_len = None
+    ids = []
+    rows = []
+    for (seqid, _, seqstr) in bioutils.read_fastx(fh, 'fasta'):
+        if aln_len is None:
+            aln_len = len(seqstr)
+        elif len(seqstr) != aln_len:
+            raise ValueError(
+                "Sequences must all be the same length (%s has %d, expected %d)" % (
+                    seqid, len(seqstr), aln_len))
+        ids.append(seqid)
+        rows.append(seqstr)
+        if len(rows) * max(1, aln_len) >= block_size:
+            yield bioutils.Alignment(ids, numpy.frombuffer(
+                ''.join(rows), dtype=numpy.uint8).reshape(len(rows), aln_len))
+            ids = []
+            rows = []
+    if aln_len is None:
+        raise ValueError("No records found in handle")
+    if rows:
+        yield bioutils.Alignment(ids, numpy.frombuffer(
+            ''.join(rows), dtype=numpy.uint8).reshape(len(rows), aln_len))
+
+
+
+def stream_col_counts(fh, ref_id=None):
+    """First pass of stream_prune(): returns column counts
+    (ColumnCounts) of aligned fasta read from fh and the row of
+    sequence ref_id (None if not found). Memory usage only depends on
+    the alignment length
+    """
+
+    col_counts = None
+    ref_row = None
+    for block in fasta_row_blocks(fh):
+        if col_counts is None:
+            col_counts = ColumnCounts(block.get_alignment_length())
+        col_counts.add(block.mx)
+        if ref_id in block.ids and ref_row is None:
+            ref_row = block.row(block.ids.index(ref_id)).copy()
+    return (col_counts, ref_row)
+
+
+
+def stream_prune(fname, filters, combine='and', ref_id=None,
+                 fh_out=sys.stdout, fmt='fasta', tmp_dir=None):
+    """Prune columns not passing filters (see keep_mask()) from fasta
+    alignment fname in two passes, without loading it: the first one
+    collects column counts, the second one writes pruned sequences in
+    format fmt. Formats other than fasta need all sequences at once,
+    so the pruned sequences are spooled to a memory-mapped temporary
+    file in tmp_dir first. Returns kept columns
+    """
+
+    fh_in = bioutils.xopen(fname)
+    (col_counts, ref_row) = stream_col_counts(fh_in, ref_id)
+    fh_in.close()
+    if ref_id and ref_row is None:
+        raise ValueError("Reference sequence %s not found in alignment" % (
+            ref_id))
+    keep_cols = numpy.flatnonzero(
+        keep_mask(col_counts, filters, combine, ref_row))
+    LOG.info("Keeping %d of %d columns" % (
+        len(keep_cols), col_counts.aln_len))
+
+    fh_in = bioutils.xopen(fname)
+    if fmt == 'fasta':
+        for block in fasta_row_blocks(fh_in):
+            block.write_fasta(fh_out, cols=keep_cols, with_descr=False)
+        fh_in.close()
+        return keep_cols
+
+    tmp_dir = tempfile.mkdtemp(prefix="prune_aln_cols-", dir=tmp_dir)
+    try:
+        spool_fname = os.path.join(tmp_dir, "pruned.u8")
+        ids = []
+        with open(spool_fname, 'wb') as fh_spool:
+            for block in fasta_row_blocks(fh_in):
+                fh_spool.write(block.mx[:, keep_cols].tostring())
+                ids.extend(block.ids)
+        fh_in.close()
+        if len(keep_cols):
+            mx = numpy.memmap(spool_fname, dtype=numpy.uint8, mode='r',
+                              shape=(len(ids), len(keep_cols)))
+        else:
+            # can't map empty files
+            mx = numpy.zeros((len(ids), 0), dtype=numpy.uint8)
+    finally:
+        # mapping stays valid after removal
+        shutil.rmtree(tmp_dir)
+    bioutils.Alignment(ids, mx).write(fh_out, fmt)
+    return keep_cols
+
 
 
-        
 def main():
     """
     The main function
@@ -126,35 +486,74 @@ def main():
         parser.error("Missing input alignment argument")
         sys.exit(1)
 
-    what = None
-    if opts.any_gap:
-        assert not what, ("Can only do one operation at a time")
-        what = 'any_gap'
-    if opts.all_gap:
-        assert not what, ("Can only do one operation at a time")
-        what = 'all_gap'
-    if opts.identical:
-        assert not what, ("Can only do one operation at a time")
-        what = 'identical'
-    if not what:
-        parser.error("No operation selected")
+    filters = []
+    for (name, _) in FILTERS:
+        value = getattr(opts, name.replace('-', '_'))
+        if value is None or value is False:
+            continue
+        filters.append((name, value))
+    ref_ranges = None
+    if opts.ref_positions:
+        if not opts.ref_seq:
+            parser.error("Reference positions need a reference sequence")
+            sys.exit(1)
+        try:
+            ref_ranges = parse_positions(opts.ref_positions)
+        except ValueError as err:
+            parser.error("Invalid reference positions: %s" % err)
+            sys.exit(1)
+    if opts.ref_seq:
+        filters.append(('ref', ref_ranges))
+    if not filters:
+        parser.error("No filter selected")
         sys.exit(1)
-        
-    if opts.aln_in == "-":
-        fh_in = sys.stdin
-    else:
-        fh_in = open(opts.aln_in, "rU")
 
     fmt = opts.informat
     if not fmt:
         fmt = bioutils.guess_seqformat(opts.aln_in)
+    if opts.stream and fmt != 'fasta':
+        LOG.fatal("Only fasta input supported in streaming mode")
+        sys.exit(1)
 
-    aln = AlignIO.read(fh_in, fmt)
-    if fh_in != sys.stdin:
-        fh_in.close()
-
-
-    prune_aln(aln, what, sys.stdout)
+    if opts.stream and opts.aln_in != "-":
+        try:
+            keep_cols = stream_prune(opts.aln_in, filters, opts.combine,
+                                     opts.ref_seq, sys.stdout,
+                                     opts.outformat, opts.tmp_dir)
+        except ValueError as err:
+            LOG.fatal("%s" % err)
+            sys.exit(1)
+        if opts.colmap:
+            with open(opts.colmap, 'w') as fh:
+                write_colmap(keep_cols, fh)
+        return
+
+    # transparently decompresses
+    fh_in = bioutils.xopen(opts.aln_in)
+    if opts.stream:
+        # stdin can't be read twice: spool to memory-mapped file
+        tmp_dir = tempfile.mkdtemp(prefix="prune_aln_cols-", dir=opts.tmp_dir)
+        aln = bioutils.Alignment.read_fasta(
+            fh_in, os.path.join(tmp_dir, "aln.u8"))
+        # mapping stays valid after removal
+        shutil.rmtree(tmp_dir)
+    else:
+        aln = bioutils.Alignment.read(fh_in, fmt)
+    fh_in.close()
+
+    ref_row = None
+    if opts.ref_seq:
+        if opts.ref_seq not in aln.ids:
+            LOG.fatal("Reference sequence %s not found in alignment" % (
+                opts.ref_seq))
+            sys.exit(1)
+        ref_row = aln.row(aln.ids.index(opts.ref_seq))
+
+    keep_cols = prune_aln(aln, filters, opts.combine, ref_row, sys.stdout,
+                          opts.outformat)
+    if opts.colmap:
+        with open(opts.colmap, 'w') as fh:
+            write_colmap(keep_cols, fh)
 
     
 
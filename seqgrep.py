@@ -11,7 +11,12 @@ import logging
 # optparse deprecated from Python 2.7 on
 from optparse import OptionParser
 import re
-import gzip
+from array import array
+from collections import deque
+from cStringIO import StringIO
+import tempfile
+import shutil
+import multiprocessing
 
 #--- third-party imports
 #
@@ -29,6 +34,16 @@ __email__ = "andreas.wilm@gmail.com"
 __license__ = "The MIT License (MIT)"
 
 
+# IUPAC nucleotide codes and the bases they stand for
+IUPAC_BASES = dict(
+    A='A', C='C', G='G', T='T', U='T',
+    R='AG', Y='CT', S='CG', W='AT', K='GT', M='AC',
+    B='CGT', D='AGT', H='ACT', V='ACG', N='ACGT')
+
+# minimum seed length for the prefilter of approximate search
+MIN_SEED_LEN = 4
+
+
 #global logger
 # http://docs.python.org/library/logging.html
 LOG = logging.getLogger("")
@@ -37,6 +52,708 @@ logging.basicConfig(level=logging.WARN,
 
   
 
+class RegexMatcher(object):
+    """Matcher for one regular expression
+    """
+
+    # match fasta description, not id
+    match_id = False
+
+    def __init__(self, pattern, ignore_case=False, both_strands=False,
+                 all_hits=True):
+        """If both_strands is True, the reverse complement of pattern
+        is searched as well. If all_hits is False, search() stops at
+        the first hit (enough for deciding whether a record matches)
+        """
+        self.pattern = pattern
+        self.all_hits = all_hits
+        flags = re.IGNORECASE if ignore_case else 0
+        self.regexps = [('+', re.compile(pattern, flags=flags))]
+        if both_strands:
+            self.regexps.append(
+                ('-', re.compile(revcomp(pattern), flags=flags)))
+
+
+    def search(self, target):
+        """Returns list of (non-overlapping) hits in target as tuples
+        of pattern name, start and end (zero-based, exclusive), strand
+        and distance (always 0). Only the first hit if all_hits is
+        False
+        """
+        if not self.all_hits:
+            for (strand, regexp) in self.regexps:
+                m = regexp.search(target)
+                if m:
+                    return [(self.pattern, m.start(), m.end(), strand, 0)]
+            return []
+        return [(self.pattern, m.start(), m.end(), strand, 0)
+                for (strand, regexp) in self.regexps
+                for m in regexp.finditer(target)]
+
+
+
+class AhoCorasick(object):
+    """Aho-Corasick automaton for finding many literal patterns in one
+    pass over the target.
+
+    The automaton is stored as complete transition table (one array
+    of next states per character occurring in patterns), so that
+    searching needs one lookup per character and no failure link
+    traversal. Characters not occurring in any pattern reset the
+    search.
+    """
+
+    # match fasta description, not id
+    match_id = False
+
+    def __init__(self, patterns, names=None, strands=None,
+                 ignore_case=False):
+        """patterns is a list of strings, names optional names used
+        for reporting hits (default: the patterns themselves) and
+        strands their optional strands (default: '+')
+        """
+
+        if names is None:
+            names = patterns
+        if strands is None:
+            strands = ['+'] * len(patterns)
+        self.strands = strands
+        self.ignore_case = ignore_case
+        if ignore_case:
+            patterns = [p.upper() for p in patterns]
+        self.names = names
+        self.lengths = [len(p) for p in patterns]
+
+        # trie
+        goto = [dict()]
+        out = [[]]
+        for (pidx, pattern) in enumerate(patterns):
+            state = 0
+            for c in pattern:
+                next_state = goto[state].get(c)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][c] = next_state
+                    goto.append(dict())
+                    out.append([])
+                state = next_state
+            out[state].append(pidx)
+        nstates = len(goto)
+
+        # transition table and outputs via failure links in
+        # breadth-first order, so that the failure state is always
+        # complete
+        alphabet = set(c for pattern in patterns for c in pattern)
+        delta = dict((c, array('i', [0]) * nstates) for c in alphabet)
+        fail = [0] * nstates
+        queue = deque()
+        for c in alphabet:
+            next_state = goto[0].get(c, 0)
+            delta[c][0] = next_state
+            if next_state:
+                queue.append(next_state)
+        while queue:
+            state = queue.popleft()
+            out[state].extend(out[fail[state]])
+            for c in alphabet:
+                next_state = goto[state].get(c)
+                if next_state is None:
+                    delta[c][state] = delta[c][fail[state]]
+                else:
+                    delta[c][state] = next_state
+                    fail[next_state] = delta[c][fail[state]]
+                    queue.append(next_state)
+        self.delta = delta
+        self.out = [tuple(o) for o in out]
+        LOG.info("Aho-Corasick automaton for %d patterns has %d states" % (
+            len(patterns), nstates))
+
+
+    def search(self, target):
+        """Returns list of all (possibly overlapping) hits in target
+        as tuples of pattern name, start and end (zero-based,
+        exclusive), strand and distance (always 0)
+        """
+
+        if self.ignore_case:
+            target = target.upper()
+        get_row = self.delta.get
+        out = self.out
+        hits = []
+        state = 0
+        for (i, c) in enumerate(target):
+            row = get_row(c)
+            if row is None:
+                state = 0
+                continue
+            state = row[state]
+            if out[state]:
+                for pidx in out[state]:
+                    hits.append((self.names[pidx], i+1-self.lengths[pidx],
+                                 i+1, self.strands[pidx], 0))
+        return hits
+
+
+
+class IdMatcher(object):
+    """Exact matcher for a set of record ids
+    """
+
+    match_id = True
+
+    def __init__(self, ids, ignore_case=False):
+        """
+        """
+        self.ignore_case = ignore_case
+        if ignore_case:
+            self.ids = set([i.upper() for i in ids])
+        else:
+            self.ids = set(ids)
+
+
+    def search(self, target):
+        """Returns a hit (target, 0, len(target), '+', 0) if target is
+        one of our ids, otherwise an empty list
+        """
+        key = target.upper() if self.ignore_case else target
+        if key in self.ids:
+            return [(target, 0, len(target), '+', 0)]
+        return []
+
+
+
+def revcomp(seq):
+    """Reverse complement (IUPAC aware) of a sequence string
+    """
+    return str(Seq(seq).reverse_complement())
+
+
+
+def _iupac_peq(pattern):
+    """Returns dict of text character to bitmask of pattern positions
+    it matches, where bit i stands for pattern[i]. A text character
+    matches an IUPAC code in the pattern if all bases it stands for
+    are covered by the code (e.g. A matches R, but N only N). Other
+    characters only match themselves
+    """
+
+    peq = dict()
+    for c in set(IUPAC_BASES.keys()) | set(pattern):
+        text_bases = set(IUPAC_BASES.get(c, c))
+        bits = 0
+        for (i, p) in enumerate(pattern):
+            if p in IUPAC_BASES and c in IUPAC_BASES:
+                if text_bases <= set(IUPAC_BASES[p]):
+                    bits |= 1 << i
+            elif p == c:
+                bits |= 1 << i
+        if bits:
+            peq[c] = bits
+    return peq
+
+
+
+def _hamming_hits(text, wstart, wend, m, peq, max_dist):
+    """Bit-parallel shift-and search with up to max_dist mismatches
+    (Wu-Manber) in text[wstart:wend]. Yields start, end and number of
+    mismatches of hits
+    """
+
+    full = (1 << m) - 1
+    high = 1 << (m-1)
+    # state[d]: bit i set if pattern[:i+1] matches with <= d mismatches
+    state = [0] * (max_dist+1)
+    get_mask = peq.get
+    for j in xrange(wstart, wend):
+        mask = get_mask(text[j], 0)
+        prev = state[0]
+        state[0] = ((prev << 1) | 1) & mask
+        for d in xrange(1, max_dist+1):
+            cur = state[d]
+            state[d] = ((((cur << 1) | 1) & mask) | ((prev << 1) | 1)) & full
+            prev = cur
+        if state[max_dist] & high:
+            dist = min([d for d in xrange(max_dist+1) if state[d] & high])
+            yield (j-m+1, j+1, dist)
+
+
+
+def _myers_scores(text, positions, m, peq, anchored=False):
+    """Myers' bit-vector algorithm: yields position and edit distance
+    of pattern (given as its peq) ending at each of the given text
+    positions. The pattern may start anywhere unless anchored, in
+    which case it has to start at the first position
+    """
+
+    full = (1 << m) - 1
+    high = 1 << (m-1)
+    pv = full
+    mv = 0
+    score = m
+    get_mask = peq.get
+    for j in positions:
+        eq = get_mask(text[j], 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & high:
+            score += 1
+        elif mh & high:
+            score -= 1
+        ph = (ph << 1) & full
+        if anchored:
+            ph |= 1
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+        yield (j, score)
+
+
+
+def _edit_hits(text, wstart, wend, m, peq, peq_rev, max_dist):
+    """Search with up to max_dist edits (mismatches and indels) in
+    text[wstart:wend]. Of overlapping end positions only the best
+    is reported. Yields start, end and edit distance of hits
+    """
+
+    run = []
+    ends = _myers_scores(text, xrange(wstart, wend), m, peq)
+    for (j, score) in ends:
+        if score <= max_dist:
+            run.append((score, j))
+            if j+1 < wend:
+                continue
+        if not run:
+            continue
+        (best, end) = min(run)
+        run = []
+        # start: anchored search of reversed pattern from end
+        # backwards, preferring a match length closest to m
+        lo = max(0, end-m-max_dist+1)
+        starts = [j for (j, score) in _myers_scores(
+            text, xrange(end, lo-1, -1), m, peq_rev, anchored=True)
+                  if score == best]
+        start = min(starts, key=lambda j: abs(end-j+1-m))
+        yield (start, end+1, best)
+
+
+
+class ApproxMatcher(object):
+    """Approximate matcher for (IUPAC) nucleotide patterns allowing up
+    to max_dist mismatches (shift-and) or, if edits is True, edits
+    (Myers' bit-vector algorithm).
+
+    Where possible (pattern long enough and without ambiguity codes)
+    a pigeonhole prefilter is used: the pattern is split into
+    max_dist+1 seeds, one of which has to occur exactly in any hit,
+    so only windows around seed occurrences (found with str.find)
+    are verified bit-parallel.
+    """
+
+    # match fasta description, not id
+    match_id = False
+
+    def __init__(self, patterns, names=None, strands=None, max_dist=0,
+                 edits=False, ignore_case=False):
+        """See AhoCorasick for patterns, names and strands
+        """
+
+        if names is None:
+            names = patterns
+        if strands is None:
+            strands = ['+'] * len(patterns)
+        self.max_dist = max_dist
+        self.edits = edits
+        self.ignore_case = ignore_case
+        self.variants = []
+        for (pattern, name, strand) in zip(patterns, names, strands):
+            if ignore_case:
+                pattern = pattern.upper()
+            m = len(pattern)
+            seed_len = m // (max_dist+1)
+            seeds = None
+            if seed_len >= MIN_SEED_LEN and \
+              not set(pattern) - set('ACGT'):
+                seeds = []
+                for i in xrange(max_dist+1):
+                    end = m if i == max_dist else (i+1)*seed_len
+                    seeds.append((i*seed_len, pattern[i*seed_len:end]))
+            self.variants.append(
+                (name, strand, m, _iupac_peq(pattern),
+                 _iupac_peq(pattern[::-1]), seeds))
+        LOG.info("%d of %d patterns can use seed prefilter" % (
+            len([v for v in self.variants if v[-1]]), len(self.variants)))
+
+
+    def search(self, target):
+        """Returns list of hits in target as tuples of pattern name,
+        start and end (zero-based, exclusive), strand and distance
+        """
+
+        if self.ignore_case:
+            target = target.upper()
+        tlen = len(target)
+        # seeds can't find U matching T
+        use_seeds = 'U' not in target
+        hits = []
+        for (name, strand, m, peq, peq_rev, seeds) in self.variants:
+            if seeds is not None and use_seeds:
+                windows = []
+                for (offset, seed) in seeds:
+                    pos = target.find(seed)
+                    while pos >= 0:
+                        windows.append(
+                            (max(0, pos-offset-self.max_dist),
+                             min(tlen, pos-offset+m+self.max_dist)))
+                        pos = target.find(seed, pos+1)
+                if not windows:
+                    continue
+                # merge overlapping
+                windows.sort()
+                merged = [list(windows[0])]
+                for (start, end) in windows[1:]:
+                    if start <= merged[-1][1]:
+                        merged[-1][1] = max(merged[-1][1], end)
+                    else:
+                        merged.append([start, end])
+                windows = merged
+            else:
+                windows = [(0, tlen)]
+
+            for (wstart, wend) in windows:
+                if self.edits:
+                    found = _edit_hits(target, wstart, wend, m, peq,
+                                       peq_rev, self.max_dist)
+                else:
+                    found = _hamming_hits(target, wstart, wend, m, peq,
+                                          self.max_dist)
+                for (start, end, dist) in found:
+                    hits.append((name, start, end, strand, dist))
+        return hits
+
+
+
+def read_patterns(fname):
+    """Reads patterns from file: either one per line or, if the file
+    is in fasta format, one per sequence (named by its id). Returns
+    list of patterns and list of names
+    """
+
+    # pattern files are small
+    fh = bioutils.xopen(fname)
+    data = fh.read()
+    fh.close()
+    if data.startswith('>'):
+        records = list(bioutils.read_fastx(StringIO(data), 'fasta'))
+        names = [r[0] for r in records]
+        patterns = [r[2] for r in records]
+    else:
+        patterns = [line.strip() for line in data.splitlines()]
+        names = patterns
+    keep = [i for (i, p) in enumerate(patterns) if p]
+    if len(keep) != len(patterns):
+        LOG.warn("Ignoring %d empty patterns in %s" % (
+            len(patterns)-len(keep), fname))
+    return ([patterns[i] for i in keep], [names[i] for i in keep])
+
+
+
+def indexed_records(fname, ids):
+    """Yields records with given ids from an indexed fasta file (see
+    bioutils.FastaIndex) in file order, without scanning the file
+    """
+    fasta_idx = bioutils.FastaIndex(fname)
+    names = sorted([n for n in ids if n in fasta_idx],
+                   key=lambda n: fasta_idx.entries[n][1])
+    for name in names:
+        yield (name, fasta_idx.header(name), fasta_idx.fetch(name))
+    fasta_idx.close()
+
+
+
+def until_all_found(records, ids):
+    """Passes on the first record of each of ids (as a lookup in the
+    fasta index would) and stops once all ids have been seen
+    """
+    remaining = set(ids)
+    if not remaining:
+        return
+    for record in records:
+        if record[0] not in remaining:
+            continue
+        yield record
+        remaining.discard(record[0])
+        if not remaining:
+            LOG.info("All ids found. Stopping early")
+            break
+
+
+
+def format_record(record, fmt, out_format, prefix=""):
+    """Formats a record (tuple as returned by bioutils.read_fastx(),
+    with raw text as last element if out_format is 'raw', or with
+    SeqRecord as fourth element for formats other than fasta and
+    fastq) for output.
+
+    out_format 'auto' keeps the input format, 'raw' writes fasta and
+    fastq records as they were read, 'fasta' converts to (single
+    line) fasta and 'ids' only writes the id. All lines are prefixed
+    with prefix.
+    """
+
+    if out_format == 'ids':
+        return "%s%s\n" % (prefix, record[0])
+    if fmt == 'fasta' and out_format != 'raw' \
+      or fmt == 'fastq' and out_format == 'fasta':
+        return "%s>%s\n%s%s\n" % (prefix, record[1], prefix, record[2])
+    if fmt == 'fastq' and out_format == 'auto':
+        return "%s@%s\n%s%s\n%s+\n%s%s\n" % (
+            prefix, record[1], prefix, record[2], prefix, prefix, record[3])
+    if fmt in ['fasta', 'fastq']:
+        text = record[-1]
+    elif out_format == 'fasta':
+        text = record[3].format('fasta')
+    else:
+        text = record[3].format(fmt)
+    if prefix:
+        text = ''.join([prefix + line for line in text.splitlines(True)])
+    return text
+
+
+
+def grep_records(records, fmt, matcher, search_in, invert_match, prefix="",
+                 hits_label=None, out_format='auto'):
+    """Yields output for all records (tuples as returned by
+    bioutils.read_fastx) matching matcher as tuple of record output
+    (see format_record(); empty if out_format is 'count') and hits
+    output (tab separated hits_label (file name), id, pattern,
+    strand, start, end (one-based) and distance per hit; empty if
+    hits_label is None)
+    """
+
+    for record in records:
+        (rec_id, rec_descr, rec_seq) = record[:3]
+
+        if search_in == 'seq':
+            target = rec_seq
+        elif search_in == 'id':
+            # special case fasta: id is everything before the
+            # first whitespace. description contains this as well.
+            if fmt == 'fasta' and not matcher.match_id:
+                target = rec_descr
+            else:
+                target = rec_id
+        else:
+            raise ValueError, (
+                "internal error...not sure where to search in")
+
+        hits = matcher.search(target)
+        print_match = False
+        if hits and not invert_match:
+            LOG.debug("match in %s: %s" % (rec_id, hits))
+            print_match = True
+        elif invert_match and not hits:
+            print_match = True
+
+        if print_match:
+            out = ""
+            if out_format != 'count':
+                out = format_record(record, fmt, out_format, prefix)
+            hits_out = ""
+            if hits_label is not None:
+                hits_out = ''.join(["%s\t%s\t%s\t%s\t%d\t%d\t%d\n" % (
+                    hits_label, rec_id, name, strand, start+1, end, dist)
+                                    for (name, start, end, strand, dist) in hits])
+            yield (out, hits_out)
+
+
+
+def grep_chunk(records, *args):
+    """Output of grep_records() as one string each for records and
+    hits, plus number of matching records. Used as worker function
+    for parallel parsing of chunks
+    """
+    outs = []
+    hits_outs = []
+    for (out, hits_out) in grep_records(records, *args):
+        outs.append(out)
+        hits_outs.append(hits_out)
+    return (''.join(outs), ''.join(hits_outs), len(outs))
+
+
+
+def file_records(fseq, fmt, matcher, id_lookup, invert_match, raw=False):
+    """Returns records of fseq as needed by grep_records() and the
+    file handle to close after use (or None). If id_lookup is True
+    matcher.ids are looked up in the fasta index if possible or used
+    to prefilter records during parsing. If raw is True, fasta/fastq
+    records include their original text (see bioutils.read_fastx())
+    """
+
+    fhandle = None
+    if id_lookup and not invert_match and not raw and fmt == 'fasta' \
+      and bioutils.fasta_index_exists(fseq):
+        LOG.info("Using index for %s" % fseq)
+        records = indexed_records(fseq, matcher.ids)
+    else:
+        # transparently decompresses
+        fhandle = bioutils.xopen(fseq)
+        if fmt in ['fasta', 'fastq'] and id_lookup:
+            records = bioutils.read_fastx(
+                fhandle, fmt, ids=matcher.ids,
+                exclude_ids=invert_match, raw=raw)
+            if not invert_match:
+                records = until_all_found(records, matcher.ids)
+        elif fmt in ['fasta', 'fastq']:
+            # fast path: no SeqRecord construction
+            records = bioutils.read_fastx(fhandle, fmt, raw=raw)
+        else:
+            # record kept for format preserving output
+            records = ((r.id, r.description, str(r.seq), r)
+                       for r in SeqIO.parse(fhandle, fmt))
+    return (records, fhandle)
+
+
+
+def grep_file(fseq, fmt, matcher, search_in, invert_match, id_lookup,
+              out_format, prefix, hits_label, out_fh, hits_fh):
+    """Greps one file and writes output to out_fh and hits_fh (if not
+    None). Returns number of matching records
+    """
+
+    (records, fhandle) = file_records(fseq, fmt, matcher, id_lookup,
+                                      invert_match, out_format == 'raw')
+    count = 0
+    for (out, hits_out) in grep_records(records, fmt, matcher, search_in,
+                                        invert_match, prefix, hits_label,
+                                        out_format):
+        count += 1
+        out_fh.write(out)
+        if hits_fh:
+            hits_fh.write(hits_out)
+    if fhandle is not None:
+        fhandle.close()
+    return count
+
+
+
+# matcher and search options shared by all worker processes. set by
+# _init_worker() once per process, so that the matcher isn't pickled
+# per task
+_WORKER_ARGS = None
+
+def _init_worker(matcher, search_in, invert_match, id_lookup, out_format):
+    """Initializes a grep_task() worker process
+    """
+    global _WORKER_ARGS
+    _WORKER_ARGS = (matcher, search_in, invert_match, id_lookup, out_format)
+
+
+
+def grep_task(task):
+    """Worker function for parallel grep of one file or one chunk of a
+    file. task is a tuple of file number, file name, format, chunk
+    (see bioutils.fastx_chunks(); None for whole file), prefix and
+    hits label.
+
+    Returns tuple of file number, record output, hits output, number
+    of matching records and temporary file names. Output for a whole
+    file is spooled to two temporary files (records and hits)
+    instead of being returned.
+    """
+
+    (fnum, fseq, fmt, chunk, prefix, hits_label) = task
+    (matcher, search_in, invert_match, id_lookup, out_format) = _WORKER_ARGS
+    if chunk is not None:
+        records = bioutils.read_fastx_chunk(fseq, fmt, chunk,
+                                            raw=out_format == 'raw')
+        (out, hits_out, count) = grep_chunk(
+            records, fmt, matcher, search_in, invert_match, prefix,
+            hits_label, out_format)
+        return (fnum, out, hits_out, count, None)
+
+    tmp_fnames = []
+    try:
+        for _ in xrange(2):
+            (fd, tmp_fname) = tempfile.mkstemp(prefix="seqgrep-")
+            os.close(fd)
+            tmp_fnames.append(tmp_fname)
+        with open(tmp_fnames[0], 'wb') as out_fh, \
+          open(tmp_fnames[1], 'wb') as hits_fh:
+            count = grep_file(fseq, fmt, matcher, search_in, invert_match,
+                              id_lookup, out_format, prefix, hits_label,
+                              out_fh, hits_fh)
+    except:
+        for tmp_fname in tmp_fnames:
+            os.unlink(tmp_fname)
+        raise
+    return (fnum, None, None, count, tmp_fnames)
+
+
+
+def grep_tasks(seqfiles, fmts, prefixes, hits_labels, split_files,
+               chunk_size=bioutils.FASTX_CHUNK_SIZE):
+    """Returns list of grep_task() tasks for seqfiles. Uncompressed
+    and bgzip compressed fasta/fastq files larger than chunk_size are
+    split into chunks if split_files is True.
+    """
+
+    tasks = []
+    for (fnum, (fseq, fmt, prefix, hits_label)) in enumerate(zip(
+            seqfiles, fmts, prefixes, hits_labels)):
+        chunks = [None]
+        if split_files and fmt in ['fasta', 'fastq'] \
+          and bioutils.is_chunkable(fseq) \
+          and os.path.getsize(fseq) > chunk_size:
+            chunks = bioutils.fastx_chunks(fseq, chunk_size)
+            LOG.info("Splitting %s into %d chunks" % (fseq, len(chunks)))
+        for chunk in chunks:
+            tasks.append((fnum, fseq, fmt, chunk, prefix, hits_label))
+    return tasks
+
+
+
+def parallel_grep(tasks, matcher, search_in, invert_match, id_lookup,
+                  out_format, num_workers, out_fh, hits_fh, ordered=True):
+    """Runs tasks (see grep_tasks()) with num_workers processes and
+    writes their output to out_fh and hits_fh (if not None), in input
+    order or in order of completion if ordered is False. Returns
+    number of matching records per file (by file number) as dict
+    """
+
+    counts = dict()
+    pool = multiprocessing.Pool(
+        num_workers, _init_worker,
+        (matcher, search_in, invert_match, id_lookup, out_format))
+    try:
+        if ordered:
+            results = pool.imap(grep_task, tasks)
+        else:
+            results = pool.imap_unordered(grep_task, tasks)
+        for (fnum, out, hits_out, count, tmp_fnames) in results:
+            counts[fnum] = counts.get(fnum, 0) + count
+            if tmp_fnames is None:
+                out_fh.write(out)
+                if hits_fh:
+                    hits_fh.write(hits_out)
+                continue
+            for (tmp_fname, fh) in zip(tmp_fnames, [out_fh, hits_fh]):
+                if fh:
+                    with open(tmp_fname, 'rb') as fh_tmp:
+                        shutil.copyfileobj(fh_tmp, fh,
+                                           bioutils.WRITE_BUFFER_SIZE)
+                os.unlink(tmp_fname)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return counts
+
+
+
 def cmdline_parser():
     """
     creates an OptionParser instance
@@ -64,12 +781,88 @@ def cmdline_parser():
                       action="store_true", 
                       dest="revcomp",
                       help="Reverse complement search string")
+    parser.add_option("-b", "--both-strands",
+                      action="store_true",
+                      dest="both_strands",
+                      help="Search pattern(s) and reverse complement(s)"
+                      " in one pass (strand is reported in hits)")
+    parser.add_option("", "--max-mismatches",
+                      dest="max_mismatches",
+                      type="int",
+                      help="Approximate search: allow this many"
+                      " mismatches (patterns are IUPAC nucleotide"
+                      " sequences; needs search in seq)")
+    parser.add_option("", "--max-edits",
+                      dest="max_edits",
+                      type="int",
+                      help="Approximate search: allow this many"
+                      " mismatches and indels (as --max-mismatches)")
+    parser.add_option("-f", "--pattern-file",
+                      dest="pattern_file",
+                      help="Search for all literal patterns in this file"
+                      " (one per line, or fasta) in one pass, instead"
+                      " of a pattern argument")
+    parser.add_option("-x", "--exact-id",
+                      action="store_true",
+                      dest="exact_id",
+                      help="Pattern (or ids in pattern file) must be"
+                      " identical to record id. Only headers are"
+                      " parsed, indexed fasta files (.fai) are not"
+                      " scanned at all and reading stops once all ids"
+                      " were found (i.e. only first of duplicate ids"
+                      " is reported)")
+    parser.add_option("", "--hits-out",
+                      dest="hits_out",
+                      help="Write pattern hits of matching records to"
+                      " this file (tab separated: file, id, pattern,"
+                      " strand, start, end (one-based, on forward"
+                      " strand) and distance)")
     parser.add_option("-i", "--ignore-case",
                       action="store_true", dest="ignore_case",
                       help="Make search case sensitive")
     parser.add_option("-v", "--invert-match",
                       action="store_true", dest="invert_match",
                       help="invert sense of matching")
+    parser.add_option("-j", "--jobs",
+                      dest="jobs",
+                      type="int",
+                      default=1,
+                      help="Number of processes. Files are distributed"
+                      " over processes and large uncompressed or bgzip"
+                      " compressed fasta/fastq files are split into"
+                      " chunks (default=1)")
+    parser.add_option("", "--unordered",
+                      action="store_true",
+                      dest="unordered",
+                      help="With more than one job: write output in order"
+                      " of completion instead of input order (output"
+                      " per record stays intact)")
+    choices = ['auto', 'fasta', 'raw']
+    parser.add_option("", "--out-format",
+                      dest="out_format",
+                      default="auto", choices=choices,
+                      help="Output format of matching records: auto"
+                      " (input format, e.g. fastq with qualities), fasta,"
+                      " or raw (fasta/fastq records exactly as read,"
+                      " otherwise as auto) (%s; default=auto)" % (choices))
+    parser.add_option("-c", "--count",
+                      action="store_true",
+                      dest="count",
+                      help="Only print number of matching records per file")
+    parser.add_option("-l", "--ids-only",
+                      action="store_true",
+                      dest="ids_only",
+                      help="Only print ids of matching records")
+    parser.add_option("-o", "--output",
+                      dest="output",
+                      default="-",
+                      help="Output file (gzip or bgzip compressed if"
+                      " ending in .gz or .bgz; default=stdout)")
+    choices = ['gzip', 'bgzip']
+    parser.add_option("-z", "--compress",
+                      dest="compress",
+                      choices=choices,
+                      help="Compress output (%s)" % (choices))
     return parser
 
 
@@ -87,25 +880,90 @@ def main():
     if opts.debug:
         LOG.setLevel(logging.DEBUG)
         
-    if len(args)<2:
+    if opts.pattern_file:
+        if len(args)<1:
+            parser.error("Need at least one seqfile as argument")
+            sys.exit(1)
+    elif len(args)<2:
         parser.error("Need pattern and at least one seqfile as argument")
         sys.exit(1)
+    if opts.jobs < 1:
+        parser.error("Number of jobs must be at least 1")
+        sys.exit(1)
+    if opts.exact_id and opts.search_in != 'id':
+        parser.error("Exact id mode only works with search in id")
+        sys.exit(1)
+    if opts.max_mismatches is not None and opts.max_edits is not None:
+        parser.error("Use either max. mismatches or max. edits")
+        sys.exit(1)
+    approx_dist = opts.max_mismatches
+    if opts.max_edits is not None:
+        approx_dist = opts.max_edits
+    if approx_dist is not None:
+        if approx_dist < 0:
+            parser.error("Max. mismatches/edits can't be negative")
+            sys.exit(1)
+        if opts.search_in != 'seq' or opts.exact_id:
+            parser.error("Approximate search only works with search in seq")
+            sys.exit(1)
+    if opts.count and opts.ids_only:
+        parser.error("Use either count or ids-only")
+        sys.exit(1)
+    out_format = opts.out_format
+    if opts.count:
+        out_format = 'count'
+    elif opts.ids_only:
+        out_format = 'ids'
 
     
-    # first arg is pattern. rest are files
-    pattern_arg = args[0]
-    if opts.revcomp:
-        pattern_arg = str(Seq(pattern_arg).reverse_complement())
-        LOG.info("Pattern after reverse complement: %s" % pattern_arg)
-    seqfiles_arg = args[1:]
-    LOG.debug("args=%s" % (args))
-    LOG.debug("pattern_arg=%s" % (pattern_arg))
-    LOG.debug("seqfiles_arg=%s" % (seqfiles_arg))
+    if opts.pattern_file:
+        if not os.path.exists(opts.pattern_file):
+            LOG.fatal("pattern file %s does not exist.\n" % opts.pattern_file)
+            sys.exit(1)
+        (patterns, names) = read_patterns(opts.pattern_file)
+        if not patterns:
+            LOG.fatal("No patterns found in %s" % opts.pattern_file)
+            sys.exit(1)
+        LOG.info("Loaded %d patterns from %s" % (
+            len(patterns), opts.pattern_file))
+        seqfiles_arg = args
+    else:
+        # first arg is pattern. rest are files
+        patterns = names = [args[0]]
+        LOG.debug("pattern_arg=%s" % (args[0]))
+        seqfiles_arg = args[1:]
 
-    if opts.ignore_case:
-        regexp = re.compile(pattern_arg, flags=re.IGNORECASE)
+    if opts.exact_id:
+        # ids of sequences if pattern file was fasta
+        matcher = IdMatcher(names, opts.ignore_case)
     else:
-        regexp = re.compile(pattern_arg)
+        if opts.revcomp:
+            patterns = [revcomp(p) for p in patterns]
+            LOG.info("Pattern(s) after reverse complement: %s" % (
+                ', '.join(patterns[:10])))
+        strands = ['+'] * len(patterns)
+        if opts.both_strands and (
+                opts.pattern_file or approx_dist is not None):
+            # one pass for both strands (a single regular expression
+            # is handled by RegexMatcher)
+            patterns = patterns + [revcomp(p) for p in patterns]
+            names = names + names
+            strands = strands + ['-'] * len(strands)
+        if approx_dist is not None:
+            matcher = ApproxMatcher(patterns, names, strands,
+                                    max_dist=approx_dist,
+                                    edits=opts.max_edits is not None,
+                                    ignore_case=opts.ignore_case)
+        elif opts.pattern_file:
+            matcher = AhoCorasick(patterns, names, strands,
+                                  ignore_case=opts.ignore_case)
+        else:
+            # hit positions are only reported with --hits-out
+            matcher = RegexMatcher(patterns[0], opts.ignore_case,
+                                   both_strands=opts.both_strands,
+                                   all_hits=bool(opts.hits_out))
+    LOG.debug("args=%s" % (args))
+    LOG.debug("seqfiles_arg=%s" % (seqfiles_arg))
 
         
     for fseq in seqfiles_arg:
@@ -116,60 +974,67 @@ def main():
     print_file_prefix = False
     if len(seqfiles_arg)>1:
         print_file_prefix = True
-        
+
+    fmts = []
+    prefixes = []
+    hits_labels = []
     for fseq in seqfiles_arg:
-        if fseq == "-":
-            fhandle = sys.stdin
-        else:
-            if fseq[-3:] == ".gz":
-                fhandle = gzip.open(fseq)
-            else:
-                fhandle = open(fseq, "rU")
-        
         fmt = bioutils.guess_seqformat(fseq)
         if not fmt:
             fmt = 'fasta'
-        LOG.info("Checking file %s (format %s)" % (fseq, fmt))
-        
-        for record in SeqIO.parse(fhandle, fmt):
-            #LOG.debug("checking seq %s (len %d)" % (record.id, len(record.seq)))
-
-            if opts.search_in == 'seq':
-                target = record.seq
-            elif opts.search_in == 'id':
-                # special case fasta: id is everything before the
-                # first whitespace. description contains this as well.
-                if fmt == 'fasta':
-                    target = record.description
-                else:
-                    target = record.id
-            else:
-                raise ValueError, (
-                    "internal error...not sure where to search in")
-            
-            target = str(target)
-            match = regexp.search(target) 
-            print_match = False
-            if match and not opts.invert_match:
-                LOG.debug("match.string=%s" % match.string)
-                print_match = True
-            elif opts.invert_match and not match:
-                print_match = True
-
-            if print_match:
-                #import pdb; pdb.set_trace()
-                prefix = ""
-                if print_file_prefix:
-                    prefix = fseq + ":"
-                if fmt == 'fasta':
-                    print "%s>%s\n%s%s" % (prefix, record.description, prefix, record.seq)
-                else:
-                    print "%s>%s\n%s%s" % (prefix, record.id, prefix, record.seq)
-        if fhandle != sys.stdin:
-            fhandle.close()
+        fmts.append(fmt)
+        if print_file_prefix:
+            prefixes.append(fseq + ":")
+        else:
+            prefixes.append("")
+        hits_labels.append(fseq if opts.hits_out else None)
+
+    # exact ids (case sensitive) can be looked up or prefiltered
+    # during parsing
+    id_lookup = opts.exact_id and not opts.ignore_case
+
+    # single buffered writer for all output
+    out_fh = bioutils.xopen_write(opts.output, opts.compress)
+    hits_fh = None
+    if opts.hits_out:
+        hits_fh = bioutils.xopen_write(opts.hits_out)
+        hits_fh.write("#file\tid\tpattern\tstrand\tstart\tend\tdist\n")
+
+    if opts.jobs > 1 and "-" in seqfiles_arg:
+        # worker processes can't read from stdin
+        LOG.warn("Reading from stdin: ignoring number of jobs")
+        opts.jobs = 1
+    if opts.jobs > 1:
+        # lookup of exact ids stops after first hit, so files can't
+        # be split then
+        split_files = not (id_lookup and not opts.invert_match)
+        tasks = grep_tasks(seqfiles_arg, fmts, prefixes, hits_labels,
+                           split_files)
+        LOG.info("Running %d tasks with %d processes" % (
+            len(tasks), opts.jobs))
+        counts = parallel_grep(tasks, matcher, opts.search_in,
+                               opts.invert_match, id_lookup, out_format,
+                               opts.jobs, out_fh, hits_fh,
+                               ordered=not opts.unordered)
+    else:
+        counts = dict()
+        for (fnum, (fseq, fmt, prefix, hits_label)) in enumerate(zip(
+                seqfiles_arg, fmts, prefixes, hits_labels)):
+            LOG.info("Checking file %s (format %s)" % (fseq, fmt))
+            counts[fnum] = grep_file(fseq, fmt, matcher, opts.search_in,
+                                     opts.invert_match, id_lookup,
+                                     out_format, prefix, hits_label,
+                                     out_fh, hits_fh)
+
+    if out_format == 'count':
+        for (fnum, prefix) in enumerate(prefixes):
+            out_fh.write("%s%d\n" % (prefix, counts.get(fnum, 0)))
+    out_fh.close()
+    if hits_fh:
+        hits_fh.close()
             
 
 if __name__ == "__main__":
     main()
-    LOG.debug("FIXME: Add support coloured output, length filtering, support output format arg.")
+    LOG.debug("FIXME: Add support coloured output, length filtering.")
 
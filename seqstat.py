@@ -7,11 +7,15 @@ Prints statistics of a sequence file (aligned or unaligned).
 #--- standard library imports
 #
 import sys
+import os
 import logging
+import tempfile
+import shutil
+import multiprocessing
+import hashlib
+import random
 # optparse deprecated from Python 2.7 on
 from optparse import OptionParser, SUPPRESS_HELP
-from itertools import izip
-from itertools import chain
 from math import sqrt
 from operator import itemgetter
 
@@ -19,6 +23,7 @@ from operator import itemgetter
 #
 from Bio import SeqIO
 from Bio import Seq
+import numpy
 
 #--- project specific imports
 #
@@ -41,6 +46,27 @@ logging.basicConfig(level=logging.WARN,
 
 NUCLEIC_ACID_LETTERS = 'ACGTUN'
 
+# block sizes (sequences, columns) used for the pairwise identity
+# computation. determine memory usage
+IDENT_ROW_BLOCK = 1024
+IDENT_COL_BLOCK = 4096
+
+# number of pairs for which identities are computed at once in
+# approximate mode
+PAIRS_BATCH = 1000
+DEFAULT_SAMPLE_PAIRS = 100000
+
+# MinHash sketches for finding related sequences in approximate mode
+SKETCH_SIZE = 64
+SKETCH_BANDS = 16
+SKETCH_EMPTY = numpy.uint64(2**64-1)
+SKETCH_MAX_BUCKET = 50
+SKETCH_NUM_REFS = 64
+SKETCH_NUM_OUTLIERS = 32
+SKETCH_RANDOM_PARTNERS = 8
+SKETCH_NUM_PIVOTS = 16
+SKETCH_KMER_LEN = {'nucleic': 12, 'protein': 5}
+
 
 def argminmax(values, what=None):
     """Return index and value of min/max from values.
@@ -142,44 +168,620 @@ def pairwise_identity(s1, s2):
     """
     
     assert len(s1) == len(s2)
-    idents = sum(c1 == c2
-                 for c1, c2 in izip(s1, s2) 
-                 if not bioutils.isgap(c1) and not bioutils.isgap(c2))
+    (a1, a2) = (bioutils.as_byte_array(s1), bioutils.as_byte_array(s2))
+    non_gaps = ~(bioutils.gap_mask(a1) | bioutils.gap_mask(a2))
+    idents = int(((a1 == a2) & non_gaps).sum())
     min_ungapped_len = min(len(bioutils.ungap(s1)), len(bioutils.ungap(s2)))
     return idents / float(min_ungapped_len)
 
 
 
 
-def comp_pairwise_ident_matrix(seqrecs):
-    """Returns a fake matrix (symmetric 2d list) of pairwise
-    identities. Valid index range is [i][j], where i>=j, j>=0 and
-    i<nseqs. values for i=j are None!
+def encode_aln(aln, fname=None, row_block=IDENT_ROW_BLOCK):
+    """Encode alignment (bioutils.Alignment) once into an uppercased
+    uint8 matrix of shape (nseqs, aln_len) plus a boolean gap mask of
+    the same shape. Gap positions are zeroed in the returned matrix,
+    so that zero never counts as a residue.
+
+    If fname is given the matrix is backed by a memory-mapped file of
+    that name (which can then be shared between processes).
+    """
+
+    shape = aln.mx.shape
+    if fname:
+        enc_mx = numpy.memmap(fname, dtype=numpy.uint8, mode='w+',
+                              shape=shape)
+    else:
+        enc_mx = numpy.empty(shape, dtype=numpy.uint8)
+    gap_mx = aln.gap_mask()
+    for i in xrange(0, shape[0], row_block):
+        rows = slice(i, i+row_block)
+        enc_mx[rows] = bioutils.to_upper(aln.mx[rows])
+        enc_mx[rows][gap_mx[rows]] = 0
+    if fname:
+        enc_mx.flush()
+
+    return (enc_mx, gap_mx)
+
+
+
+def condensed_index(nseqs, i, j):
+    """Returns the index of pair (i, j) with i<j in a condensed
+    (upper triangle, row-major) pairwise matrix of nseqs sequences
+    (same layout as scipy.spatial.distance.squareform). i and j can
+    also be integer arrays
+    """
+    assert numpy.all(i < j)
+    return nseqs*i - i*(i+1)//2 + j - i - 1
+
+
+
+def condensed_row(cmx, nseqs, i):
+    """Returns all values for sequence i from condensed matrix cmx as
+    array of length nseqs. The self-comparison value is NaN.
+    """
+
+    row = numpy.empty(nseqs, dtype=cmx.dtype)
+    # j<i: one value per earlier row
+    if i > 0:
+        row[:i] = cmx[condensed_index(nseqs, numpy.arange(i), i)]
+    row[i] = numpy.nan
+    # j>i: contiguous
+    if i < nseqs-1:
+        start = condensed_index(nseqs, i, i+1)
+        row[i+1:] = cmx[start:start+nseqs-i-1]
+    return row
+
+
+
+def ident_counts_tile(enc_mx, rows, cols, residues, col_block=IDENT_COL_BLOCK):
+    """Returns a matrix of shape (len(rows), len(cols)) with the
+    number of identical, non-gap residues between all pairs of
+    sequences in the row and column slices of enc_mx (as returned by
+    encode_aln).
+
+    Counts are accumulated per residue as products of one-hot
+    matrices, processing col_block alignment columns at a time to
+    keep memory bounded.
+    """
+
+    aln_len = enc_mx.shape[1]
+    # float32 sums of integers are exact up to 2**24
+    if aln_len < 2**24:
+        dtype = numpy.float32
+    else:
+        dtype = numpy.float64
+
+    counts = numpy.zeros((rows.stop-rows.start, cols.stop-cols.start),
+                         dtype=dtype)
+    for start in xrange(0, aln_len, col_block):
+        end = min(start+col_block, aln_len)
+        row_block = enc_mx[rows, start:end]
+        col_block_mx = enc_mx[cols, start:end]
+        for res in residues:
+            row_onehot = (row_block == res).astype(dtype)
+            col_onehot = (col_block_mx == res).astype(dtype)
+            counts += numpy.dot(row_onehot, col_onehot.T)
+    return counts.astype(numpy.int64)
+
+
+
+def ident_tile_to_condensed(enc_mx, ungapped_lens, rows, cols, residues, cmx):
+    """Computes pairwise identities for the given tile (rows and cols
+    are slices into enc_mx with rows.start <= cols.start) and stores
+    the upper triangle part in condensed matrix cmx
+    """
+
+    nseqs = enc_mx.shape[0]
+    idents = ident_counts_tile(enc_mx, rows, cols, residues)
+    min_ungapped_lens = numpy.minimum.outer(
+        ungapped_lens[rows], ungapped_lens[cols])
+    tile = idents / min_ungapped_lens.astype(numpy.float64)
+
+    for i in xrange(rows.start, rows.stop):
+        # only j>i
+        jstart = max(cols.start, i+1)
+        if jstart >= cols.stop:
+            continue
+        cstart = condensed_index(nseqs, i, jstart)
+        cmx[cstart:cstart+cols.stop-jstart] = \
+          tile[i-rows.start, jstart-cols.start:]
+
+
+
+def _ident_tile_worker(args):
+    """Process pool wrapper for ident_tile_to_condensed() working on
+    memory-mapped input (encoded alignment) and output (condensed
+    matrix) files
+    """
+
+    (enc_fname, enc_shape, cmx_fname, cmx_dtype,
+     ungapped_lens, rows, cols, residues) = args
+    enc_mx = numpy.memmap(enc_fname, dtype=numpy.uint8, mode='r',
+                          shape=enc_shape)
+    cmx = numpy.memmap(cmx_fname, dtype=cmx_dtype, mode='r+')
+    ident_tile_to_condensed(enc_mx, ungapped_lens, rows, cols, residues, cmx)
+    cmx.flush()
+    return (rows.start, cols.start)
+
+
+
+def check_ungapped_lens(ungapped_lens, ids):
+    """Raises ValueError if any sequence consists of gaps only, since
+    its identity to any other sequence is undefined (no residues to
+    divide by)
+    """
+
+    empty = numpy.flatnonzero(ungapped_lens == 0)
+    if len(empty):
+        raise ValueError(
+            "%d sequence(s) consist of gaps only (first: %s):"
+            " pairwise identities are undefined" % (
+                len(empty), ids[empty[0]]))
+
+
+
+def comp_pairwise_ident_matrix(aln, num_workers=1, dtype=numpy.float64,
+                               row_block=IDENT_ROW_BLOCK):
+    """Returns a condensed matrix (see condensed_index) of pairwise
+    identities between all sequences of aln (bioutils.Alignment), as
+    defined by
+    pairwise_identity() (after uppercasing).
+
+    The alignment is encoded once (see encode_aln) and identities
+    are computed in tiles of row_block x row_block sequences (upper
+    triangle only). If num_workers>1 the tiles are distributed over
+    a process pool, which works on a memory-mapped copy of the
+    encoded alignment and writes directly into a memory-mapped
+    condensed matrix.
+    """
+
+    nseqs = len(aln)
+    npairs = nseqs*(nseqs-1)//2
+    tmp_dir = None
+    if num_workers > 1:
+        tmp_dir = tempfile.mkdtemp(prefix="seqstat-")
+        enc_fname = os.path.join(tmp_dir, "aln.u8")
+        cmx_fname = os.path.join(tmp_dir, "pwid.cmx")
+        (enc_mx, gap_mx) = encode_aln(aln, enc_fname)
+        cmx = numpy.memmap(cmx_fname, dtype=dtype, mode='w+',
+                           shape=(npairs,))
+        # smaller tiles to keep all workers busy
+        row_block = max(1, min(row_block, nseqs//(2*num_workers)))
+    else:
+        (enc_mx, gap_mx) = encode_aln(aln)
+        cmx = numpy.empty(npairs, dtype=dtype)
+
+    try:
+        ungapped_lens = enc_mx.shape[1] - gap_mx.sum(axis=1)
+        check_ungapped_lens(ungapped_lens, aln.ids)
+        residues = [r for r in numpy.unique(enc_mx) if r != 0]
+        del gap_mx
+        tiles = []
+        for i in xrange(0, nseqs, row_block):
+            rows = slice(i, min(i+row_block, nseqs))
+            for j in xrange(i, nseqs, row_block):
+                cols = slice(j, min(j+row_block, nseqs))
+                tiles.append((rows, cols))
+
+        if num_workers > 1:
+            LOG.info("Computing %d identity tiles with %d workers" % (
+                len(tiles), num_workers))
+            pool = multiprocessing.Pool(num_workers)
+            try:
+                for _ in pool.imap_unordered(
+                        _ident_tile_worker,
+                        [(enc_fname, enc_mx.shape, cmx_fname, cmx.dtype,
+                          ungapped_lens, rows, cols, residues)
+                         for (rows, cols) in tiles]):
+                    pass
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            for (rows, cols) in tiles:
+                ident_tile_to_condensed(enc_mx, ungapped_lens, rows, cols,
+                                        residues, cmx)
+    finally:
+        if tmp_dir:
+            # mappings stay valid after unlinking
+            shutil.rmtree(tmp_dir)
+
+    return cmx
+
+
+
+def sample_pairs(nseqs, num_pairs, rng):
+    """Returns two index arrays (i<j) for num_pairs pairs of
+    sequences drawn uniformly without replacement from all
+    nseqs*(nseqs-1)/2 pairs, using random.Random instance rng.
+    """
+
+    npairs = nseqs*(nseqs-1)//2
+    num_pairs = min(num_pairs, npairs)
+    # condensed indices, converted back to row and column
+    k = numpy.array(sorted(rng.sample(xrange(npairs), num_pairs)),
+                    dtype=numpy.int64)
+    i = nseqs - 2 - numpy.floor(
+        numpy.sqrt(-8*k + 4*nseqs*(nseqs-1) - 7)/2.0 - 0.5).astype(numpy.int64)
+    j = k + i + 1 - npairs + (nseqs-i)*(nseqs-i-1)//2
+    return (i, j)
+
+
+
+def pairs_identity(enc_mx, ungapped_lens, i, j, batch_size=PAIRS_BATCH):
+    """Returns pairwise identities (as in pairwise_identity()) for
+    the sequence pairs given as index arrays i and j into enc_mx (as
+    returned by encode_aln), computed batch_size pairs at a time.
+    """
+
+    idents = numpy.empty(len(i), dtype=numpy.int64)
+    for start in xrange(0, len(i), batch_size):
+        end = start+batch_size
+        s1 = enc_mx[i[start:end]]
+        s2 = enc_mx[j[start:end]]
+        # gaps are encoded as 0
+        idents[start:end] = ((s1 == s2) & (s1 != 0)).sum(axis=1)
+    min_ungapped_lens = numpy.minimum(ungapped_lens[i], ungapped_lens[j])
+    return idents / min_ungapped_lens.astype(numpy.float64)
+
+
+
+def sampled_ident_stats(pw_ids, npairs, z=1.96):
+    """Returns mean and standard deviation of sampled pairwise
+    identities pw_ids plus their (normal approximation) confidence
+    intervals as (low, high) tuples. npairs is the total number of
+    pairs the sample was drawn from (used for the finite population
+    correction).
+    """
+
+    n = len(pw_ids)
+    mean = pw_ids.mean()
+    std = pw_ids.std()
+    if n < 2:
+        return (mean, (mean, mean), std, (std, std))
+    fpc = sqrt((npairs-n)/float(npairs-1))
+    mean_err = z * pw_ids.std(ddof=1)/sqrt(n) * fpc
+    std_err = z * std/sqrt(2*(n-1)) * fpc
+    return (mean, (mean-mean_err, mean+mean_err),
+            std, (max(0.0, std-std_err), std+std_err))
+
+
+
+def minhash_sketch(enc_seq, kmer_len, sketch_size=SKETCH_SIZE):
+    """Returns a one-permutation MinHash sketch (uint64 array of
+    length sketch_size, a power of two) of the k-mers in encoded
+    sequence enc_seq (gaps, encoded as 0, are removed first). Empty
+    bins are set to SKETCH_EMPTY.
+    """
+
+    res = enc_seq[enc_seq != 0].astype(numpy.uint64)
+    sketch = numpy.empty(sketch_size, dtype=numpy.uint64)
+    sketch.fill(SKETCH_EMPTY)
+    nkmers = len(res) - kmer_len + 1
+    if nkmers < 1:
+        return sketch
+
+    # polynomial k-mer hash, wrapping around at 2**64
+    hashes = numpy.zeros(nkmers, dtype=numpy.uint64)
+    for t in xrange(kmer_len):
+        hashes = hashes * numpy.uint64(1099511628211) + res[t:t+nkmers]
+    # splitmix64 finalizer to spread bits
+    hashes ^= hashes >> numpy.uint64(30)
+    hashes *= numpy.uint64(0xbf58476d1ce4e5b9)
+    hashes ^= hashes >> numpy.uint64(27)
+    hashes *= numpy.uint64(0x94d049bb133111eb)
+    hashes ^= hashes >> numpy.uint64(31)
+
+    # bin by top bits and keep minimum per bin
+    hashes.sort()
+    shift = numpy.uint64(64 - int(sketch_size).bit_length() + 1)
+    (bins, first) = numpy.unique(hashes >> shift, return_index=True)
+    sketch[bins.astype(numpy.int64)] = hashes[first]
+    return sketch
+
+
+
+def sketch_candidate_pairs(sketches, num_bands=SKETCH_BANDS,
+                           max_bucket=SKETCH_MAX_BUCKET):
+    """Returns index arrays (i<j) of candidate pairs of similar
+    sequences, i.e. those which share all sketch values in at least
+    one band (locality sensitive hashing). Members of buckets larger
+    than max_bucket (i.e. many near-identical sequences) are only
+    paired with their max_bucket neighbours in the bucket.
+    """
+
+    (nseqs, sketch_size) = sketches.shape
+    rows_per_band = sketch_size // num_bands
+    pair_keys = set()
+    for b in xrange(num_bands):
+        band = sketches[:, b*rows_per_band:(b+1)*rows_per_band]
+        valid = ~(band == SKETCH_EMPTY).any(axis=1)
+        buckets = dict()
+        for i in numpy.flatnonzero(valid):
+            buckets.setdefault(band[i].tostring(), []).append(i)
+        for members in buckets.itervalues():
+            for (p, i) in enumerate(members):
+                for j in members[p+1:p+1+max_bucket]:
+                    pair_keys.add(i*nseqs + j)
+    pair_keys = numpy.array(sorted(pair_keys), dtype=numpy.int64)
+    return (pair_keys // nseqs, pair_keys % nseqs)
+
+
+
+def sketch_partners(enc_mx, ungapped_lens, kmer_len, rng):
+    """Returns the most related and most unrelated partner for each
+    sequence in enc_mx (as returned by encode_aln) without computing
+    all pairwise identities, as four arrays: max_idx, max_val,
+    min_idx, min_val. Results are identical to the exact version.
+
+    Sketches are only used to rank candidates: identities are first
+    computed for similar pairs found via MinHash sketches (see
+    sketch_candidate_pairs), pairs with the SKETCH_NUM_OUTLIERS
+    sequences with lowest average sketch similarity to a random
+    sample (likely most unrelated partners) plus
+    SKETCH_RANDOM_PARTNERS random partners per sequence. These are
+    then confirmed by confirm_partners().
+    """
+
+    nseqs = enc_mx.shape[0]
+    sketches = numpy.vstack([minhash_sketch(enc_mx[i], kmer_len)
+                             for i in xrange(nseqs)])
+    (cand_i, cand_j) = sketch_candidate_pairs(sketches)
+    LOG.info("Found %d candidate pairs via sketches" % len(cand_i))
+
+    refs = numpy.array(rng.sample(xrange(nseqs), min(nseqs, SKETCH_NUM_REFS)))
+    avg_sim = numpy.empty(nseqs)
+    for start in xrange(0, nseqs, PAIRS_BATCH):
+        block = sketches[start:start+PAIRS_BATCH]
+        avg_sim[start:start+PAIRS_BATCH] = (
+            block[:, None, :] == sketches[refs][None, :, :]).mean(axis=2).mean(axis=1)
+    outliers = numpy.argsort(avg_sim, kind='mergesort')[:SKETCH_NUM_OUTLIERS]
+
+    all_i = [cand_i, numpy.repeat(numpy.arange(nseqs), len(outliers)),
+             numpy.repeat(numpy.arange(nseqs), SKETCH_RANDOM_PARTNERS)]
+    all_j = [cand_j, numpy.tile(outliers, nseqs),
+             numpy.array([rng.randrange(nseqs)
+                          for _ in xrange(nseqs*SKETCH_RANDOM_PARTNERS)],
+                         dtype=numpy.int64)]
+    (all_i, all_j) = (numpy.concatenate(all_i), numpy.concatenate(all_j))
+    keep = all_i != all_j
+    pair_keys = numpy.unique(numpy.minimum(all_i[keep], all_j[keep]) * nseqs
+                             + numpy.maximum(all_i[keep], all_j[keep]))
+    (pi, pj) = (pair_keys // nseqs, pair_keys % nseqs)
+    pw_ids = pairs_identity(enc_mx, ungapped_lens, pi, pj)
+    LOG.info("Computed identities for %d pairs" % len(pw_ids))
+
+    # both directions. lexsort: last key is primary. ties resolved
+    # by lowest partner index as in the exact version
+    (idx, partner) = (numpy.concatenate([pi, pj]), numpy.concatenate([pj, pi]))
+    vals = numpy.concatenate([pw_ids, pw_ids])
+    max_idx = numpy.zeros(nseqs, dtype=numpy.int64)
+    max_val = numpy.zeros(nseqs)
+    min_idx = numpy.zeros(nseqs, dtype=numpy.int64)
+    # valid bounds for sequences without candidates
+    min_val = numpy.ones(nseqs)
+    for (sign, res_idx, res_val) in [(-1, max_idx, max_val),
+                                     (1, min_idx, min_val)]:
+        order = numpy.lexsort((partner, sign*vals, idx))
+        first = order[numpy.r_[True, idx[order][1:] != idx[order][:-1]]]
+        res_idx[idx[first]] = partner[first]
+        res_val[idx[first]] = vals[first]
+    return confirm_partners(enc_mx, ungapped_lens, rng,
+                            max_idx, max_val, min_idx, min_val)
+
+
+
+def confirm_partners(enc_mx, ungapped_lens, rng,
+                     max_idx, max_val, min_idx, min_val, eps=1e-9):
+    """Turns candidate most related and most unrelated partners (as
+    returned by sketch_partners) into exact ones, i.e. what argmax
+    and argmin over all pairwise identities give (ties resolved by
+    lowest partner index).
+
+    Mismatches (gaps included) between aligned sequences form a
+    metric, so distances to SKETCH_NUM_PIVOTS random pivots give
+    lower and upper bounds for the number of identical residues of
+    any pair. Identities are only computed for partners whose bounds
+    do not rule them out, i.e. which could be at least as similar
+    (dissimilar) as the candidate partner. Work is therefore small
+    if candidates are good, but never worse than computing all pairs.
     """
-    nseqs = len(seqrecs)
 
-    # intentionally a list, not a matrix, because numpy doesn't know
-    # about symmetric arrays
-    mx = []
+    (nseqs, aln_len) = enc_mx.shape
+    gap_lens = aln_len - ungapped_lens
+    pivots = rng.sample(xrange(nseqs), min(nseqs, SKETCH_NUM_PIVOTS))
+    piv_dist = numpy.empty((nseqs, len(pivots)), dtype=numpy.int64)
+    for start in xrange(0, nseqs, PAIRS_BATCH):
+        block = enc_mx[start:start+PAIRS_BATCH]
+        for (k, p) in enumerate(pivots):
+            piv_dist[start:start+PAIRS_BATCH, k] = (
+                block != enc_mx[p]).sum(axis=1)
+    # range queries on the first pivot, the others only filter
+    order = numpy.argsort(piv_dist[:, 0], kind='mergesort')
+    sorted_dist = piv_dist[order, 0]
+    min_len = ungapped_lens.min()
+
+    num_checked = 0
     for i in xrange(nseqs):
-        jdists = []
-        for j in xrange(0, i):
-            s1 = str(seqrecs[i].seq).upper()
-            s2 = str(seqrecs[j].seq).upper()
-            pwid = pairwise_identity(s1, s2)
-            jdists.append(pwid)
-
-            if False:
-                # tmp hack dna dist
-                dist = sum(c1 != c2
-                         for c1, c2 in izip(s1, s2)
-                         if not bioutils.isgap(c1) and not bioutils.isgap(c2))
-                print "TMP: dist %s vs %s: %d" % (seqrecs[i].id, seqrecs[j].id, dist)
-
-        jdists.append(None) # self comparison not defined
-        mx.append(jdists)
-    return mx
-    
+        for find_max in [True, False]:
+            if find_max:
+                # idents <= aln_len - mismatches - both gapped
+                radius = aln_len - max_val[i]*min_len + eps
+                lo = numpy.searchsorted(sorted_dist, piv_dist[i, 0]-radius,
+                                        side='left')
+                hi = numpy.searchsorted(sorted_dist, piv_dist[i, 0]+radius,
+                                        side='right')
+            else:
+                # idents >= aln_len - mismatches - min(gap lengths)
+                thresh = ungapped_lens[i]*(1.0-min_val[i]) - piv_dist[i, 0] - eps
+                (lo, hi) = (numpy.searchsorted(sorted_dist, thresh,
+                                               side='left'), nseqs)
+            cand = numpy.sort(order[lo:hi])
+            cand = cand[cand != i]
+            if not len(cand):
+                continue
+            pair_len = numpy.minimum(ungapped_lens[i], ungapped_lens[cand])
+            if find_max:
+                dist_lb = numpy.abs(piv_dist[cand] - piv_dist[i]).max(axis=1)
+                both_gap_lb = numpy.maximum(
+                    0, gap_lens[cand] + gap_lens[i] - aln_len)
+                bound = aln_len - dist_lb - both_gap_lb
+                cand = cand[bound >= max_val[i]*pair_len - eps]
+            else:
+                dist_ub = (piv_dist[cand] + piv_dist[i]).min(axis=1)
+                both_gap_ub = numpy.minimum(gap_lens[cand], gap_lens[i])
+                bound = aln_len - dist_ub - both_gap_ub
+                cand = cand[bound <= min_val[i]*pair_len + eps]
+            if not len(cand):
+                continue
+            pw_ids = pairs_identity(enc_mx, ungapped_lens,
+                                    numpy.repeat(i, len(cand)), cand)
+            num_checked += len(cand)
+            if find_max:
+                best = numpy.argmax(pw_ids)
+                (max_idx[i], max_val[i]) = (cand[best], pw_ids[best])
+            else:
+                best = numpy.argmin(pw_ids)
+                (min_idx[i], min_val[i]) = (cand[best], pw_ids[best])
+    LOG.info("Confirmed partners with %d identity computations" % num_checked)
+    return (max_idx, max_val, min_idx, min_val)
+
+
+
+class SeqStats(object):
+    """Single pass accumulator of (unaligned) sequence statistics.
+
+    Memory usage is constant apart from the sets of ids and sequence
+    digests used for counting unique names and sequences. Sequences
+    are only kept if keep_seqs is True and only as long as they could
+    still be aligned (i.e. have all the same length), since they are
+    only needed for identity computation (see aln()). They are kept
+    in one byte buffer. Id and ungapped length of each sequence are
+    kept only if keep_info is True.
+    """
+
+    def __init__(self, keep_seqs=True, keep_info=False):
+        """
+        """
+        self.nseqs = 0
+        self.min_len = None
+        self.max_len = None
+        self.sum_len = 0
+        # length including gaps of first seq and whether all others
+        # had the same length
+        self.aln_len = None
+        self.same_len = True
+        self.has_gaps = False
+        self.first_seq = None
+        self.ids = set()
+        self.seq_digests = set()
+
+        self.keep_seqs = keep_seqs
+        self.seq_buf = bytearray()
+        self.seq_ids = []
+        self.keep_info = keep_info
+        self.info = []
+
+
+    def add(self, seqid, seqstr):
+        """Add a sequence (given as id and string)
+        """
+
+        seqlen = len(seqstr)
+        ungapped_len = len(bioutils.ungap(seqstr))
+
+        if self.nseqs == 0:
+            self.first_seq = seqstr
+            self.aln_len = seqlen
+            self.min_len = self.max_len = ungapped_len
+        else:
+            self.min_len = min(self.min_len, ungapped_len)
+            self.max_len = max(self.max_len, ungapped_len)
+            if self.same_len and seqlen != self.aln_len:
+                self.same_len = False
+                # not aligned: no need to keep them
+                self.seq_buf = bytearray()
+                self.seq_ids = []
+        self.nseqs += 1
+        self.sum_len += ungapped_len
+        if ungapped_len != seqlen:
+            self.has_gaps = True
+
+        self.ids.add(seqid)
+        self.seq_digests.add(hashlib.md5(seqstr).digest())
+        if self.keep_seqs and self.same_len:
+            self.seq_buf.extend(seqstr)
+            self.seq_ids.append(seqid)
+        if self.keep_info:
+            self.info.append((seqid, ungapped_len))
+
+
+    def merge(self, other):
+        """Merge statistics of other, which covers sequences
+        following ours (e.g. the next chunk of the same file)
+        """
+
+        if other.nseqs == 0:
+            return
+        if self.nseqs == 0:
+            self.first_seq = other.first_seq
+            self.aln_len = other.aln_len
+            self.min_len = other.min_len
+            self.max_len = other.max_len
+        else:
+            self.min_len = min(self.min_len, other.min_len)
+            self.max_len = max(self.max_len, other.max_len)
+        if self.same_len and (
+                not other.same_len or other.aln_len != self.aln_len):
+            self.same_len = False
+            self.seq_buf = bytearray()
+            self.seq_ids = []
+        self.nseqs += other.nseqs
+        self.sum_len += other.sum_len
+        self.has_gaps = self.has_gaps or other.has_gaps
+
+        self.ids.update(other.ids)
+        self.seq_digests.update(other.seq_digests)
+        if self.keep_seqs and self.same_len:
+            self.seq_buf.extend(other.seq_buf)
+            self.seq_ids.extend(other.seq_ids)
+        if self.keep_info:
+            self.info.extend(other.info)
+
+
+    def aligned(self):
+        """Sequences are considered aligned if there is more than one
+        and all have the same length
+        """
+        return self.nseqs > 1 and self.same_len
+
+
+    def aln(self):
+        """Returns kept sequences as bioutils.Alignment (or None if
+        no sequences were kept) and releases them
+        """
+        if not self.seq_ids:
+            return None
+        aln = bioutils.Alignment(
+            self.seq_ids, numpy.frombuffer(self.seq_buf, dtype=numpy.uint8).reshape(
+                len(self.seq_ids), self.aln_len))
+        self.seq_buf = bytearray()
+        self.seq_ids = []
+        return aln
+
+
+
+def chunk_stats(records, keep_info):
+    """Statistics of one chunk of records (in streaming mode). Used as
+    worker function for parallel parsing of bgzip files
+    """
+    stats = SeqStats(keep_seqs=False, keep_info=keep_info)
+    for rec in records:
+        stats.add(rec[0], rec[2])
+    return stats
+
 
 
 def cmdline_parser():
@@ -207,6 +809,39 @@ def cmdline_parser():
     parser.add_option("-f", "--infmt",
                       dest="informat",
                       help="Input format (must be supported by Biopython)")
+    parser.add_option("-w", "--workers",
+                      dest="num_workers",
+                      type="int",
+                      default=1,
+                      help="Number of worker processes for computing"
+                      " pairwise identities (>1 stores them with single"
+                      " precision) and, in streaming mode, for parsing"
+                      " uncompressed or bgzip compressed fasta/fastq"
+                      " chunk-parallel"
+                      " (default=1)")
+    parser.add_option("-s", "--stream",
+                      action="store_true",
+                      dest="stream",
+                      help="Streaming mode: never keep sequences in"
+                      " memory (skips identity computation for aligned"
+                      " sequences)")
+    parser.add_option("", "--sample-pairs",
+                      dest="sample_pairs",
+                      type="int",
+                      help="Approximate mode: estimate identity statistics"
+                      " from this many random pairs of aligned sequences"
+                      " (default for --nn-sketch: %d)" % DEFAULT_SAMPLE_PAIRS)
+    parser.add_option("", "--nn-sketch",
+                      action="store_true",
+                      dest="nn_sketch",
+                      help="Approximate mode, but find exact most related"
+                      " and unrelated partner per sequence (-a) using"
+                      " k-mer sketches and distance bounds instead of"
+                      " all pairs")
+    parser.add_option("", "--seed",
+                      dest="seed",
+                      type="int",
+                      help="Random seed for approximate mode")
     return parser
 
 
@@ -227,13 +862,15 @@ def main():
     if len(args) != 1:
         parser.error("Need sequence file as input argument")
         sys.exit(1)
+    if opts.num_workers < 1:
+        parser.error("Number of workers must be at least 1")
+        sys.exit(1)
+    if opts.sample_pairs is not None and opts.sample_pairs < 1:
+        parser.error("Number of pairs to sample must be at least 1")
+        sys.exit(1)
 
         
     fseq = args[0]
-    if fseq == "-":
-        fhandle = sys.stdin
-    else:
-        fhandle = open(fseq, "rU")
 
 
     fmt = opts.informat
@@ -241,105 +878,170 @@ def main():
         fmt = bioutils.guess_seqformat(fseq)
 
 
-    seqrecs = []
-    seqlens = []
-    seqlens_ungapped = []
-    
-    # read all into memory: makes id computation easier. the file
-    # might come from stdin so we can't read twice
-    for seqrec in SeqIO.parse(fhandle, fmt):
-        seqrecs.append(seqrec)
-        seqlens.append(len(seqrec.seq))
-        seqlens_ungapped.append(len(bioutils.ungap(str(seqrec.seq))))
-    if fhandle != sys.stdin:
+    # single pass, since the file might come from stdin so we can't
+    # read twice. sequences are only kept if needed for identity
+    # computation
+    stats = SeqStats(keep_seqs=not opts.stream,
+                     keep_info=opts.info_for_all)
+    if opts.stream and opts.num_workers > 1 \
+      and fmt in ['fasta', 'fastq'] and bioutils.is_chunkable(fseq):
+        LOG.info("Parsing %s in parallel with %d processes" % (
+            fseq, opts.num_workers))
+        for other in bioutils.fastx_parallel_map(
+                fseq, fmt, chunk_stats, (opts.info_for_all,),
+                num_workers=opts.num_workers):
+            stats.merge(other)
+    else:
+        # transparently decompresses
+        fhandle = bioutils.xopen(fseq)
+        if fmt in ['fasta', 'fastq']:
+            # fast path: no SeqRecord construction
+            for rec in bioutils.read_fastx(fhandle, fmt):
+                stats.add(rec[0], rec[2])
+        else:
+            for seqrec in SeqIO.parse(fhandle, fmt):
+                stats.add(seqrec.id, str(seqrec.seq))
         fhandle.close()
             
-    nseqs = len(seqlens)        
+    nseqs = stats.nseqs
     if nseqs == 0:
         LOG.warn('No sequences found. Try changing the format (just tried: %s)' % fmt)
         sys.exit(0)
 
     
-    aligned = False
-    if nseqs > 1 and len(set(seqlens)) == 1:
+    # guess type from first entry
+    if guess_if_nucleic_acid(stats.first_seq):
+        seqtype = 'protein' 
+    else:
+        seqtype = 'nucleic'
+
+    aligned = stats.aligned()
+    approx = opts.sample_pairs or opts.nn_sketch
+    if aligned and opts.stream:
+        LOG.warn("Sequences seem to be aligned, but identities are not"
+                 " computed in streaming mode")
+    elif aligned and approx:
+        rng = random.Random(opts.seed)
+        aln = stats.aln()
+        (enc_mx, gap_mx) = encode_aln(aln)
+        ungapped_lens = enc_mx.shape[1] - gap_mx.sum(axis=1)
+        del gap_mx
+        try:
+            check_ungapped_lens(ungapped_lens, aln.ids)
+        except ValueError as err:
+            LOG.fatal("%s" % err)
+            sys.exit(1)
+        npairs = nseqs*(nseqs-1)//2
+        (sample_i, sample_j) = sample_pairs(
+            nseqs, opts.sample_pairs or DEFAULT_SAMPLE_PAIRS, rng)
+        sampled_pw_ids = pairs_identity(
+            enc_mx, ungapped_lens, sample_i, sample_j)
+        if opts.nn_sketch and opts.info_for_all:
+            partners = sketch_partners(enc_mx, ungapped_lens,
+                                       SKETCH_KMER_LEN[seqtype], rng)
+    elif aligned:
         # add and len(set(seqlens_ungapped)) != 1 to make sure
         # unaligend sequence length are identical
-        aligned = True
-        aln_len = seqlens[0] # any will do as we know they're aligned
-        pw_id_mx = comp_pairwise_ident_matrix(seqrecs)
+        if opts.num_workers > 1:
+            pw_id_dtype = numpy.float32
+        else:
+            pw_id_dtype = numpy.float64
+        try:
+            pw_id_mx = comp_pairwise_ident_matrix(
+                stats.aln(), opts.num_workers, pw_id_dtype)
+        except ValueError as err:
+            LOG.fatal("%s" % err)
+            sys.exit(1)
 
-    if not aligned and seqlens != seqlens_ungapped:
+    if not aligned and stats.has_gaps:
         LOG.warn("Found gaps, but sequences do not seem to be aligned."
                  " Stats will be for ungapped seqs.")
          
-    # guess type from first entry
-    if guess_if_nucleic_acid(seqrecs[0].seq):
-        seqtype = 'protein' 
-    else:
-        seqtype = 'nucleic'
     print "Type (of 1st seq):   %s" % (seqtype)
 
     print "Number of sequences: %d" % (nseqs)        
     print "Smallest:            %d" % (
-        min(seqlens_ungapped))
+        stats.min_len)
     print "Largest:             %d" % (
-        max(seqlens_ungapped))
+        stats.max_len)
     print "Average length:      %.1f" % (
-        sum(seqlens_ungapped)/float(len(seqlens_ungapped)))
+        stats.sum_len/float(nseqs))
     #print "Format:              %s" % (fmt)
     
     print "Aligned:             %s" % ("yes" if aligned else "no")
-    if aligned:
-        # make sure to ignore self-comparison None's
-        flat_pw_id_mx = [x for x in chain.from_iterable(pw_id_mx) if x]
-        print "Alignment length:    %d" % (aln_len)        
-        (mean, std) = meanstd(flat_pw_id_mx)
+    compute_ids = aligned and not opts.stream
+    if compute_ids and approx:
+        print "Alignment length:    %d" % (stats.aln_len)
+        (mean, mean_ci, std, std_ci) = sampled_ident_stats(
+            sampled_pw_ids, npairs)
+        print "Average identity:    %0.2f (95%% CI %0.2f-%0.2f, %d of %d pairs sampled)" % (
+            mean, mean_ci[0], mean_ci[1], len(sampled_pw_ids), npairs)
+        print "Standard deviation:  %0.2f (95%% CI %0.2f-%0.2f)" % (
+            std, std_ci[0], std_ci[1])
+        if opts.nn_sketch and opts.info_for_all:
+            # exact: extremes over all best partners
+            print "Most related pair:   %0.2f" % (
+                partners[1].max())
+            print "Most unrelated pair: %0.2f" % (
+                partners[3].min())
+        else:
+            print "Most related pair:   %0.2f (sampled)" % (
+                sampled_pw_ids.max())
+            print "Most unrelated pair: %0.2f (sampled)" % (
+                sampled_pw_ids.min())
+    elif compute_ids:
+        # condensed matrix: no self-comparisons
+        print "Alignment length:    %d" % (stats.aln_len)
+        (mean, std) = (pw_id_mx.mean(dtype=numpy.float64),
+                       pw_id_mx.std(dtype=numpy.float64))
         print "Average identity:    %0.2f" % (
             mean)
         print "Standard deviation:  %0.2f" % (
             std)
         print "Most related pair:   %0.2f" % (
-            max(flat_pw_id_mx))
+            pw_id_mx.max())
         print "Most unrelated pair: %0.2f" % (
-            min(flat_pw_id_mx))
+            pw_id_mx.min())
     
     if opts.info_for_all:
         # spacer
         print ""
         
         header = "# Name\tLength"
-        if aligned:
+        if compute_ids and approx and not opts.nn_sketch:
+            LOG.warn("Not reporting partners per sequence in sampling"
+                     " mode (use sketches for that)")
+            compute_ids = False
+        if compute_ids:
             header += "\thigh-id to\tlow-id to"
         print header
         
-        for (i, seqrec) in enumerate(seqrecs):
+        for (i, (seqid, ungapped_len)) in enumerate(stats.info):
             line = "%s\t%d" % (
-                seqrec.id, seqlens_ungapped[i])
+                seqid, ungapped_len)
             
-            if aligned:
-                # construct list of pairwise ids from fake matrix. 
-                pw_ids = pw_id_mx[i]
-                pw_ids.extend([pw_id_mx[j][i] 
-                               for j in xrange(i+1, nseqs)])
-                assert len(pw_ids) == nseqs, (
-                    "len(pw_ids)=%d, but expected %d" % (len(pw_ids), nseqs))
-
+            if compute_ids and approx:
+                (max_idx, max_val, min_idx, min_val) = [
+                    p[i] for p in partners]
+                line += "\t%.4f\t%s\t%.4f\t%s" % (
+                    max_val, stats.info[max_idx][0],
+                    min_val, stats.info[min_idx][0])
+            elif compute_ids:
                 # Find min and max and corresponding partner index,
-                # but take care to ignore self-comparison value 'None'
+                # but take care to ignore self-comparison value
+                pw_ids = condensed_row(pw_id_mx, nseqs, i)
                 pw_ids[i] = -1.0
-                (pw_id_max_idx, pw_id_max_val) = argminmax(pw_ids, 'max')
+                pw_id_max_idx = pw_ids.argmax()
                 pw_ids[i] = 1.1
-                (pw_id_min_idx, pw_id_min_val) = argminmax(pw_ids, 'min')
-                pw_ids[i] = None # reset even though not strictly necessary
+                pw_id_min_idx = pw_ids.argmin()
 
                 line += "\t%.4f\t%s\t%.4f\t%s" % (
-                    pw_id_max_val, seqrecs[pw_id_max_idx].id,
-                    pw_id_min_val, seqrecs[pw_id_min_idx].id)
+                    pw_ids[pw_id_max_idx], stats.info[pw_id_max_idx][0],
+                    pw_ids[pw_id_min_idx], stats.info[pw_id_min_idx][0])
             print line
 
     print "%d names are unique and %d sequences are unique (including gaps)." % (
-        len(set([s.id for s in seqrecs])),
-        len(set([str(s.seq) for s in seqrecs])))
+        len(stats.ids), len(stats.seq_digests))
 
             
 
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""Tests for bioutils.Alignment, output is read back with Biopython
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+#--- third-party imports
+#
+import numpy
+from Bio import AlignIO
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+
+
+
+# our formats and the Biopython parser reading them
+BIO_FORMATS = dict(fasta='fasta', phylip='phylip-relaxed',
+                   stockholm='stockholm', clustal='clustal')
+
+
+
+class TestAlignmentWrite(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        nseqs = 23
+        aln_len = 151
+        seqs = [''.join(rng.choice('ACGTacgtN-.~') for _ in xrange(aln_len))
+                for _ in xrange(nseqs)]
+        ids = ['seq%d' % i for i in xrange(nseqs)]
+        ids[3] = 'a_much_longer_sequence_id'
+        mx = numpy.vstack([numpy.frombuffer(s, dtype=numpy.uint8)
+                           for s in seqs])
+        self.aln = bioutils.Alignment(
+            ids, mx, ['%s descr %d' % (sid, i) for (i, sid) in enumerate(ids)])
+        self.seqs = seqs
+
+    def expected(self, fmt, rows, cols):
+        row_idx = numpy.arange(len(self.aln))
+        if rows is not None:
+            row_idx = row_idx[rows]
+        col_idx = numpy.arange(self.aln.get_alignment_length())
+        if cols is not None:
+            col_idx = col_idx[cols]
+        expected = []
+        for i in row_idx:
+            seq = ''.join(self.seqs[i][j] for j in col_idx)
+            # we write all gaps as '-' for phylip, Biopython reads
+            # '.' as '-' for stockholm
+            if fmt == 'phylip':
+                seq = seq.replace('.', '-').replace('~', '-')
+            elif fmt == 'stockholm':
+                seq = seq.replace('.', '-')
+            expected.append((self.aln.ids[i], seq))
+        return expected
+
+    def test_round_trip(self):
+        selections = [(None, None), (slice(2, 20), None),
+                      (None, numpy.array([0, 5, 6, 100, 150])),
+                      (numpy.array([3, 0, 7]), slice(10, 140))]
+        for fmt in bioutils.ALN_WRITE_FORMATS:
+            for (rows, cols) in selections:
+                fh = StringIO()
+                self.aln.write(fh, fmt, rows=rows, cols=cols)
+                bio_aln = AlignIO.read(StringIO(fh.getvalue()),
+                                       BIO_FORMATS[fmt])
+                self.assertEqual([(r.id, str(r.seq)) for r in bio_aln],
+                                 self.expected(fmt, rows, cols),
+                                 (fmt, rows, cols))
+
+    def test_fasta_descriptions(self):
+        for line_width in [None, 60]:
+            fh = StringIO()
+            self.aln.write_fasta(fh, line_width=line_width)
+            aln = bioutils.Alignment.read_fasta(StringIO(fh.getvalue()))
+            self.assertEqual(aln.descriptions, self.aln.descriptions)
+            self.assertTrue((aln.mx == self.aln.mx).all())
+
+    def test_access(self):
+        for i in [0, 3, 22]:
+            self.assertEqual(self.aln.seq(i), self.seqs[i])
+            self.assertEqual(self.aln.row(i).tostring(), self.seqs[i])
+        for j in [0, 100, 150]:
+            self.assertEqual(self.aln.col(j).tostring(),
+                             ''.join(s[j] for s in self.seqs))
+        gaps = self.aln.gap_mask()
+        for (i, seq) in enumerate(self.seqs):
+            self.assertEqual(list(gaps[i]),
+                             [bioutils.isgap(c) for c in seq])
+
+    def test_read_fasta_memmap(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            fh = StringIO()
+            self.aln.write_fasta(fh)
+            aln = bioutils.Alignment.read_fasta(
+                StringIO(fh.getvalue()), os.path.join(tmp_dir, 'mx'),
+                upper=True)
+            self.assertEqual([aln.seq(i) for i in xrange(len(aln))],
+                             [s.upper() for s in self.seqs])
+            self.assertEqual(aln.ids, self.aln.ids)
+            del aln
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_unequal_lengths(self):
+        self.assertRaises(ValueError, bioutils.Alignment.read_fasta,
+                          StringIO(">a\nAC\n>b\nA\n"))
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, self.aln.write, StringIO(), 'nexus')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""Tests for column profiles and scores in alnscore
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+import subprocess
+from math import log
+from collections import Counter
+
+#--- third-party imports
+#
+import numpy
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+import alnscore
+
+ALNSCORE = os.path.join(os.path.dirname(TEST_DIR), 'alnscore.py')
+
+
+
+def byte_matrix(rows):
+    return numpy.vstack([numpy.frombuffer(r, dtype=numpy.uint8)
+                         for r in rows])
+
+
+def shannon_entropy(l, b=2):
+    """Entropy as originally computed
+    """
+    return sum([-p*log(p, b) for p in l if p > 0])
+
+
+def seqid(colctr):
+    """Identity as originally computed
+    """
+    for (res, count) in colctr.most_common():
+        if res not in bioutils.GAP_CHARS:
+            return count/float(sum(colctr.values()))
+    return 0.0
+
+
+def baseline_output(rows, char_set):
+    """Output lines as originally produced by alnscore.py (with given
+    char_set)
+    """
+    lines = []
+    for i in xrange(len(rows[0])):
+        counter = Counter(''.join(r[i] for r in rows).upper())
+        denom = sum([counter[r] for r in char_set])
+        vec = [counter[r]/float(denom) for r in char_set]
+        counts_str = ' '.join(
+            ["%s:%d" % (k, v) for (k, v) in sorted(counter.iteritems())])
+        lines.append("%d %.6f %.6f %s" % (
+            i+1, seqid(counter), shannon_entropy(vec), counts_str))
+    return lines
+
+
+def random_rows(rng, nseqs, aln_len, chars, char_set):
+    """Random alignment rows with at least one residue of char_set per
+    column
+    """
+    rows = [[rng.choice(chars) for _ in xrange(aln_len)]
+            for _ in xrange(nseqs)]
+    for j in xrange(aln_len):
+        rows[rng.randrange(nseqs)][j] = rng.choice(char_set)
+    return [''.join(r) for r in rows]
+
+
+
+class TestColumnProfile(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.rows = random_rows(rng, 23, 300, 'ACGTNacgtnRX-.~', 'ACGTN')
+
+    def test_profile(self):
+        counts = alnscore.column_profile(byte_matrix(self.rows))
+        self.assertEqual(counts.shape, (256, 300))
+        for j in xrange(300):
+            counter = Counter(r[j] for r in self.rows)
+            expected = numpy.zeros(256, dtype=numpy.int64)
+            for (c, n) in counter.items():
+                expected[ord(c)] = n
+            self.assertTrue((counts[:, j] == expected).all())
+
+    def test_seqid_entropy(self):
+        upper = [r.upper() for r in self.rows]
+        counts = alnscore.column_profile(byte_matrix(upper))
+        seqids = alnscore.seqid_per_col(counts)
+        (ents, denoms) = alnscore.entropy_per_col(counts, 'ACGTN')
+        for j in xrange(300):
+            counter = Counter(r[j] for r in upper)
+            denom = sum([counter[c] for c in 'ACGTN'])
+            self.assertEqual(denoms[j], denom)
+            self.assertAlmostEqual(seqids[j], seqid(counter), 12)
+            self.assertAlmostEqual(ents[j], shannon_entropy(
+                [counter[c]/float(denom) for c in 'ACGTN']), 12)
+
+    def test_row_blocks(self):
+        mx = byte_matrix(self.rows)
+        seq_weights = numpy.arange(1, len(self.rows)+1) / 10.0
+        expected = [alnscore.column_profile(mx),
+                    alnscore.column_profile(mx, seq_weights)]
+        orig_block_size = alnscore.PROFILE_COUNT_BLOCK
+        alnscore.PROFILE_COUNT_BLOCK = 1000
+        try:
+            found = [alnscore.column_profile(mx),
+                     alnscore.column_profile(mx, seq_weights)]
+        finally:
+            alnscore.PROFILE_COUNT_BLOCK = orig_block_size
+        self.assertTrue((found[0] == expected[0]).all())
+        self.assertTrue(numpy.allclose(found[1], expected[1]))
+
+    def test_all_gap_column(self):
+        counts = alnscore.column_profile(byte_matrix(['A-', 'C.']))
+        self.assertEqual(list(alnscore.seqid_per_col(counts)), [0.5, 0.0])
+        (ents, denoms) = alnscore.entropy_per_col(counts, 'ACGTN')
+        self.assertEqual(list(denoms), [2, 0])
+        self.assertEqual(ents[0], 1.0)
+        self.assertTrue(numpy.isnan(ents[1]))
+
+
+
+class TestCmdline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test-alnscore-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_alnscore(self, rows, args):
+        fname = os.path.join(self.tmp_dir, "aln.fa")
+        with open(fname, 'w') as fh:
+            for (i, r) in enumerate(rows):
+                fh.write(">s%d\n%s\n" % (i, r))
+        proc = subprocess.Popen([sys.executable, ALNSCORE, '-i', fname] + args,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        return out
+
+    def test_dna(self):
+        rows = random_rows(random.Random(1), 31, 200,
+                           'ACGTNacgtn-.', 'ACGTN')
+        self.assertEqual(self.run_alnscore(rows, []).splitlines(),
+                         baseline_output(rows, 'ACGTN'))
+
+    def test_protein(self):
+        char_set = alnscore.ALPHABETS['protein']
+        rows = random_rows(random.Random(2), 31, 200,
+                           char_set + char_set.lower() + 'X-', char_set)
+        self.assertEqual(self.run_alnscore(rows, []).splitlines(),
+                         baseline_output(rows, char_set))
+
+    def test_low_mem(self):
+        # more than one block of columns
+        prot = alnscore.ALPHABETS['protein']
+        for (rows, char_set) in [
+                (random_rows(random.Random(3), 17, 2100,
+                             'ACGTNacgtn-.', 'ACGTN'), 'ACGTN'),
+                (random_rows(random.Random(4), 17, 2100,
+                             prot + prot.lower() + 'X-', prot), prot)]:
+            self.assertEqual(
+                self.run_alnscore(rows, ['--low-mem']).splitlines(),
+                baseline_output(rows, char_set))
+            args = ['-s', ','.join(sorted(alnscore.SCORERS)), '-w']
+            self.assertEqual(self.run_alnscore(rows, args + ['--low-mem']),
+                             self.run_alnscore(rows, args))
+
+
+
+class TestScores(unittest.TestCase):
+
+    def scores(self, scorer, rows, char_set):
+        return list(scorer(alnscore.column_profile(byte_matrix(rows)),
+                           char_set))
+
+    def test_sum_of_pairs(self):
+        # identity for nucleic acids: one of three pairs matches
+        found = self.scores(alnscore.score_sum_of_pairs,
+                            ['AA', 'A-', 'C-'], 'ACGTN')
+        self.assertAlmostEqual(found[0], 1/3.0, 12)
+        self.assertTrue(numpy.isnan(found[1]))
+        # BLOSUM62 for protein: A/A 4, A/W -3
+        found = self.scores(alnscore.score_sum_of_pairs,
+                            ['A', 'A', 'W'], alnscore.ALPHABETS['protein'])
+        self.assertAlmostEqual(found[0], (4 - 3 - 3)/3.0, 12)
+
+    def test_jsd(self):
+        # all A against uniform background, once with half gaps
+        found = self.scores(alnscore.score_jsd,
+                            ['AA', 'A-'], 'ACGTN')
+        jsd = 0.5 * (log(1/0.6, 2) + 0.2*log(1/3.0, 2) + 0.8)
+        self.assertAlmostEqual(found[0], jsd, 12)
+        self.assertAlmostEqual(found[1], jsd/2, 12)
+        # matching background
+        found = self.scores(alnscore.score_jsd,
+                            ['A', 'C', 'G', 'T', 'N'], 'ACGTN')
+        self.assertAlmostEqual(found[0], 0.0, 12)
+
+    def test_gap_entropy(self):
+        # any gap character counts as the same symbol
+        found = self.scores(alnscore.score_gap_entropy,
+                            ['AA', 'C-', '--', '.~'], 'ACGTN')
+        self.assertAlmostEqual(found[0], 1.5, 12)
+        self.assertAlmostEqual(found[1], shannon_entropy([0.25, 0.75]), 12)
+
+
+
+class TestHenikoffWeights(unittest.TestCase):
+
+    def test_known(self):
+        weights = alnscore.henikoff_weights(
+            byte_matrix(['AAAA', 'AAAA', 'AAAC']))
+        self.assertEqual(list(weights), [0.9375, 0.9375, 1.125])
+
+    def test_blocks(self):
+        rng = random.Random(5)
+        mx = byte_matrix(random_rows(rng, 19, 100, 'ACGT-', 'ACGT'))
+        expected = alnscore.henikoff_weights(mx)
+        self.assertAlmostEqual(expected.sum(), 19, 12)
+        orig_block_size = alnscore.PROFILE_COUNT_BLOCK
+        alnscore.PROFILE_COUNT_BLOCK = 50
+        try:
+            found = alnscore.henikoff_weights(mx, col_block=7)
+        finally:
+            alnscore.PROFILE_COUNT_BLOCK = orig_block_size
+        self.assertTrue(numpy.allclose(found, expected))
+
+    def test_gaps_only(self):
+        weights = alnscore.henikoff_weights(byte_matrix(['--', '.~']))
+        self.assertEqual(list(weights), [1.0, 1.0])
+
+
+
+class TestGuessAlphabet(unittest.TestCase):
+
+    def test_alphabets(self):
+        rng = random.Random(6)
+        prot = alnscore.ALPHABETS['protein']
+        for (chars, expected) in [('ACGT-', 'dna'), ('ACGTN-', 'dna'),
+                                  ('ACGU-', 'rna'), (prot + '-', 'protein'),
+                                  ('-.', 'dna')]:
+            mx = byte_matrix(random_rows(rng, 300, 50, chars, chars))
+            self.assertEqual(alnscore.guess_alphabet(mx), expected, chars)
+
+    def test_threshold(self):
+        # 5% non-nucleic residues are tolerated, 15% are not
+        self.assertEqual(alnscore.guess_alphabet(
+            byte_matrix(['ACGTACGTACGTACGTACGE'])), 'dna')
+        self.assertEqual(alnscore.guess_alphabet(
+            byte_matrix(['ACGTEEACGTACGTACGTAE'])), 'protein')
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""Tests for compressed input and output in bioutils
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import bz2
+import gzip
+import shutil
+import tempfile
+import unittest
+import subprocess
+from cStringIO import StringIO
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+
+
+# random-ish, partly compressible data spanning several BGZF blocks
+DATA = ''.join('>seq%d\n%s\n' % (i, 'ACGT'[i % 4] * (i % 97) + os.urandom(8).encode('hex'))
+               for i in range(20000))
+
+
+def run_python(code, stdin=None):
+    """Runs code in a python subprocess with bioutils importable and
+    returns (stdout, stderr, exit status)
+    """
+    proc = subprocess.Popen(
+        [sys.executable, '-c', 'import sys; sys.path.insert(0, %r); %s' % (
+            os.path.dirname(TEST_DIR), code)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    (out, err) = proc.communicate(stdin)
+    return (out, err, proc.returncode)
+
+
+def gunzip(data):
+    """Decompresses (multi-member) gzip data
+    """
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+
+def compress(data, compression):
+    """Returns data compressed with given compression (gzip, bgzip
+    or bz2)
+    """
+    if compression == 'bz2':
+        return bz2.compress(data)
+    (fd, fname) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        with bioutils.xopen_write(fname, compression,
+                                  use_external=False) as fh:
+            fh.write(data)
+        with open(fname, 'rb') as fh:
+            return fh.read()
+    finally:
+        os.unlink(fname)
+
+
+# reads stdin through xopen and reports decompression errors
+READ_STDIN = '''import bioutils
+fh = bioutils.xopen("-")
+data = fh.read()
+try:
+    fh.close()
+except IOError as err:
+    sys.stderr.write(str(err))
+    sys.exit(1)
+sys.stdout.write(data)
+'''
+
+
+
+class TestCompressedInput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_guess_compression(self):
+        for compression in ['gzip', 'bgzip', 'bz2']:
+            self.assertEqual(bioutils.guess_compression(
+                compress(DATA, compression)[:16]), compression)
+        self.assertEqual(bioutils.guess_compression(DATA[:16]), None)
+
+    def test_files(self):
+        for compression in ['gzip', 'bgzip', 'bz2']:
+            fname = os.path.join(self.tmp_dir, 'x')
+            # multi-member input
+            with open(fname, 'wb') as fh:
+                fh.write(compress(DATA, compression))
+                fh.write(compress(DATA[:1000], compression))
+            for use_external in [True, False]:
+                fh = bioutils.xopen(fname, use_external=use_external)
+                self.assertEqual(fh.read(), DATA + DATA[:1000])
+                fh.close()
+
+    def test_stdin(self):
+        for compression in [None, 'gzip', 'bgzip', 'bz2']:
+            data = compress(DATA, compression) if compression else DATA
+            (out, err, status) = run_python(READ_STDIN, data)
+            self.assertEqual(status, 0, err)
+            self.assertEqual(out, DATA)
+
+    def test_truncated_stdin(self):
+        for compression in ['gzip', 'bgzip', 'bz2']:
+            data = compress(DATA, compression)
+            for cut in [5, 1000]:
+                (out, err, status) = run_python(READ_STDIN, data[:-cut])
+                self.assertEqual(status, 1, compression)
+                self.assertTrue('end-of-stream' in err, err)
+
+    def test_truncated_file(self):
+        fname = os.path.join(self.tmp_dir, 'x.gz')
+        with open(fname, 'wb') as fh:
+            fh.write(compress(DATA, 'gzip')[:-1000])
+        fh = bioutils.xopen(fname, use_external=False)
+        fh.read()
+        self.assertRaises(IOError, fh.close)
+
+
+
+class TestCompressedOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_bgzip_file(self):
+        fname = os.path.join(self.tmp_dir, 'x.fa.bgz')
+        with bioutils.xopen_write(fname, use_external=False) as fh:
+            fh.write(DATA)
+        with open(fname, 'rb') as fh:
+            data = fh.read()
+        self.assertEqual(bioutils.guess_compression(data[:16]), 'bgzip')
+        self.assertTrue(data.endswith(bioutils.BGZF_EOF_BLOCK))
+        self.assertEqual(gunzip(data), DATA)
+        # block offsets only work if block sizes are right
+        with open(fname, 'rb') as fh:
+            self.assertTrue(len(bioutils.bgzf_block_offsets(fh)) > 2)
+
+    def test_bgzip_pipe(self):
+        (out, err, status) = run_python(
+            'import bioutils; fh = bioutils.xopen_write("-", "bgzip", '
+            'use_external=False); fh.write(sys.stdin.read()); fh.close()',
+            DATA)
+        self.assertEqual(status, 0, err)
+        self.assertEqual(bioutils.guess_compression(out[:16]), 'bgzip')
+        self.assertEqual(gunzip(out), DATA)
+
+    def test_gzip_pipe(self):
+        for use_external in [True, False]:
+            (out, err, status) = run_python(
+                'import bioutils; fh = bioutils.xopen_write("-", "gzip", '
+                'use_external=%s); fh.write(sys.stdin.read()); fh.close()' % (
+                    use_external), DATA)
+            self.assertEqual(status, 0, err)
+            self.assertEqual(gunzip(out), DATA)
+
+    def test_compression_from_ext(self):
+        for (ext, compression) in [('.gz', 'gzip'), ('.bgz', 'bgzip'),
+                                   ('.fa', None)]:
+            fname = os.path.join(self.tmp_dir, 'x' + ext)
+            with bioutils.xopen_write(fname) as fh:
+                fh.write(DATA)
+            with open(fname, 'rb') as fh:
+                self.assertEqual(bioutils.guess_compression(fh.read(16)),
+                                 compression)
+            self.assertEqual(bioutils.xopen(fname).read(), DATA)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
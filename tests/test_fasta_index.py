@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+"""Tests for faidx compatible random access in bioutils
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+
+
+
+def random_records(rng, num):
+    """Names, headers and sequences including empty ones
+    """
+    records = []
+    for i in xrange(num):
+        seq = ''.join(rng.choice('ACGTNacgtn') for _ in xrange(
+            rng.choice([0, 1, 5, 59, 60, 61, 300])))
+        records.append(('s%d' % i, 's%d desc %d' % (i, rng.randint(0, 9)), seq))
+    return records
+
+
+def format_fasta(rng, records, newline='\n'):
+    """Fasta with random line width per record
+    """
+    out = []
+    for (_, header, seq) in records:
+        out.append('>' + header + newline)
+        width = rng.choice([1, 7, 60, 1000])
+        out.extend(seq[j:j+width] + newline
+                   for j in xrange(0, len(seq), width))
+    return ''.join(out)
+
+
+
+class TestFastaIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test-fasta-index-")
+        self.fname = os.path.join(self.tmp_dir, "x.fa")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, text):
+        with open(self.fname, 'wb') as fh:
+            fh.write(text)
+
+    def check_fetch(self, rng, records):
+        with bioutils.FastaIndex(self.fname) as fasta_idx:
+            self.assertEqual(len(fasta_idx), len(records))
+            self.assertEqual(fasta_idx.names, [r[0] for r in records])
+            for (name, header, seq) in records:
+                self.assertTrue(name in fasta_idx)
+                self.assertEqual(fasta_idx.length(name), len(seq))
+                self.assertEqual(fasta_idx.header(name), header)
+                self.assertEqual(fasta_idx.fetch(name), seq)
+                self.assertEqual(fasta_idx.fetch_region(name), seq)
+                for _ in xrange(20):
+                    start = rng.randint(-2, len(seq)+2)
+                    end = rng.randint(-2, len(seq)+2)
+                    self.assertEqual(fasta_idx.fetch(name, start, end),
+                                     seq[max(0, start):max(0, end)])
+                    self.assertEqual(fasta_idx.fetch(name, start),
+                                     seq[max(0, start):])
+                    if 0 < start <= end:
+                        self.assertEqual(fasta_idx.fetch_region(
+                            "%s:%d-%d" % (name, start, end)),
+                                         seq[start-1:end])
+                        self.assertEqual(fasta_idx.fetch_region(
+                            "%s:%d" % (name, start)), seq[start-1:])
+            self.assertFalse('missing' in fasta_idx)
+            self.assertRaises(KeyError, fasta_idx.fetch, 'missing')
+            self.assertRaises(KeyError, fasta_idx.fetch_region, 'missing:1-2')
+
+    def test_fetch(self):
+        rng = random.Random(0)
+        for newline in ['\n', '\r\n']:
+            for _ in xrange(10):
+                records = random_records(rng, 20)
+                self.write(format_fasta(rng, records, newline))
+                if os.path.exists(self.fname + ".fai"):
+                    os.remove(self.fname + ".fai")
+                self.check_fetch(rng, records)
+                # again from written index
+                self.check_fetch(rng, records)
+
+    def test_region_with_commas(self):
+        self.write(">chr1\n" + "ACGT" * 500 + "\n")
+        with bioutils.FastaIndex(self.fname) as fasta_idx:
+            self.assertEqual(fasta_idx.fetch_region("chr1:1,001-1,004"),
+                             "ACGT")
+
+    def test_no_final_newline(self):
+        self.write(">a\nACG\nT\n>b\nAC\nGT")
+        with bioutils.FastaIndex(self.fname) as fasta_idx:
+            self.assertEqual(fasta_idx.fetch('a'), 'ACGT')
+            self.assertEqual(fasta_idx.fetch('b', 1), 'CGT')
+
+    def test_fai_round_trip(self):
+        rng = random.Random(1)
+        records = random_records(rng, 30)
+        self.write(format_fasta(rng, records))
+        fai = self.fname + ".fai"
+        self.assertFalse(bioutils.fasta_index_exists(self.fname))
+        fasta_idx = bioutils.FastaIndex(self.fname)
+        fasta_idx.close()
+        self.assertTrue(bioutils.fasta_index_exists(self.fname))
+        self.assertEqual(fasta_idx.read_fai(fai),
+                         bioutils.FastaIndex.build(self.fname))
+        # samtools faidx format: name, length, offset, line bases,
+        # line width
+        with open(fai) as fh:
+            first = fh.readline().rstrip('\n').split('\t')
+        self.assertEqual(first[:2], [records[0][0], str(len(records[0][2]))])
+        self.assertEqual(int(first[2]), len(records[0][1]) + 2)
+
+        # an outdated index is ignored and rebuilt
+        os.utime(fai, (0, 0))
+        self.assertFalse(bioutils.fasta_index_exists(self.fname))
+        records = random_records(rng, 5)
+        self.write(format_fasta(rng, records))
+        os.utime(fai, (0, 0))
+        self.check_fetch(rng, records)
+        self.assertTrue(bioutils.fasta_index_exists(self.fname))
+
+    def test_no_write(self):
+        self.write(">a\nACGT\n")
+        with bioutils.FastaIndex(self.fname, write_index=False) as fasta_idx:
+            self.assertEqual(fasta_idx.fetch('a'), 'ACGT')
+        self.assertFalse(os.path.exists(self.fname + ".fai"))
+
+    def test_build_errors(self):
+        for text in [">a\nACG\nA\nACG\n",
+                     ">a\nACG\nACGT\n",
+                     ">a\nACG\n\nACG\n",
+                     ">a\nACG\r\nACG\nA\n",
+                     ">a\nAC\n>b\nAC\n>a x\nAC\n"]:
+            self.write(text)
+            self.assertRaises(ValueError, bioutils.FastaIndex.build,
+                              self.fname)
+            self.assertRaises(ValueError, bioutils.FastaIndex, self.fname)
+            self.assertFalse(os.path.exists(self.fname + ".fai"))
+
+    def test_compressed(self):
+        fh = gzip.open(self.fname, 'wb')
+        fh.write(">a\nACGT\n")
+        fh.close()
+        self.assertRaises(ValueError, bioutils.FastaIndex, self.fname)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+"""Tests for fastx parsing in bioutils
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+
+
+
+class TestFastaBlocks(unittest.TestCase):
+
+    def check_blocks(self, text, block_size):
+        if text.startswith('>'):
+            start = 0
+        else:
+            start = text.find('\n>') + 1 or len(text)
+        blocks = list(bioutils._fasta_blocks(StringIO(text), block_size))
+        self.assertEqual(''.join(blocks), text[start:])
+        # blocks only split at record starts
+        pos = start
+        for block in blocks:
+            self.assertTrue(block.startswith('>'))
+            self.assertTrue(pos == 0 or text[pos-1] == '\n')
+            pos += len(block)
+
+    def test_random(self):
+        rng = random.Random(0)
+        pieces = ['>a\n', 'AC\n', '>b c\n', 'G', '\n', '>', 'x\n>\n', '\r\n']
+        for _ in xrange(1000):
+            text = ''.join(rng.choice(pieces)
+                           for _ in xrange(rng.randint(0, 30)))
+            for block_size in [1, 2, 3, 5, 17, 1000]:
+                self.check_blocks(text, block_size)
+
+    def test_long_record(self):
+        text = '>x\n' + ('ACGT' * 15 + '\n') * 10000 + '>y\nA\n'
+        blocks = list(bioutils._fasta_blocks(StringIO(text), 100))
+        self.assertEqual(blocks[0], text[:text.index('>y')])
+        self.assertEqual(''.join(blocks), text)
+
+
+
+def random_fasta(rng, num):
+    """Multi-line fasta with empty and long records and descriptions
+    """
+    out = []
+    for i in xrange(num):
+        seq = ''.join(rng.choice('ACGTN-') for _ in xrange(
+            rng.choice([0, 1, 10, 100, 1000])))
+        out.append('>s%d desc %d\n' % (i, rng.randint(0, 9)))
+        width = rng.choice([7, 60, 1000])
+        out.extend(seq[j:j+width] + '\n' for j in xrange(0, len(seq), width))
+    return ''.join(out)
+
+
+def random_fastq(rng, num):
+    """Fastq whose quality lines often start with '@' or '+'
+    """
+    out = []
+    for i in xrange(num):
+        seq_len = rng.choice([1, 10, 100])
+        seq = ''.join(rng.choice('ACGTN') for _ in xrange(seq_len))
+        qual = ''.join(rng.choice('@+!I#') for _ in xrange(seq_len))
+        out.append('@r%d x\n%s\n+\n%s\n' % (i, seq, qual))
+    return ''.join(out)
+
+
+def count_records(records):
+    """Picklable function for fastx_parallel_map()
+    """
+    return len(list(records))
+
+
+
+class TestFastxChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = random.Random(0)
+        self.files = []
+        orig_block_size = bioutils.BGZF_BLOCK_DATA_SIZE
+        # many small BGZF blocks
+        bioutils.BGZF_BLOCK_DATA_SIZE = 997
+        try:
+            for (fmt, text) in [('fasta', random_fasta(rng, 300)),
+                                ('fastq', random_fastq(rng, 500))]:
+                for ext in ['', '.bgz']:
+                    fname = os.path.join(self.tmp_dir, fmt + ext)
+                    with bioutils.xopen_write(fname) as fh:
+                        fh.write(text)
+                    self.files.append((fname, fmt))
+        finally:
+            bioutils.BGZF_BLOCK_DATA_SIZE = orig_block_size
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_chunks_equal_serial(self):
+        for (fname, fmt) in self.files:
+            fh = bioutils.xopen(fname)
+            expected = list(bioutils.read_fastx(fh, fmt))
+            fh.close()
+            for chunk_size in [1, 7, 100, 1000, 5000, 10**7]:
+                found = []
+                for chunk in bioutils.fastx_chunks(fname, chunk_size):
+                    found.extend(bioutils.read_fastx_chunk(fname, fmt, chunk))
+                self.assertEqual(found, expected, (fname, chunk_size))
+
+    def test_raw_chunks_equal_text(self):
+        for (fname, fmt) in self.files:
+            fh = bioutils.xopen(fname)
+            text = fh.read()
+            fh.close()
+            for chunk_size in [13, 4000]:
+                raw = []
+                for chunk in bioutils.fastx_chunks(fname, chunk_size):
+                    raw.extend(rec[-1] for rec in bioutils.read_fastx_chunk(
+                        fname, fmt, chunk, raw=True))
+                self.assertEqual(''.join(raw), text, (fname, chunk_size))
+
+    def test_parallel_map(self):
+        for (fname, fmt) in self.files:
+            fh = bioutils.xopen(fname)
+            num = len(list(bioutils.read_fastx(fh, fmt)))
+            fh.close()
+            counts = list(bioutils.fastx_parallel_map(
+                fname, fmt, count_records, num_workers=2, chunk_size=2000))
+            self.assertTrue(len(counts) > 1)
+            self.assertEqual(sum(counts), num)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""Tests for column statistics and streaming in prune_aln_cols
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import math
+import random
+import shutil
+import tempfile
+import unittest
+import subprocess
+from collections import Counter
+from cStringIO import StringIO
+
+#--- third-party imports
+#
+import numpy
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+import prune_aln_cols
+
+
+
+def byte_matrix(rows):
+    return numpy.vstack([numpy.frombuffer(r, dtype=numpy.uint8)
+                         for r in rows])
+
+
+
+class TestColumnCounts(unittest.TestCase):
+
+    def test_other_chars_are_distinct(self):
+        col_counts = prune_aln_cols.ColumnCounts(5)
+        col_counts.add(byte_matrix(['**aX#', '*?AX#', '**aX#']))
+        self.assertEqual(list(col_counts.num_classes()), [1, 2, 1, 1, 1])
+        self.assertEqual(list(col_counts.conservation()),
+                         [1.0, 2/3.0, 1.0, 1.0, 1.0])
+
+    def test_brute_force(self):
+        rng = random.Random(0)
+        rows = [''.join(rng.choice('AaCcT-.~*?1') for _ in xrange(200))
+                for _ in xrange(30)]
+        col_counts = prune_aln_cols.ColumnCounts(200)
+        # several blocks, new classes appearing in later ones
+        orig_block_size = prune_aln_cols.COUNT_BLOCK_SIZE
+        prune_aln_cols.COUNT_BLOCK_SIZE = 1000
+        try:
+            col_counts.add(byte_matrix(rows[:3]))
+            col_counts.add(byte_matrix(rows[3:]))
+        finally:
+            prune_aln_cols.COUNT_BLOCK_SIZE = orig_block_size
+        nseqs = len(rows)
+        for j in xrange(200):
+            counter = Counter(r[j].upper() for r in rows)
+            res = dict((c, n) for (c, n) in counter.items()
+                       if c not in bioutils.GAP_CHARS)
+            nres = float(sum(res.values()))
+            self.assertEqual(col_counts.num_classes()[j], len(counter))
+            self.assertEqual(col_counts.gaps()[j], nseqs - nres)
+            self.assertAlmostEqual(col_counts.conservation()[j],
+                                   max(res.values() or [0]) / float(nseqs))
+            self.assertAlmostEqual(col_counts.entropy()[j], sum(
+                -n/nres * math.log(n/nres, 2) for n in res.values()))
+
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test-prune-aln-cols-")
+        self.fname = os.path.join(self.tmp_dir, "aln.fa")
+        rng = random.Random(1)
+        # mostly gap free columns and some gappy ones
+        col_gap_frac = [rng.choice([0.0, 0.05, 0.5, 1.0]) for _ in xrange(300)]
+        with open(self.fname, 'w') as fh:
+            for i in xrange(50):
+                seq = ''.join('-' if rng.random() < f else rng.choice('ACGTa')
+                              for f in col_gap_frac)
+                fh.write('>s%d desc\n' % i)
+                fh.write(''.join(seq[j:j+60] + '\n'
+                                 for j in xrange(0, len(seq), 60)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_prune(self, args, stdin=None):
+        colmap = os.path.join(self.tmp_dir, "colmap.txt")
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(TEST_DIR),
+                                          'prune_aln_cols.py'),
+             '--colmap', colmap] + args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        (out, err) = proc.communicate(stdin)
+        self.assertEqual(proc.returncode, 0, err)
+        with open(colmap) as fh:
+            return (out, fh.read())
+
+    def test_stream_prune(self):
+        with open(self.fname) as fh:
+            aln = bioutils.Alignment.read(fh, 'fasta')
+        filters = [('max-gap-frac', 0.1), ('ref', None)]
+        ref_row = aln.row(aln.ids.index('s7'))
+        for fmt in bioutils.ALN_WRITE_FORMATS:
+            expected = StringIO()
+            keep_cols = prune_aln_cols.prune_aln(
+                aln, filters, 'and', ref_row, expected, fmt)
+            found = StringIO()
+            orig_block_size = prune_aln_cols.COUNT_BLOCK_SIZE
+            # several row blocks
+            prune_aln_cols.COUNT_BLOCK_SIZE = 1000
+            try:
+                stream_keep_cols = prune_aln_cols.stream_prune(
+                    self.fname, filters, 'and', 's7', found, fmt,
+                    self.tmp_dir)
+            finally:
+                prune_aln_cols.COUNT_BLOCK_SIZE = orig_block_size
+            self.assertEqual(list(stream_keep_cols), list(keep_cols))
+            self.assertEqual(found.getvalue(), expected.getvalue(), fmt)
+        self.assertRaises(ValueError, prune_aln_cols.stream_prune,
+                          self.fname, filters, 'and', 'missing', StringIO())
+
+    def test_cmdline(self):
+        with open(self.fname) as fh:
+            text = fh.read()
+        for args in [['--max-gap-frac', '0.1'],
+                     ['--any-gap', '--identical', '--combine', 'or'],
+                     ['--ref-seq', 's3', '--ref-positions', '5-50,70']]:
+            for fmt in bioutils.ALN_WRITE_FORMATS:
+                args_fmt = args + ['-o', fmt]
+                expected = self.run_prune(args_fmt + ['-i', self.fname])
+                self.assertTrue(expected[0])
+                for stream_args in [['-i', self.fname, '--stream'],
+                                    ['-i', '-', '--stream',
+                                     '--tmp-dir', self.tmp_dir]]:
+                    self.assertEqual(
+                        self.run_prune(args_fmt + stream_args, text),
+                        expected, (args_fmt, stream_args))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
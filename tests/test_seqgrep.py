@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""Tests for the seqgrep matchers, id lookup and compressed input and
+output
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+import subprocess
+from cStringIO import StringIO
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+import seqgrep
+
+
+
+def iupac_match(text_char, pattern_char):
+    """Text character matches pattern character (see
+    seqgrep._iupac_peq())
+    """
+    if text_char in seqgrep.IUPAC_BASES and \
+      pattern_char in seqgrep.IUPAC_BASES:
+        return set(seqgrep.IUPAC_BASES[text_char]) <= \
+          set(seqgrep.IUPAC_BASES[pattern_char])
+    return text_char == pattern_char
+
+
+def edit_distance(pattern, text):
+    """Edit distance (IUPAC aware) of pattern and text
+    """
+    prev = range(len(text)+1)
+    for (i, p) in enumerate(pattern):
+        cur = [i+1]
+        for (j, t) in enumerate(text):
+            cur.append(min(prev[j] + (not iupac_match(t, p)),
+                           prev[j+1] + 1, cur[j] + 1))
+        prev = cur
+    return prev[-1]
+
+
+def best_end_distances(pattern, text):
+    """Minimal edit distance (IUPAC aware) of pattern and any
+    substring of text ending at each position (exclusive)
+    """
+    # pattern can start anywhere: first row all zero
+    prev = [0] * (len(text)+1)
+    for (i, p) in enumerate(pattern):
+        cur = [i+1]
+        for (j, t) in enumerate(text):
+            cur.append(min(prev[j] + (not iupac_match(t, p)),
+                           prev[j+1] + 1, cur[j] + 1))
+        prev = cur
+    return prev
+
+
+def random_seq(rng, length, chars='ACGT'):
+    return ''.join(rng.choice(chars) for _ in xrange(length))
+
+
+def mutate(rng, seq, num):
+    """Applies num random substitutions, insertions or deletions
+    """
+    seq = list(seq)
+    for _ in xrange(num):
+        pos = rng.randrange(len(seq))
+        op = rng.choice('sid')
+        if op == 's':
+            seq[pos] = rng.choice('ACGT')
+        elif op == 'i':
+            seq.insert(pos, rng.choice('ACGT'))
+        elif len(seq) > 1:
+            del seq[pos]
+    return ''.join(seq)
+
+
+def random_target(rng, patterns, length=300, num_inserts=5, max_mut=2):
+    """Random sequence with (mutated) patterns inserted
+    """
+    target = random_seq(rng, length, 'ACGTN')
+    for _ in xrange(num_inserts):
+        pattern = mutate(rng, rng.choice(patterns).replace('N', 'A'),
+                         rng.randint(0, max_mut))
+        pos = rng.randrange(len(target))
+        target = target[:pos] + pattern + target[pos:]
+    return target
+
+
+
+class TestMatchers(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def test_aho_corasick(self):
+        for _ in xrange(50):
+            patterns = [random_seq(self.rng, self.rng.randint(1, 6), 'ACGt')
+                        for _ in xrange(self.rng.randint(1, 20))]
+            names = ['p%d' % i for i in xrange(len(patterns))]
+            target = random_seq(self.rng, 500, 'ACGTaN')
+            for ignore_case in [False, True]:
+                matcher = seqgrep.AhoCorasick(patterns, names,
+                                              ignore_case=ignore_case)
+                (t, ps) = (target, patterns)
+                if ignore_case:
+                    (t, ps) = (target.upper(), [p.upper() for p in patterns])
+                expected = [(names[k], i, i+len(p), '+', 0)
+                            for (k, p) in enumerate(ps)
+                            for i in xrange(len(t)-len(p)+1)
+                            if t[i:i+len(p)] == p]
+                self.assertEqual(sorted(matcher.search(target)),
+                                 sorted(expected))
+
+    def test_regex(self):
+        target = random_seq(self.rng, 1000, 'ACGT')
+        for both_strands in [False, True]:
+            all_hits = seqgrep.RegexMatcher(
+                'AC.T', both_strands=both_strands).search(target)
+            first = seqgrep.RegexMatcher(
+                'AC.T', both_strands=both_strands,
+                all_hits=False).search(target)
+            self.assertTrue(len(all_hits) > 1)
+            self.assertEqual(first, all_hits[:1])
+        self.assertEqual(seqgrep.RegexMatcher(
+            'TTTTTTTTTTTT', all_hits=False).search(target), [])
+
+    def test_hamming(self):
+        for max_dist in [0, 1, 2]:
+            # long patterns use the seed prefilter, ambiguous ones not
+            patterns = [random_seq(self.rng, 12), random_seq(self.rng, 5),
+                        random_seq(self.rng, 10, 'ACGTRN')]
+            for pattern in patterns:
+                matcher = seqgrep.ApproxMatcher([pattern], max_dist=max_dist)
+                for _ in xrange(10):
+                    target = random_target(self.rng, [pattern])
+                    m = len(pattern)
+                    expected = []
+                    for i in xrange(len(target)-m+1):
+                        dist = sum(not iupac_match(t, p) for (t, p) in zip(
+                            target[i:i+m], pattern))
+                        if dist <= max_dist:
+                            expected.append((pattern, i, i+m, '+', dist))
+                    self.assertEqual(sorted(matcher.search(target)),
+                                     sorted(expected))
+
+    def test_edits(self):
+        for max_dist in [0, 1, 2]:
+            patterns = [random_seq(self.rng, 12), random_seq(self.rng, 6),
+                        random_seq(self.rng, 10, 'ACGTRN')]
+            for pattern in patterns:
+                matcher = seqgrep.ApproxMatcher([pattern], max_dist=max_dist,
+                                                edits=True)
+                for _ in xrange(10):
+                    target = random_target(self.rng, [pattern])
+                    best = best_end_distances(pattern, target)
+                    hits = matcher.search(target)
+                    self.assertEqual(bool(hits), min(best) <= max_dist)
+                    for (_, start, end, _, dist) in hits:
+                        self.assertTrue(dist <= max_dist)
+                        self.assertEqual(dist, best[end])
+                        self.assertEqual(
+                            edit_distance(pattern, target[start:end]), dist)
+                    # every run of end positions within max_dist
+                    # has a hit
+                    runs = []
+                    for (end, dist) in enumerate(best):
+                        if dist > max_dist:
+                            continue
+                        if runs and runs[-1][1] == end-1:
+                            runs[-1][1] = end
+                        else:
+                            runs.append([end, end])
+                    for (run_start, run_end) in runs:
+                        self.assertTrue(any(
+                            run_start <= e <= run_end
+                            for (_, _, e, _, _) in hits), (run_start, hits))
+
+
+
+class TestIdLookup(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test-seqgrep-")
+        self.fname = os.path.join(self.tmp_dir, "x.fa")
+        rng = random.Random(2)
+        with open(self.fname, 'w') as fh:
+            for i in xrange(200):
+                seq = random_seq(rng, rng.randint(0, 200))
+                width = rng.choice([10, 60])
+                fh.write('>s%d desc %d\n' % (i, i))
+                fh.write(''.join(seq[j:j+width] + '\n'
+                                 for j in xrange(0, len(seq), width)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def parsed(self, ids):
+        with open(self.fname) as fh:
+            return [rec for rec in bioutils.read_fastx(fh) if rec[0] in ids]
+
+    def test_indexed_records(self):
+        ids = ['s150', 's3', 'missing', 's0', 's199', 's77']
+        self.assertFalse(bioutils.fasta_index_exists(self.fname))
+        self.assertEqual(list(seqgrep.indexed_records(self.fname, ids)),
+                         self.parsed(ids))
+        # index was written and is used for lookups
+        self.assertTrue(bioutils.fasta_index_exists(self.fname))
+        (records, fhandle) = seqgrep.file_records(
+            self.fname, 'fasta', seqgrep.IdMatcher(ids), True, False)
+        self.assertTrue(fhandle is None)
+        self.assertEqual(list(records), self.parsed(ids))
+
+    def run_seqgrep(self, args, fname=None):
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(TEST_DIR),
+                                          'seqgrep.py')]
+            + args + [fname or self.fname],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (out, err) = proc.communicate()
+        self.assertEqual(proc.returncode, 0, err)
+        return out
+
+    def id_file(self, ids):
+        fname = os.path.join(self.tmp_dir, "ids.txt")
+        with open(fname, 'w') as fh:
+            fh.write(''.join(i + '\n' for i in ids))
+        return fname
+
+    def expected(self, records):
+        return ''.join('>%s\n%s\n' % (rec[1], rec[2]) for rec in records)
+
+    def test_exact_id(self):
+        ids = ['s150', 's3', 'missing', 's0', 's199', 's77']
+        args = ['-x', '-f', self.id_file(ids)]
+        without_index = self.run_seqgrep(args)
+        self.assertFalse(bioutils.fasta_index_exists(self.fname))
+        self.assertEqual(without_index, self.expected(self.parsed(ids)))
+        bioutils.FastaIndex(self.fname).close()
+        self.assertEqual(self.run_seqgrep(args), without_index)
+        # only part of the id
+        self.assertEqual(self.run_seqgrep(['-x', 's']), '')
+        self.assertEqual(self.run_seqgrep(['-x', 's', '-v']),
+                         self.expected(self.parsed(
+                             ['s%d' % i for i in xrange(200)])))
+
+    def test_exact_id_invert(self):
+        ids = ['s1%d' % i for i in xrange(10)]
+        others = ['s%d' % i for i in xrange(200) if 's%d' % i not in ids]
+        expected = self.expected(self.parsed(others))
+        args = ['-x', '-v', '-f', self.id_file(ids)]
+        self.assertEqual(self.run_seqgrep(args), expected)
+        bioutils.FastaIndex(self.fname).close()
+        self.assertEqual(self.run_seqgrep(args), expected)
+
+    def test_exact_id_duplicates(self):
+        fname = os.path.join(self.tmp_dir, "dups.fa")
+        with open(fname, 'w') as fh:
+            fh.write(">a 1\nAC\n>B 2\nGT\n>a 3\nTT\n>c 4\nGG\n>b 5\nCC\n")
+        # only the first record per id, reading stops once all ids
+        # were found
+        self.assertEqual(self.run_seqgrep(['-x', 'a'], fname),
+                         ">a 1\nAC\n")
+        self.assertEqual(self.run_seqgrep(['-x', '-f', self.id_file(
+            ['c', 'a'])], fname), ">a 1\nAC\n>c 4\nGG\n")
+        self.assertEqual(self.run_seqgrep(['-x', '-v', 'a'], fname),
+                         ">B 2\nGT\n>c 4\nGG\n>b 5\nCC\n")
+        # ignoring case all records are checked
+        self.assertEqual(self.run_seqgrep(['-x', '-i', 'A'], fname),
+                         ">a 1\nAC\n>a 3\nTT\n")
+        self.assertEqual(self.run_seqgrep(['-x', '-i', 'b'], fname),
+                         ">B 2\nGT\n>b 5\nCC\n")
+        self.assertEqual(self.run_seqgrep(['-x', '-i', '-v', 'b'], fname),
+                         ">a 1\nAC\n>a 3\nTT\n>c 4\nGG\n")
+
+
+
+class TestCompressedIO(unittest.TestCase):
+
+    def test_gzip_stdin_to_bgzip_pipe(self):
+        rng = random.Random(1)
+        text = ''.join('>s%d\n%s\n' % (i, random_seq(rng, 50))
+                       for i in xrange(2000))
+        fh = StringIO()
+        gz = gzip.GzipFile(fileobj=fh, mode='wb')
+        gz.write(text)
+        gz.close()
+        proc = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(TEST_DIR),
+                                          'seqgrep.py'),
+             '-s', 'seq', '-z', 'bgzip', 'ACGTA', '-'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        (out, err) = proc.communicate(fh.getvalue())
+        self.assertEqual(proc.returncode, 0, err)
+        self.assertEqual(bioutils.guess_compression(out[:16]), 'bgzip')
+        found = gzip.GzipFile(fileobj=StringIO(out)).read()
+        expected = ''.join('>%s\n%s\n' % (rec[1], rec[2])
+                           for rec in bioutils.read_fastx(StringIO(text))
+                           if 'ACGTA' in rec[2])
+        self.assertTrue(expected)
+        self.assertEqual(found, expected)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
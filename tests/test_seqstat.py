@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""Tests for sequence statistics and pairwise identities in seqstat
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+import subprocess
+from itertools import izip
+
+#--- third-party imports
+#
+import numpy
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+import bioutils
+import seqstat
+
+
+
+def loop_identity(s1, s2):
+    """Pairwise identity as originally computed, one residue pair at a
+    time
+    """
+    idents = sum(c1 == c2
+                 for c1, c2 in izip(s1, s2)
+                 if not bioutils.isgap(c1) and not bioutils.isgap(c2))
+    min_ungapped_len = min(len(bioutils.ungap(s1)), len(bioutils.ungap(s2)))
+    return idents / float(min_ungapped_len)
+
+
+def random_aln(rng, nseqs, aln_len, chars='ACGTacgtN-.~'):
+    """Alignment of random sequences with at least one residue each
+    """
+    seqs = []
+    for _ in xrange(nseqs):
+        seq = [rng.choice(chars) for _ in xrange(aln_len)]
+        seq[rng.randrange(aln_len)] = 'A'
+        seqs.append(''.join(seq))
+    mx = numpy.vstack([numpy.frombuffer(s, dtype=numpy.uint8) for s in seqs])
+    return bioutils.Alignment(['s%d' % i for i in xrange(nseqs)], mx)
+
+
+def mutated_aln(rng, nseqs, aln_len, rate, chars='ACGT-'):
+    """Alignment of mutated copies of a few random sequences
+    """
+    bases = [[rng.choice(chars[:-1]) for _ in xrange(aln_len)]
+             for _ in xrange(3)]
+    seqs = []
+    for _ in xrange(nseqs):
+        seq = [c if rng.random() > rate else rng.choice(chars)
+               for c in rng.choice(bases)]
+        seq[rng.randrange(aln_len)] = 'A'
+        seqs.append(''.join(seq))
+    mx = numpy.vstack([numpy.frombuffer(s, dtype=numpy.uint8) for s in seqs])
+    return bioutils.Alignment(['s%d' % i for i in xrange(nseqs)], mx)
+
+
+def exact_partners(aln):
+    """Most related and unrelated partners as determined by seqstat -a
+    """
+    nseqs = len(aln)
+    cmx = seqstat.comp_pairwise_ident_matrix(aln)
+    partners = []
+    for i in xrange(nseqs):
+        row = seqstat.condensed_row(cmx, nseqs, i)
+        row[i] = -1.0
+        max_idx = numpy.argmax(row)
+        row[i] = 1.1
+        min_idx = numpy.argmin(row)
+        partners.append((max_idx, row[max_idx], min_idx, row[min_idx]))
+    return partners
+
+
+
+class TestPairwiseIdentity(unittest.TestCase):
+
+    def setUp(self):
+        self.aln = random_aln(random.Random(0), 37, 150)
+        self.seqs = [self.aln.seq(i).upper() for i in xrange(len(self.aln))]
+        self.nseqs = len(self.seqs)
+
+    def test_pairwise_identity(self):
+        for i in xrange(self.nseqs):
+            for j in xrange(i+1, self.nseqs):
+                self.assertEqual(
+                    seqstat.pairwise_identity(self.seqs[i], self.seqs[j]),
+                    loop_identity(self.seqs[i], self.seqs[j]))
+
+    def test_ident_matrix(self):
+        for (num_workers, row_block) in [(1, 1024), (1, 5), (2, 1024)]:
+            cmx = seqstat.comp_pairwise_ident_matrix(
+                self.aln, num_workers=num_workers, row_block=row_block)
+            for i in xrange(self.nseqs):
+                for j in xrange(i+1, self.nseqs):
+                    self.assertAlmostEqual(
+                        cmx[seqstat.condensed_index(self.nseqs, i, j)],
+                        loop_identity(self.seqs[i], self.seqs[j]), 12)
+
+    def test_condensed_row(self):
+        cmx = seqstat.comp_pairwise_ident_matrix(self.aln)
+        for i in xrange(self.nseqs):
+            row = seqstat.condensed_row(cmx, self.nseqs, i)
+            self.assertTrue(numpy.isnan(row[i]))
+            for j in xrange(self.nseqs):
+                if j != i:
+                    self.assertAlmostEqual(
+                        row[j], loop_identity(self.seqs[i], self.seqs[j]), 12)
+
+    def test_sampled_pairs(self):
+        (enc_mx, gap_mx) = seqstat.encode_aln(self.aln)
+        ungapped_lens = enc_mx.shape[1] - gap_mx.sum(axis=1)
+        (i, j) = seqstat.sample_pairs(self.nseqs, 100, random.Random(1))
+        self.assertTrue((i < j).all())
+        pw_ids = seqstat.pairs_identity(enc_mx, ungapped_lens, i, j,
+                                        batch_size=7)
+        for (k, ident) in enumerate(pw_ids):
+            self.assertAlmostEqual(
+                ident, loop_identity(self.seqs[i[k]], self.seqs[j[k]]), 12)
+
+
+
+class TestSketchPartners(unittest.TestCase):
+
+    def check_partners(self, aln, kmer_len):
+        (enc_mx, gap_mx) = seqstat.encode_aln(aln)
+        ungapped_lens = enc_mx.shape[1] - gap_mx.sum(axis=1)
+        for seed in xrange(3):
+            partners = seqstat.sketch_partners(
+                enc_mx, ungapped_lens, kmer_len, random.Random(seed))
+            self.assertEqual(zip(*partners), exact_partners(aln))
+
+    def test_random(self):
+        self.check_partners(random_aln(random.Random(0), 37, 150), 3)
+
+    def test_mutated(self):
+        rng = random.Random(1)
+        for rate in [0.01, 0.1, 0.3]:
+            self.check_partners(mutated_aln(rng, 120, 200, rate), 6)
+
+    def test_two_seqs(self):
+        self.check_partners(random_aln(random.Random(2), 2, 20), 3)
+
+
+
+class TestAllGapRows(unittest.TestCase):
+
+    def setUp(self):
+        self.aln = random_aln(random.Random(3), 5, 30)
+        self.aln.mx[2] = ord('-')
+
+    def test_ident_matrix(self):
+        self.assertRaises(ValueError, seqstat.comp_pairwise_ident_matrix,
+                          self.aln)
+
+    def test_cmdline(self):
+        text = ''.join('>%s\n%s\n' % (self.aln.ids[i], self.aln.seq(i))
+                       for i in xrange(len(self.aln)))
+        for args in [[], ['-w', '2'], ['--sample-pairs', '3'],
+                     ['-a', '--nn-sketch']]:
+            proc = subprocess.Popen(
+                [sys.executable, os.path.join(os.path.dirname(TEST_DIR),
+                                              'seqstat.py'),
+                 '-f', 'fasta'] + args + ['-'],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            (out, err) = proc.communicate(text)
+            self.assertEqual(proc.returncode, 1, args)
+            self.assertIn('gaps only (first: s2)', err)
+            self.assertNotIn('Warning', err)
+
+
+
+def random_records(rng, num, lens):
+    """Records with gaps, duplicate names and duplicate sequences
+    """
+    records = []
+    for i in xrange(num):
+        seq = ''.join(rng.choice('ACGT-') for _ in xrange(rng.choice(lens)))
+        if records and rng.random() < 0.1:
+            seq = rng.choice(records)[1]
+        records.append(('s%d' % rng.randint(0, num), seq))
+    return records
+
+
+def stats_summary(stats):
+    return (stats.nseqs, stats.min_len, stats.max_len, stats.sum_len,
+            stats.aln_len, stats.same_len, stats.has_gaps, stats.first_seq,
+            len(stats.ids), len(stats.seq_digests), stats.info,
+            str(stats.seq_buf), stats.seq_ids)
+
+
+
+class TestSeqStats(unittest.TestCase):
+
+    def serial(self, records, keep_seqs=True):
+        stats = seqstat.SeqStats(keep_seqs=keep_seqs, keep_info=True)
+        for (seqid, seq) in records:
+            stats.add(seqid, seq)
+        return stats
+
+    def test_add(self):
+        records = [('a', 'AC-T'), ('b', 'ACGT'), ('a', 'AC-T')]
+        stats = self.serial(records)
+        self.assertEqual(stats_summary(stats), (
+            3, 3, 4, 10, 4, True, True, 'AC-T', 2, 2,
+            [('a', 3), ('b', 4), ('a', 3)], 'AC-TACGTAC-T', ['a', 'b', 'a']))
+        self.assertTrue(stats.aligned())
+        self.assertEqual(stats.aln().seq(1), 'ACGT')
+        # sequences are dropped once lengths differ
+        stats.add('c', 'ACG')
+        self.assertFalse(stats.aligned())
+        self.assertEqual((str(stats.seq_buf), stats.seq_ids), ('', []))
+        stats.add('d', 'ACG')
+        self.assertEqual((str(stats.seq_buf), stats.seq_ids), ('', []))
+        self.assertTrue(stats.aln() is None)
+
+    def test_merge(self):
+        rng = random.Random(0)
+        for lens in [[50], [0, 10, 50]]:
+            for _ in xrange(20):
+                records = random_records(rng, 40, lens)
+                expected = stats_summary(self.serial(records))
+                cuts = sorted(rng.sample(xrange(len(records)+1), 3))
+                merged = seqstat.SeqStats(keep_info=True)
+                for (start, end) in zip([0] + cuts, cuts + [len(records)]):
+                    merged.merge(self.serial(records[start:end]))
+                self.assertEqual(stats_summary(merged), expected)
+
+    def test_merge_drops_seqs(self):
+        for chunks in [[[('a', 'AC')], [('b', 'ACG')]],
+                       [[('a', 'AC'), ('b', 'AC')], [('c', 'AC'), ('d', 'A')]],
+                       [[('a', 'AC'), ('b', 'A')], [('c', 'AC')]]]:
+            merged = seqstat.SeqStats(keep_info=True)
+            for chunk in chunks:
+                merged.merge(self.serial(chunk))
+            self.assertFalse(merged.aligned())
+            self.assertEqual((str(merged.seq_buf), merged.seq_ids), ('', []))
+            self.assertEqual(stats_summary(merged), stats_summary(
+                self.serial(sum(chunks, []))))
+
+
+
+class TestParallelStats(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix="test-seqstat-")
+        rng = random.Random(1)
+        text = ''.join('>%s x\n%s\n' % rec
+                       for rec in random_records(rng, 3000, [0, 10, 50, 200]))
+        self.files = []
+        orig_block_size = bioutils.BGZF_BLOCK_DATA_SIZE
+        # many small BGZF blocks
+        bioutils.BGZF_BLOCK_DATA_SIZE = 997
+        try:
+            for ext in ['', '.bgz']:
+                fname = os.path.join(self.tmp_dir, "x.fa" + ext)
+                with bioutils.xopen_write(fname, use_external=False) as fh:
+                    fh.write(text)
+                self.files.append(fname)
+        finally:
+            bioutils.BGZF_BLOCK_DATA_SIZE = orig_block_size
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_chunks(self):
+        for fname in self.files:
+            fh = bioutils.xopen(fname)
+            serial = seqstat.SeqStats(keep_seqs=False, keep_info=True)
+            for rec in bioutils.read_fastx(fh, 'fasta'):
+                serial.add(rec[0], rec[2])
+            fh.close()
+            merged = seqstat.SeqStats(keep_seqs=False, keep_info=True)
+            for other in bioutils.fastx_parallel_map(
+                    fname, 'fasta', seqstat.chunk_stats, (True,),
+                    num_workers=3, chunk_size=5000):
+                merged.merge(other)
+            self.assertEqual(stats_summary(merged), stats_summary(serial))
+
+    def test_cmdline(self):
+        for fname in self.files:
+            outs = []
+            for args in [['-a'], ['-a', '-s'], ['-a', '-s', '-w', '3']]:
+                proc = subprocess.Popen(
+                    [sys.executable, os.path.join(os.path.dirname(TEST_DIR),
+                                                  'seqstat.py')]
+                    + args + [fname],
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                (out, err) = proc.communicate()
+                self.assertEqual(proc.returncode, 0, err)
+                outs.append(out)
+            self.assertEqual(outs[1], outs[0])
+            self.assertEqual(outs[2], outs[0])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
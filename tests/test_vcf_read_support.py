@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Tests for vcf_read_support: the sweep must give the same output as
+fetching reads per variant
+"""
+
+
+#--- standard library imports
+#
+import os
+import sys
+import copy
+import types
+import random
+import unittest
+
+#--- project specific imports
+#
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TEST_DIR))
+
+
+class FakeRead(object):
+    """Minimal stand-in for pysam.AlignedRead
+    """
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+
+class FakeSamfile(object):
+    """Minimal stand-in for pysam.Samfile: reads sorted by position
+    per chromosome for fetching, written reads are collected
+    """
+
+    def __init__(self, reads=None):
+        self.reads = reads
+        self.written = []
+
+    def fetch(self, reference, start, end):
+        for r in self.reads.get(reference, []):
+            if r.pos < end and r.aend > start:
+                # pysam returns new objects on every fetch
+                yield copy.deepcopy(r)
+
+    def write(self, r):
+        self.written.append((r.name, r.tags))
+
+
+# vcf_read_support imports pysam, which is only needed for file
+# access
+if 'pysam' not in sys.modules:
+    sys.modules['pysam'] = types.ModuleType('pysam')
+import vcf_read_support
+
+
+
+def random_data(seed, chroms=('c1', 'c2', 'c3'), reads_per_chrom=300,
+                num_vars=200):
+    """Returns reads (dict of position sorted lists per chromosome)
+    and variants (unsorted, with duplicates)
+    """
+
+    rng = random.Random(seed)
+    reads = dict()
+    num = 0
+    for chrom in chroms:
+        reads[chrom] = []
+        pos = 0
+        for _ in xrange(reads_per_chrom):
+            # occasional large jumps make for sparse regions
+            pos += rng.choice([0, 1, 2, 5, 500])
+            read_len = rng.randint(5, 30)
+            pairs = []
+            (qpos, rpos) = (0, pos)
+            while qpos < read_len:
+                x = rng.random()
+                if x < 0.05:
+                    pairs.append((None, rpos))
+                    rpos += 1
+                elif x < 0.1:
+                    pairs.append((qpos, None))
+                    qpos += 1
+                else:
+                    pairs.append((qpos, rpos))
+                    qpos += 1
+                    rpos += 1
+            reads[chrom].append(FakeRead(
+                name='r%d' % num, pos=pos, aend=rpos, cigar=[(0, read_len)],
+                is_unmapped=False,
+                flag=rng.choice([0, 1, 3, 3, 3, 0x400 | 3, 0x100]),
+                mapq=rng.randint(0, 60), aligned_pairs=pairs,
+                query=''.join(rng.choice('ACGTacgtN')
+                              for _ in xrange(read_len)),
+                qqual=''.join(chr(33 + rng.randint(0, 40))
+                              for _ in xrange(read_len)),
+                tags=[('NM', 1)] if rng.random() < 0.5 else []))
+            num += 1
+
+    variants = []
+    for _ in xrange(num_vars):
+        chrom = rng.choice(chroms)
+        max_pos = reads[chrom][-1].pos
+        (ref, alt) = rng.sample('ACGT', 2)
+        var = vcf_read_support.Variant(
+            chrom, rng.randint(0, max_pos), '.', ref, alt, '.', '.', dict())
+        variants.append(var)
+        if rng.random() < 0.1:
+            variants.append(var)
+    return (reads, variants)
+
+
+
+class TestSweep(unittest.TestCase):
+
+    def run_both(self, reads, variants, sweep_gap, args=()):
+        args = vcf_read_support.cmdline_parser().parse_args(
+            ['-b', 'fake.bam', '--sweep-gap', str(sweep_gap)] + list(args))
+        outputs = []
+        for func in [vcf_read_support.fetch_per_variant,
+                     vcf_read_support.sweep_variants]:
+            sam_out_fh = FakeSamfile()
+            func(FakeSamfile(reads), sam_out_fh, variants, args)
+            outputs.append(sam_out_fh.written)
+        return outputs
+
+    def test_sweep_equals_per_variant(self):
+        for seed in xrange(5):
+            (reads, variants) = random_data(seed)
+            for sweep_gap in [0, 10, 1000, 10**9]:
+                (expected, found) = self.run_both(reads, variants, sweep_gap)
+                self.assertTrue(len(expected) > 0)
+                self.assertEqual(expected, found)
+
+    def test_sweep_equals_per_variant_filters(self):
+        (reads, variants) = random_data(42)
+        (expected, found) = self.run_both(
+            reads, variants, 100, ['--use-orphan', '--mq-filter', '20',
+                                   '--bq-filter', '0'])
+        self.assertEqual(expected, found)
+
+    def test_skip_flagged(self):
+        (reads, variants) = random_data(1)
+        flags = dict((r.name, r.flag) for chrom_reads in reads.values()
+                     for r in chrom_reads)
+        # flagged reads are only ignored on request
+        (written, _) = self.run_both(reads, variants, 100)
+        self.assertTrue(any(flags[name] & (0x100 | 0x400)
+                            for (name, _) in written))
+        (expected, found) = self.run_both(reads, variants, 100,
+                                          ['--skip-flagged'])
+        self.assertEqual(expected, found)
+        self.assertTrue(expected)
+        for (name, _) in expected:
+            self.assertFalse(flags[name] & (0x100 | 0x400))
+
+    def test_variant_clusters(self):
+        (_, variants) = random_data(3)
+        for max_gap in [0, 50, 10**9]:
+            seen = []
+            for (chrom, cluster) in vcf_read_support.variant_clusters(
+                    variants, max_gap):
+                positions = [pos for (pos, _) in cluster]
+                self.assertEqual(positions, sorted(positions))
+                for (pos, idx) in cluster:
+                    self.assertEqual(variants[idx].chrom, chrom)
+                self.assertTrue(all(positions[i+1] - positions[i] <= max_gap
+                                    for i in xrange(len(positions)-1)))
+                seen.extend(idx for (_, idx) in cluster)
+            self.assertEqual(sorted(seen), range(len(variants)))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
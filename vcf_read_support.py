@@ -20,7 +20,6 @@ import sys
 import logging
 import os
 import argparse
-import gzip
 from collections import namedtuple
 
 #--- third-party imports
@@ -30,7 +29,7 @@ import pysam
 
 #--- project specific imports
 #
-# /
+import bioutils
 
 
 #global logger
@@ -50,6 +49,10 @@ Variant = namedtuple('Variant',
 
 SKIP_FLAGS = [0x4, 0x100, 0x200, 0x400]
 
+# variants further apart than this are fetched separately, so that
+# reads between sparse variants aren't read for nothing
+DEFAULT_SWEEP_GAP = 1000
+
 
 def cmdline_parser():
     """Returns an argparse instance
@@ -88,6 +91,25 @@ def cmdline_parser():
     parser.add_argument("-a", "--use-orphan",
                         action="store_true",
                         help="Don't ignore orphan-reads / anomalous read-pairs")
+    parser.add_argument("--skip-flagged",
+                        action="store_true",
+                        help="Ignore unmapped, secondary, qc-failed and"
+                        " duplicate reads (flags 0x4, 0x100, 0x200, 0x400)."
+                        " Off by default, keeping the output of earlier"
+                        " versions, which used them")
+    parser.add_argument("--no-sweep",
+                        action="store_true",
+                        help="Fetch reads separately for each variant instead"
+                        " of one sweep over each cluster of nearby variants"
+                        " sorted by position (same output, but slow for"
+                        " dense variants)")
+    default = DEFAULT_SWEEP_GAP
+    parser.add_argument("--sweep-gap",
+                        type=int,
+                        default=default,
+                        help="Variants on the same chromosome at most this"
+                        " far apart are handled in one sweep, i.e. reads"
+                        " are fetched once for all of them (default=%d)" % default)
 
     return parser
 
@@ -116,6 +138,248 @@ def simple_vcf_reader(fh):
         yield Variant(chrom, pos, id, ref, alt, qual, filter, info)
         
         
+class ReadInfo(object):
+    """Read level values needed for testing a read against variants,
+    decoded once per read (lazily) and shared by all variants it
+    covers
+    """
+
+    def __init__(self, read):
+        """
+        """
+        self.read = read
+        self._ref_to_read = None
+        self._query = None
+        self._qqual = None
+        self._tags = None
+
+
+    def ref_to_read(self):
+        """Maps reference positions to read positions (None for
+        deletions)
+        """
+        if self._ref_to_read is None:
+            self._ref_to_read = dict([
+                (vpos_on_ref, vpos_on_read)
+                for (vpos_on_read, vpos_on_ref) in self.read.aligned_pairs])
+        return self._ref_to_read
+
+
+    def query(self):
+        """Query sequence
+        """
+        if self._query is None:
+            self._query = self.read.query
+        return self._query
+
+
+    def qqual(self):
+        """Query qualities (ASCII)
+        """
+        if self._qqual is None:
+            self._qqual = self.read.qqual
+        return self._qqual
+
+
+    def tags(self):
+        """Original tags of the read
+        """
+        if self._tags is None:
+            self._tags = self.read.tags
+        return self._tags
+
+
+
+def read_passes_filters(r, args):
+    """Returns True if read r passes the variant independent filters
+    """
+
+    # unused by default: the flag loop used to have no effect
+    if args.skip_flagged:
+        for f in SKIP_FLAGS:
+            if r.flag & f:
+                return False
+
+    orphan = (r.flag & 0x1) and not (r.flag & 0x2)
+    if orphan and not args.use_orphan:
+        return False
+
+    if r.mapq < args.min_mq:
+        return False
+    return True
+
+
+
+def support_tag(read_info, var, args):
+    """Returns tag (tuple of key and value) for read supporting
+    variant ('VV') or reference ('VR'), or None if neither or
+    filtered
+    """
+
+    ref_to_read = read_info.ref_to_read()
+    assert var.pos in ref_to_read
+    vpos_on_read = ref_to_read[var.pos]
+    if vpos_on_read == None:# FIXME no support for deletions
+        return None
+
+    b = read_info.query()[vpos_on_read]
+    bq = ord(read_info.qqual()[vpos_on_read])-33
+
+    if bq < args.min_bq:
+        return None
+
+    if b.upper() == var.ref[0].upper():
+        var_tag_key = 'VR'
+    elif b.upper() == var.alt[0].upper():
+        var_tag_key = 'VV'
+    else:
+        # ignore non ref non var
+        return None
+
+    return (var_tag_key, '%s:%d:%s>%s' % (
+        var.chrom, var.pos+1, var.ref, var.alt))
+
+
+
+def write_tagged(sam_out_fh, read_info, var_tag):
+    """Writes read with var_tag added to its original tags
+    """
+
+    # only way I found to add tags. inspired by
+    # http://www.ngcrawford.com/2012/04/17/python-adding-read-group-rg-tags-to-bam-or-sam-files/
+    tags = read_info.tags()
+    assert var_tag[0] not in [t[0] for t in tags], (
+        "Oops...tag %s already present in read. Refusing to overwrite")
+    read_info.read.tags = tags + [var_tag]
+    sam_out_fh.write(read_info.read)
+
+
+
+def ref_end(r):
+    """End of read r on reference (exclusive) as used for fetching,
+    i.e. pos+1 for unmapped reads or reads without cigar
+    """
+    if r.is_unmapped or not r.cigar:
+        return r.pos + 1
+    return r.aend
+
+
+
+def fetch_per_variant(sam_in_fh, sam_out_fh, variants, args):
+    """Fetches reads separately for each variant and writes those
+    supporting variant or reference
+    """
+
+    for var in variants:
+        reads = list(sam_in_fh.fetch(reference=var.chrom,
+                                 start=var.pos, end=var.pos+1))
+        LOG.info("%s %d: %d (unfiltered) reads covering position" % (
+           var.chrom, var.pos+1, len(reads)))
+
+        for r in reads:
+            if not read_passes_filters(r, args):
+                continue
+            read_info = ReadInfo(r)
+            var_tag = support_tag(read_info, var, args)
+            if var_tag is None:
+                continue
+            write_tagged(sam_out_fh, read_info, var_tag)
+
+
+
+def variant_clusters(variants, max_gap):
+    """Groups variants by chromosome (in order of first appearance)
+    and, sorted by position, into clusters of variants at most
+    max_gap apart. Yields tuples of chromosome and list of (position,
+    index in variants) per cluster
+    """
+
+    by_chrom = dict()
+    chrom_order = []
+    for (idx, var) in enumerate(variants):
+        if var.chrom not in by_chrom:
+            by_chrom[var.chrom] = []
+            chrom_order.append(var.chrom)
+        by_chrom[var.chrom].append((var.pos, idx))
+
+    for chrom in chrom_order:
+        # stable: duplicates stay in input order
+        chrom_vars = sorted(by_chrom[chrom], key=lambda x: x[0])
+        cluster = [chrom_vars[0]]
+        for (pos, idx) in chrom_vars[1:]:
+            if pos - cluster[-1][0] > max_gap:
+                yield (chrom, cluster)
+                cluster = []
+            cluster.append((pos, idx))
+        yield (chrom, cluster)
+
+
+
+def sweep_variants(sam_in_fh, sam_out_fh, variants, args):
+    """Same output as fetch_per_variant(), but with one sweep over the
+    reads of each cluster of nearby variants (see
+    variant_clusters()): every read is decoded once and tested
+    against all variants it covers (active window). Output is
+    buffered per variant until all variants listed before it are
+    done, so that it comes out in original order
+    """
+
+    # per variant: list of (read_info, var_tag) or None if not done
+    outputs = [None] * len(variants)
+    state = dict(next_out=0)
+
+    def flush():
+        """Write output of done variants in original order
+        """
+        while state['next_out'] < len(variants) \
+          and outputs[state['next_out']] is not None:
+            for (read_info, var_tag) in outputs[state['next_out']]:
+                write_tagged(sam_out_fh, read_info, var_tag)
+            outputs[state['next_out']] = []
+            state['next_out'] += 1
+
+    for (chrom, cluster) in variant_clusters(variants, args.sweep_gap):
+        nvars = len(cluster)
+        pending = [[] for _ in cluster]
+        num_reads = [0] * nvars
+        # active window starts with first variant not left of the
+        # current read
+        first = 0
+        reads = sam_in_fh.fetch(reference=chrom, start=cluster[0][0],
+                                end=cluster[-1][0]+1)
+        for r in reads:
+            # variants left of this read can't be covered by later
+            # reads, which are sorted by position
+            if first < nvars and cluster[first][0] < r.pos:
+                while first < nvars and cluster[first][0] < r.pos:
+                    outputs[cluster[first][1]] = pending[first]
+                    first += 1
+                flush()
+
+            end = ref_end(r)
+            passes = None
+            i = first
+            while i < nvars and cluster[i][0] < end:
+                num_reads[i] += 1
+                if passes is None:
+                    passes = read_passes_filters(r, args)
+                    read_info = ReadInfo(r)
+                if passes:
+                    var_tag = support_tag(
+                        read_info, variants[cluster[i][1]], args)
+                    if var_tag is not None:
+                        pending[i].append((read_info, var_tag))
+                i += 1
+
+        for i in xrange(first, nvars):
+            outputs[cluster[i][1]] = pending[i]
+        for (i, (pos, idx)) in enumerate(cluster):
+            LOG.info("%s %d: %d (unfiltered) reads covering position" % (
+                chrom, pos+1, num_reads[i]))
+        flush()
+
+
+
 def main():
     """The main function
     """
@@ -145,14 +409,11 @@ def main():
         LOG.fatal("Please use one: vcf or variant arg, but bot both")
         sys.exit(1)
     if args.vcf: 
-        if args.vcf == '-':
-            vcf_reader = simple_vcf_reader(sys.stdin)
-        else:
-            if args.vcf[-3:] == '.gz':
-                vcf_reader = simple_vcf_reader(gzip.open(args.vcf))
-            else:
-                vcf_reader = simple_vcf_reader(open(args.vcf))
+        # transparently decompresses
+        fh_vcf = bioutils.xopen(args.vcf)
+        vcf_reader = simple_vcf_reader(fh_vcf)
         variants = [r for r in vcf_reader]
+        fh_vcf.close()
         LOG.info("Loaded %d variants from %s" % (len(variants), args.vcf))
         
     elif args.var:
@@ -169,6 +430,7 @@ def main():
         LOG.critical("Missing vcf or variant argument") 
         sys.exit(1)
         
+    supported = []
     for var in variants:
         if var.info.has_key('INDEL'):
             LOG.warn("Skipping unsupported indel variant at %s:%d" % (
@@ -178,74 +440,16 @@ def main():
             LOG.warn("Skipping ref/alt variant with more than"
                      " 1 base at %s:%d" % (var.chrom, var.pos+1))
             continue
-            
-        reads = list(sam_in_fh.fetch(reference=var.chrom,
-                                 start=var.pos, end=var.pos+1))
-        LOG.info("%s %d: %d (unfiltered) reads covering position" % (
-           var.chrom, var.pos+1, len(reads)))
-
-        for r in reads:
-
-            # FIXME combine
-            for f in SKIP_FLAGS:
-                if r.flag & f:
-                    continue
-                
-            orphan = (r.flag & 0x1) and not (r.flag & 0x2)
-            if orphan and not args.use_orphan:
-                continue
+        supported.append(var)
 
-            if r.mapq < args.min_mq:
-                continue
-        
-            vpos_on_read = [vpos_on_read 
-                            for (vpos_on_read, vpos_on_ref) in r.aligned_pairs 
-                            if vpos_on_ref==var.pos]
-            assert len(vpos_on_read)==1
-            vpos_on_read = vpos_on_read[0]
-            if vpos_on_read == None:# FIXME no support for deletions
-                continue
-
-            b = r.query[vpos_on_read]
-            bq = ord(r.qqual[vpos_on_read])-33
-
-            if bq < args.min_bq:
-                continue
-
-            has_ref = False
-            has_var = False
-            if b.upper() == var.ref[0].upper():
-                has_ref = True
-            elif b.upper() == var.alt[0].upper():
-                has_var = True
-            else:
-                # ignore non ref non var
-                continue
-
-            # only way I found to add tags. inspired by
-            # http://www.ngcrawford.com/2012/04/17/python-adding-read-group-rg-tags-to-bam-or-sam-files/
-
-            if has_ref:
-                var_tag_key = 'VR'
-            elif has_var:
-                var_tag_key = 'VV'
-            else:
-                continue# paranoia (already handled above)
-            assert var_tag_key not in [t[0] for t in r.tags], (
-                "Oops...tag %s already present in read. Refusing to overwrite")
-            var_tag = (var_tag_key, '%s:%d:%s>%s' % (
-                var.chrom, var.pos+1, var.ref, var.alt))
-            new_tags = r.tags
-            new_tags.append(var_tag)
-            r.tags = new_tags
-             
-            sam_out_fh.write(r)
+    if args.no_sweep:
+        fetch_per_variant(sam_in_fh, sam_out_fh, supported, args)
+    else:
+        sweep_variants(sam_in_fh, sam_out_fh, supported, args)
 
     sam_in_fh.close()
     # FIXME close sam out if not stdout
 
-    # FIXME untangle and move to functions
-    
     # FIXME add tests:
     #  1:
     #    vcf_read_support.py -b bam -v var | grep -c var